@@ -0,0 +1,257 @@
+"""Бенчмарк синхронизации без гугл аккаунта.
+
+Генерирует синтетические папки, гоняет по ним folder_upload и оба
+main() против FakeDriveHttp и печатает время, число запросов к апи,
+переданные байты и пиковую память. Каждое дерево меряется в отдельном
+процессе, чтобы пиковая память не копилась между деревьями.
+
+    python benchmark.py
+    python benchmark.py --trees wide deep --scale 2 --latency 0.02
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import updateDrivetoPC
+import updatePCtoDrive
+from drive_api import build_service
+from drive_tree import folder_upload
+from fake_drive import FakeDriveHttp
+from metrics import METRICS
+from throttle import RequestLimiter, ThrottledHttp
+
+DIR_NAME = 'DnD'
+# Какую долю файлов менять между запусками
+CHANGE_SHARE = 0.1
+SEED = 1
+
+
+def _write(path, size, rand):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(rand.randbytes(size))
+
+
+def wide_tree(root, scale, rand):
+    """Много папок на одном уровне, в каждой по несколько файлов."""
+    for i in range(200 * scale):
+        for j in range(5):
+            _write(os.path.join(root, 'dir%04d' % i, 'file%d.txt' % j),
+                   1024, rand)
+
+
+def deep_tree(root, scale, rand):
+    """Цепочка вложенных папок, по два файла на уровень."""
+    path = root
+    for i in range(50 * scale):
+        path = os.path.join(path, 'level%03d' % i)
+        for j in range(2):
+            _write(os.path.join(path, 'file%d.txt' % j), 1024, rand)
+
+
+def many_small_tree(root, scale, rand):
+    """Тысячи маленьких файлов в нескольких папках."""
+    for i in range(2000 * scale):
+        _write(os.path.join(root, 'dir%02d' % (i % 20), 'small%05d.txt' % i),
+               256, rand)
+
+
+def few_huge_tree(root, scale, rand):
+    """Несколько больших файлов, которые идут resumable выгрузкой."""
+    for i in range(3 * scale):
+        _write(os.path.join(root, 'huge%d.bin' % i), 24 * 1024 * 1024, rand)
+
+
+def duplicate_names_tree(root, scale, rand):
+    """Одинаковые названия папок в разных местах дерева."""
+    for i in range(30 * scale):
+        for rel_dir in ('img', os.path.join('img', 'img'), 'docs'):
+            for j in range(3):
+                _write(os.path.join(root, 'part%03d' % i, rel_dir,
+                                    'file%d.dat' % j), 2048, rand)
+
+
+def duplicate_content_tree(root, scale, rand):
+    """Папки с ассетами, где одни и те же файлы лежат во многих местах."""
+    blobs = [rand.randbytes(512 * 1024) for _ in range(5)]
+    for i in range(20 * scale):
+        for j, blob in enumerate(blobs):
+            path = os.path.join(root, 'assets%03d' % i, 'blob%d.bin' % j)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as out:
+                out.write(blob)
+
+
+TREES = {
+    'wide': wide_tree,
+    'deep': deep_tree,
+    'many_small': many_small_tree,
+    'few_huge': few_huge_tree,
+    'duplicate_names': duplicate_names_tree,
+    'duplicate_content': duplicate_content_tree,
+}
+
+
+def _local_files(full_path):
+    return sorted(os.path.join(dir_path, name)
+                  for dir_path, _, names in os.walk(full_path)
+                  for name in names)
+
+
+def change_local(full_path, rand):
+    """Переписывает часть файлов на пк."""
+    files = _local_files(full_path)
+    for path in rand.sample(files, max(1, int(len(files) * CHANGE_SHARE))):
+        _write(path, os.path.getsize(path), rand)
+        # mtime должен уйти дальше допуска сравнения времени
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+def change_drive(fake, rand):
+    """Переписывает часть файлов на фейковом диске."""
+    files = sorted(fake.contents)
+    for file_id in rand.sample(files, max(1, int(len(files) * CHANGE_SHARE))):
+        fake.update_file(file_id, rand.randbytes(len(fake.contents[file_id])))
+
+
+def use_fake(module, fake, full_path, limiter):
+    """Направляет модуль скрипта синхронизации в фейковый диск.
+
+    Настоящий ThrottledHttp остается, чтобы в замер попадали
+    и ограничитель запросов, и METRICS.
+    """
+    module.FULL_PATH = full_path
+    module.DIR_NAME = DIR_NAME
+    module.get_credentials = lambda: None
+    module.new_http = lambda credentials: ThrottledHttp(fake, limiter)
+
+
+def measure(results, tree, step, fake, work_dir, func, *args, **kwargs):
+    """Запускает один этап и дописывает его показатели в results."""
+    before = (fake.http_requests, sum(fake.calls.values()),
+              fake.bytes_up, fake.bytes_down)
+    METRICS.reset()
+    os.chdir(work_dir)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    after = (fake.http_requests, sum(fake.calls.values()),
+             fake.bytes_up, fake.bytes_down)
+    requests, calls, sent, received = (b - a for a, b in zip(before, after))
+    results.append({
+        'tree': tree, 'step': step, 'seconds': round(seconds, 3),
+        'requests': requests, 'calls': calls,
+        'sent': sent, 'received': received,
+        'hashed': METRICS.report()['bytes'].get('hashed', 0),
+        # ru_maxrss на Linux в килобайтах; это пик процесса к концу этапа
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+def run_tree(tree, scale, latency, rate, workers):
+    """Меряет все этапы синхронизации на одном сгенерированном дереве.
+
+    Этапы: folder_upload, первый и повторный main() выгрузки,
+    main() выгрузки после изменений на пк, полный main() скачивания
+    в пустую папку и main() скачивания по changes после изменений
+    на диске.
+
+    Возвращает:
+        Список словарей с показателями каждого этапа.
+    """
+    rand = random.Random(SEED)
+    fake = FakeDriveHttp(latency=latency)
+    limiter = RequestLimiter(rate=rate, burst=rate)
+    results = []
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix='drive-bench-')
+    push_dir, pull_dir = os.path.join(work, 'push'), os.path.join(work, 'pull')
+    push_path = os.path.join(push_dir, DIR_NAME)
+    pull_path = os.path.join(pull_dir, DIR_NAME)
+    try:
+        TREES[tree](push_path, scale, rand)
+        os.makedirs(pull_path)
+        use_fake(updatePCtoDrive, fake, push_path, limiter)
+        use_fake(updateDrivetoPC, fake, pull_path, limiter)
+        push = functools.partial(updatePCtoDrive.main, workers=workers)
+        pull = functools.partial(updateDrivetoPC.main, workers=workers)
+        run = functools.partial(measure, results, tree, fake=fake)
+
+        # Кеш описания апи ложится в рабочую папку, как и sync_state.db
+        os.chdir(push_dir)
+        service = build_service(ThrottledHttp(fake, limiter))
+        run(step='folder_upload', work_dir=push_dir, func=folder_upload,
+            service=service, full_path=push_path,
+            http_factory=lambda: ThrottledHttp(fake, limiter))
+        run(step='push_first', work_dir=push_dir, func=push)
+        run(step='push_noop', work_dir=push_dir, func=push)
+        change_local(push_path, rand)
+        run(step='push_changed', work_dir=push_dir, func=push)
+        run(step='pull_full', work_dir=pull_dir, func=pull, full=True)
+        change_drive(fake, rand)
+        run(step='pull_changes', work_dir=pull_dir, func=pull)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print('%-18s %-14s %8s %8s %8s %10s %10s %10s' % (
+        'Дерево', 'Этап', 'Время, с', 'HTTP', 'Вызовов',
+        'Отпр., МБ', 'Получ., МБ', 'RSS, МБ'))
+    for row in results:
+        print('%-18s %-14s %8.3f %8d %8d %10.2f %10.2f %10.1f' % (
+            row['tree'], row['step'], row['seconds'], row['requests'],
+            row['calls'], row['sent'] / 2 ** 20, row['received'] / 2 ** 20,
+            row['peak_rss'] / 2 ** 20))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Бенчмарк синхронизации против фейкового гугл диска')
+    parser.add_argument('--trees', nargs='+', choices=sorted(TREES),
+                        default=list(TREES), help='Какие деревья мерить')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='Во сколько раз увеличить деревья')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Задержка фейкового диска на запрос, в секундах')
+    parser.add_argument('--rate', type=float, default=1e9,
+                        help='Ограничение запросов в секунду '
+                             '(по умолчанию без ограничения)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Сколько файлов передавать одновременно')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Записать результаты еще и в JSON файл')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    # Каждое дерево в свежем процессе: ru_maxrss не сбрасывается
+    context = multiprocessing.get_context('fork')
+    for tree in args.trees:
+        with context.Pool(1) as pool:
+            results += pool.apply(run_tree, (tree, args.scale, args.latency,
+                                             args.rate, args.workers))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as report_file:
+            json.dump(results, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
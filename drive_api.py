@@ -0,0 +1,279 @@
+import datetime
+import json
+import os
+import time
+
+from googleapiclient.errors import HttpError
+
+from metrics import call_name
+from throttle import (ThrottledHttp, is_idempotent, is_rate_limited,
+                      non_idempotent)
+from transport import SessionHttp, shared_session
+
+# Максимальный размер страницы, который разрешает files().list
+PAGE_SIZE = 1000
+# Больше 100 запросов в одном batch гугл диск не принимает
+BATCH_SIZE = 100
+# На сколько секунд могут расходиться времена изменения одного и того же
+# файла (диск хранит миллисекунды, FAT - четные секунды)
+MTIME_TOLERANCE = 2
+
+# Описание апи (discovery document) хранится на диске рядом с sync_state.db
+DISCOVERY_CACHE = 'drive_v3_discovery.json'
+# Как часто обновлять описание апи с сервера, в секундах
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+
+# Если хотим изменить права доступа, то нужно удалить файл token.json
+SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly',
+          'https://www.googleapis.com/auth/drive.file',
+          'https://www.googleapis.com/auth/drive']
+
+
+def parse_time(value):
+    """Переводит modifiedTime гугл диска (RFC 3339, UTC) в timestamp."""
+    return datetime.datetime.fromisoformat(
+        value.replace('Z', '+00:00')).timestamp()
+
+
+def format_time(timestamp):
+    """Переводит timestamp (например, st_mtime) в modifiedTime для диска."""
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat(
+            timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def get_credentials(scopes=SCOPES):
+    """Получает credentials пользователя из файла (или создает его, если нет).
+
+    Аргументы:
+        scopes: Какие права доступа запросить.
+
+    Возвращает:
+        Credentials, полученный credential.
+    """
+    # Библиотеки авторизации грузятся долго, а нужны только здесь
+    from google.oauth2.credentials import Credentials
+
+    creds = None
+
+    if os.path.exists("token.json"):
+        creds = Credentials.from_authorized_user_file("token.json", scopes)
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
+
+            # Токен обновляем через тот же пул соединений, что и запросы
+            creds.refresh(Request(shared_session()))
+        else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
+            flow = InstalledAppFlow.from_client_secrets_file(
+                "credentials.json", scopes
+            )
+            creds = flow.run_local_server(port=0)
+        # Сохраняем credentials для будущих запусков
+        with open("token.json", "w") as token:
+            token.write(creds.to_json())
+    return creds
+
+
+def new_http(credentials):
+    """Создает авторизованный HTTP клиент.
+
+    Все клиенты ходят через общий на процесс пул keep-alive
+    соединений (transport.shared_session), под общим ограничителем
+    частоты и с повтором при ответах 429, 5xx и 403 rateLimitExceeded.
+
+    Аргументы:
+        credentials: Credentials пользователя.
+
+    Возвращает:
+        ThrottledHttp, который можно передать в execute(http=...)
+        или в build_service.
+    """
+    return ThrottledHttp(SessionHttp(credentials))
+
+
+def load_discovery(http, cache_path=DISCOVERY_CACHE, ttl=DISCOVERY_TTL):
+    """Возвращает описание апи гугл диска (discovery document).
+
+    Берет его из кеша на диске. При первом запуске кеш заполняется
+    описанием, которое идет вместе с библиотекой гугла, а раз в ttl
+    секунд обновляется с сервера. Если сервер недоступен, остается
+    старое описание, и следующая попытка будет через ttl.
+
+    Аргументы:
+        http: HTTP клиент для запроса описания.
+        cache_path: Путь до файла кеша.
+        ttl: Сколько секунд описание в кеше считается свежим.
+
+    Возвращает:
+        Описание апи, строку JSON.
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as cache_file:
+            document = cache_file.read()
+        age = time.time() - os.stat(cache_path).st_mtime
+    except OSError:
+        document, age = None, None
+
+    if document is None:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        document = get_static_doc('drive', 'v3')
+    elif age < ttl:
+        return document
+
+    if document is None or age is not None:
+        try:
+            response, content = http.request(DISCOVERY_URL)
+            if response.status == 200 and 'resources' in json.loads(content):
+                document = content.decode('utf-8')
+        except (OSError, ValueError):
+            pass
+    if document is None:
+        raise RuntimeError('Не удалось получить описание апи гугл диска')
+
+    # Пишем через временный файл, чтобы не оставить обрезанный кеш
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(document)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+    return document
+
+
+def build_service(http):
+    """Создает инстанс апишки гугл диска без похода за описанием апи.
+
+    Аргументы:
+        http: HTTP клиент, например из new_http.
+    """
+    # discovery тянет за собой половину библиотеки гугла,
+    # поэтому импортируем его только когда он нужен
+    from googleapiclient import discovery
+
+    return discovery.build_from_document(load_discovery(http), http=http)
+
+
+def iter_files(service, q=None, fields='id, name, mimeType', page_size=PAGE_SIZE):
+    """Лениво отдает все объекты гугл диска, подходящие под запрос.
+
+    Идет по страницам через nextPageToken, поэтому большие папки
+    читаются целиком, но в памяти держится только текущая страница.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        q: Строка запроса для files().list, None - без фильтра.
+        fields: Поля, которые нужно получить для каждого объекта.
+        page_size: Размер одной страницы.
+
+    Возвращает:
+        Генератор словарей с информацией об объектах.
+    """
+    page_token = None
+
+    while True:
+        results = service.files().list(
+            pageSize=page_size,
+            q=q,
+            fields='nextPageToken, files(%s)' % fields,
+            pageToken=page_token).execute()
+
+        yield from results.get('files', [])
+
+        page_token = results.get('nextPageToken')
+        if page_token is None:
+            return
+
+
+def list_changes(service, page_token, fields='*', page_size=PAGE_SIZE):
+    """Получает все изменения на гугл диске, начиная с курсора.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        page_token: Курсор из changes().getStartPageToken
+        или из прошлого вызова.
+        fields: Поля, которые нужно получить для каждого изменения.
+        page_size: Размер одной страницы.
+
+    Возвращает:
+        Список изменений и новый курсор для следующего запуска.
+    """
+    changes = []
+
+    while True:
+        results = service.changes().list(
+            pageToken=page_token,
+            pageSize=page_size,
+            spaces='drive',
+            fields='nextPageToken, newStartPageToken, changes(%s)' % fields
+        ).execute()
+
+        changes.extend(results.get('changes', []))
+
+        if 'newStartPageToken' in results:
+            return changes, results['newStartPageToken']
+        page_token = results['nextPageToken']
+
+
+def execute_batch(service, requests, batch_size=BATCH_SIZE):
+    """Выполняет запросы к апи пачками через batch HTTP.
+
+    Запросы, которые упали внутри пачки, повторяются по одному.
+    Создание и копирование файлов повторяются, только если сервер
+    их точно отклонил (429 или 403 rateLimitExceeded), а пачка с ними
+    целиком не повторяется после обрыва и 5xx: иначе на диске
+    появятся дубли.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        requests: Список пар (ключ, запрос), запросы еще не выполнены.
+        batch_size: Сколько запросов отправлять в одном batch.
+
+    Возвращает:
+        Два словаря: {ключ: ответ} для успешных запросов
+        и {ключ: HttpError} для тех, что не удалось выполнить.
+    """
+    results, failed = {}, []
+
+    for start in range(0, len(requests), batch_size):
+        chunk = requests[start:start + batch_size]
+
+        def callback(request_id, response, exception, chunk=chunk):
+            key, request = chunk[int(request_id)]
+            if exception is None:
+                results[key] = response
+            else:
+                failed.append((key, request, exception))
+
+        batch = service.new_batch_http_request(callback=callback)
+        for index, (_, request) in enumerate(chunk):
+            batch.add(request, request_id=str(index))
+        if all(_is_idempotent(request) for _, request in chunk):
+            batch.execute()
+        else:
+            with non_idempotent():
+                batch.execute()
+
+    errors = {}
+    for key, request, exception in failed:
+        if not (_is_idempotent(request) or (
+                isinstance(exception, HttpError)
+                and is_rate_limited(exception.resp, exception.content))):
+            errors[key] = exception
+            continue
+        try:
+            results[key] = request.execute()
+        except HttpError as error:
+            errors[key] = error
+
+    return results, errors
+
+
+def _is_idempotent(request):
+    """Можно ли повторить запрос, не зная, выполнил ли его сервер."""
+    return is_idempotent(request.uri, call_name(request.uri, request.method))
@@ -0,0 +1,389 @@
+import mimetypes
+import os
+
+from drive_api import execute_batch, iter_files
+from driveignore import IgnoreRules
+from metrics import METRICS
+
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+# mimeType гугл доков, таблиц, презентаций и т.п.
+GOOGLE_APPS_MIME = 'application/vnd.google-apps.'
+
+# Только те поля, которые нужны для синхронизации
+TREE_FIELDS = ('id, name, parents, mimeType, md5Checksum, modifiedTime, '
+               'size, version')
+
+# Карта майкросовтовских аналогов гугловских форматов
+# например, формат google docs, по сути просто веб,
+# поэтому при его выгрузке на пк не будет ничего отображаться.
+# для этого заменяем его на аналогичный от майкрософта (word .docx)
+GOOGLE_MIME_TYPES = {
+    'application/vnd.google-apps.document':
+        ['application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+         '.docx'],
+    'application/vnd.google-apps.spreadsheet':
+        ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+         '.xlsx'],
+    'application/vnd.google-apps.presentation':
+        ['application/vnd.openxmlformats-officedocument.presentationml.presentation',
+         '.pptx']
+}
+
+
+def is_native(item):
+    """Проверяет, что это гугл док, у которого нет md5Checksum и размера."""
+    return item['mimeType'].startswith(GOOGLE_APPS_MIME)
+
+
+def local_name(item):
+    """Имя объекта на пк. Гугл доки скачиваются в формате майкрософта,
+    поэтому к их имени добавляется расширение (Doc -> Doc.docx)."""
+    export = GOOGLE_MIME_TYPES.get(item['mimeType'])
+    if export is None or item['name'].endswith(export[1]):
+        return item['name']
+    return item['name'] + export[1]
+
+
+def load_tree(service, folder_id):
+    """Загружает все дерево папки с гугл диска за несколько запросов.
+
+    Вместо запроса на каждую папку берет все неудаленные объекты диска
+    большими страницами и уже в памяти оставляет только потомков folder_id.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        folder_id: ID корневой папки синхронизации.
+
+    Возвращает:
+        Два словаря {ID родительской папки: список объектов}:
+        подпапки и файлы каждой папки дерева.
+    """
+    children = {}
+
+    for item in iter_files(service, "trashed != True", TREE_FIELDS):
+        for parent in item.get('parents', []):
+            children.setdefault(parent, []).append(item)
+
+    # Оставляем только то, что достижимо из корневой папки
+    folders, files = {}, {}
+    stack, seen = [folder_id], {folder_id}
+    while stack:
+        parent = stack.pop()
+        for item in children.get(parent, []):
+            if item['mimeType'] == FOLDER_MIME:
+                if item['id'] in seen:
+                    continue
+                seen.add(item['id'])
+                folders.setdefault(parent, []).append(item)
+                stack.append(item['id'])
+            else:
+                files.setdefault(parent, []).append(item)
+
+    return folders, files
+
+
+def create_folders(service, tree, folder_dirs):
+    """Создает на гугл диске папки и добавляет их в дерево.
+
+    Папки создаются уровнями: сначала все папки одной глубины
+    одним batch запросом, потом их подпапки, и так далее.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        tree: DriveTree, в котором уже есть родители самых верхних папок.
+        folder_dirs: Относительные пути новых папок.
+
+    Исключения:
+        HttpError, если какую-то папку так и не удалось создать.
+    """
+    levels = {}
+    for folder_dir in folder_dirs:
+        levels.setdefault(folder_dir.count(os.path.sep), []).append(folder_dir)
+
+    for depth in sorted(levels):
+        requests, metadata = [], {}
+        for folder_dir in levels[depth]:
+            metadata[folder_dir] = {
+                'name': os.path.basename(folder_dir),
+                'parents': [tree.id_of(os.path.dirname(folder_dir))],
+                'mimeType': FOLDER_MIME}
+            requests.append((folder_dir, service.files().create(
+                body=metadata[folder_dir], fields='id')))
+
+        results, errors = execute_batch(service, requests)
+        for folder_dir, response in results.items():
+            tree.add(folder_dir, dict(metadata[folder_dir], id=response['id']),
+                     folder=True)
+        if errors:
+            raise next(iter(errors.values()))
+
+
+class DriveNode:
+    """Узел дерева гугл диска: папка или файл.
+
+    У файлов children равен None, у папок - список дочерних узлов.
+    """
+
+    __slots__ = ('path', 'item', 'children')
+
+    def __init__(self, path, item, folder=False):
+        self.path = path
+        self.item = item
+        self.children = [] if folder else None
+
+    @property
+    def id(self):
+        return self.item['id']
+
+    @property
+    def is_folder(self):
+        return self.children is not None
+
+
+class DriveTree:
+    """Индекс дерева папки на гугл диске.
+
+    Хранит узлы по относительному пути (вида DnD/a/img) и по ID,
+    поэтому папки с одинаковыми именами в разных местах
+    не перезаписывают друг друга.
+
+    Аргументы:
+        root_name: Название корневой папки синхронизации.
+        root_id: ID корневой папки на гугл диске.
+    """
+
+    __slots__ = ('root', '_by_path', '_by_id')
+
+    def __init__(self, root_name, root_id):
+        self._by_path = {}
+        self._by_id = {}
+        self.root = self.add(root_name, {'id': root_id,
+                                         'name': root_name,
+                                         'mimeType': FOLDER_MIME},
+                             folder=True)
+
+    def __contains__(self, path):
+        return path in self._by_path
+
+    def __len__(self):
+        return len(self._by_path)
+
+    def add(self, path, item, folder=False):
+        """Добавляет объект в дерево и возвращает его узел."""
+        node = DriveNode(path, item, folder)
+        parent = self._by_path.get(os.path.dirname(path))
+        if parent is not None:
+            parent.children.append(node)
+        self._by_path[path] = node
+        self._by_id[item['id']] = node
+        return node
+
+    def remove(self, path):
+        """Убирает объект и все его содержимое из дерева."""
+        node = self._by_path.pop(path, None)
+        if node is None:
+            return
+        self._by_id.pop(node.id, None)
+        parent = self._by_path.get(os.path.dirname(path))
+        if parent is not None:
+            parent.children.remove(node)
+        stack = list(node.children or [])
+        while stack:
+            child = stack.pop()
+            self._by_path.pop(child.path, None)
+            self._by_id.pop(child.id, None)
+            stack.extend(child.children or [])
+
+    def move(self, old_path, new_path, item=None):
+        """Переносит объект со всем содержимым на новый путь.
+
+        Аргументы:
+            old_path: Где объект лежал.
+            new_path: Куда его перенесли (родитель уже должен быть в дереве).
+            item: Новый словарь с информацией об объекте или None.
+        """
+        node = self._by_path.get(old_path)
+        if node is None:
+            return
+        parent = self._by_path.get(os.path.dirname(old_path))
+        if parent is not None:
+            parent.children.remove(node)
+        if item is not None:
+            node.item = item
+            self._by_id[item['id']] = node
+
+        nodes, stack = [], [node]
+        while stack:
+            current = stack.pop()
+            nodes.append(current)
+            self._by_path.pop(current.path, None)
+            stack.extend(current.children or [])
+        for current in nodes:
+            current.path = new_path + current.path[len(old_path):]
+            self._by_path[current.path] = current
+
+        parent = self._by_path.get(os.path.dirname(new_path))
+        if parent is not None:
+            parent.children.append(node)
+
+    def node(self, path):
+        return self._by_path.get(path)
+
+    def id_of(self, path):
+        """Возвращает ID объекта по относительному пути или None."""
+        node = self._by_path.get(path)
+        return node.id if node is not None else None
+
+    def path_of(self, file_id):
+        """Возвращает относительный путь объекта по его ID или None."""
+        node = self._by_id.get(file_id)
+        return node.path if node is not None else None
+
+    def folders(self):
+        """Возвращает относительные пути всех подпапок, кроме корневой."""
+        return [path for path, node in self._by_path.items()
+                if node.is_folder and node is not self.root]
+
+    def files(self, path):
+        """Возвращает список файлов (словари из апи) в папке."""
+        node = self._by_path.get(path)
+        if node is None:
+            return []
+        return [child.item for child in node.children
+                if not child.is_folder]
+
+
+def get_tree(folder_name, folder_id, service, ignore=None):
+    """Получает дерево папки на гугл диске.
+
+    Загружает дерево целиком за несколько запросов (см. load_tree)
+    и раскладывает его в памяти по относительным путям.
+
+    Аргументы:
+        folder_name: Название корневой папки синхронизации.
+        folder_id: ID корневой папки на гугл диске.
+        service: Инстанс апишки Гугл Диска.
+        ignore: IgnoreRules, объекты из которых в дерево не попадают.
+
+    Возвращает:
+       DriveTree со всеми подпапками и файлами.
+
+    """
+    folders, files = load_tree(service, folder_id)
+    tree = DriveTree(folder_name, folder_id)
+
+    stack = [folder_id]
+    while stack:
+        parent_id = stack.pop()
+        root = tree.path_of(parent_id)
+
+        for item in folders.get(parent_id, []):
+            path = os.path.join(root, item['name'])
+            if ignore and ignore.match(path, True):
+                continue
+            tree.add(path, item, folder=True)
+            stack.append(item['id'])
+        for item in files.get(parent_id, []):
+            path = os.path.join(root, item['name'])
+            if ignore and ignore.match(path):
+                continue
+            tree.add(path, item)
+
+    return tree
+
+
+def folder_upload(service, full_path, http_factory=None, state=None,
+                  workers=None, chunk_size=None):
+    '''Выгружает папку со всем ее содержимым (если еще не выгружена)
+    в корневую папку да гугл диске
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        full_path: Полный путь до папки на пк.
+        http_factory: Функция, создающая HTTP клиент для потока выгрузки.
+        state: SyncState, куда сохранять resumable сессии, чтобы
+        прерванная выгрузка больших файлов продолжилась с того же места.
+        workers: Сколько файлов выгружать одновременно
+        (None - UPLOAD_WORKERS).
+        chunk_size: Размер куска выгрузки больших файлов в байтах
+        (None - UPLOAD_CHUNK_SIZE).
+
+    Возвращает:
+        DriveTree выгруженной папки.
+    '''
+    # transfers и local_tree сами импортируют этот модуль
+    from local_tree import LocalTree
+    from transfers import (UPLOAD_CHUNK_SIZE, UPLOAD_WORKERS, UploadPool,
+                           find_copies, upload_files)
+
+    local = LocalTree(full_path, IgnoreRules.load(full_path))
+
+    folder_metadata = {'name': local.root,
+                       'parents': ['root'],
+                       'mimeType': FOLDER_MIME}
+    create_folder = service.files().create(body=folder_metadata,
+                                           fields='id').execute()
+    tree = DriveTree(local.root, create_folder.get('id', []))
+
+    # Подпапки создаем batch запросами, уровень за уровнем
+    create_folders(service, tree, local.folders())
+
+    # Файлы выгружаем в несколько потоков, а повторяющиеся
+    # по содержимому выгружаем один раз и копируем на диске
+    uploads, files = {}, {}
+    for rel_dir in [local.root] + local.folders():
+        folder_id = tree.id_of(rel_dir)
+
+        for name, file_stat in local.files(rel_dir).items():
+            rel_path = os.path.join(rel_dir, name)
+            file_metadata = {'name': name, 'parents': [folder_id]}
+            uploads[rel_path] = (local.full_path(rel_path), file_metadata,
+                                 mimetypes.guess_type(name)[0])
+            files[rel_path] = (local.full_path(rel_path), file_stat)
+
+    with METRICS.phase('hash'):
+        copies = find_copies(files)
+    with UploadPool(service, http_factory, workers or UPLOAD_WORKERS, state,
+                    chunk_size or UPLOAD_CHUNK_SIZE) as pool:
+        results, errors = upload_files(service, pool, uploads, copies)
+
+    for rel_path, created in results.items():
+        tree.add(rel_path, dict(created, name=os.path.basename(rel_path)))
+    for rel_path, error in errors.items():
+        print(f"Не удалось выгрузить {rel_path}: {error}")
+
+    return tree
+
+
+def check_upload(service, full_path, http_factory=None, upload=True,
+                 state=None, workers=None, chunk_size=None):
+    """Проверяет, выгружена ли папка на диск,
+    и если нет, то выгружает.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        full_path: Полный путь до папки на пк.
+        http_factory: Функция, создающая HTTP клиент для потока выгрузки.
+        upload: Выгружать ли папку, если ее нет (для --dry-run нельзя).
+        state, workers, chunk_size: Как в folder_upload.
+
+    Возвращает:
+        ID выгруженной папки (None, если ее нет и upload=False).
+
+    """
+
+    items = iter_files(
+        service,
+        "'root' in parents and trashed != True and "
+        "mimeType='application/vnd.google-apps.folder'")
+
+    # Проверяем, существует ли папка, и, если да, то получаем ее ID, иначе выгружаем
+    folder_name = os.path.basename(full_path)
+    folder_id = next((item['id'] for item in items
+                      if item['name'] == folder_name), None)
+    if folder_id is None and upload:
+        tree = folder_upload(service, full_path, http_factory, state,
+                             workers, chunk_size)
+        folder_id = tree.root.id
+
+    return folder_id
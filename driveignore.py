@@ -0,0 +1,132 @@
+import os
+import re
+
+# Файл с правилами лежит в корне синхронизируемой папки
+IGNORE_FILE = '.driveignore'
+
+
+def _translate(pattern):
+    """Переводит шаблон в стиле .gitignore в регулярное выражение.
+
+    * и ? не переходят через /, ** совпадает с любым количеством папок.
+    """
+    i, n, out = 0, len(pattern), []
+    while i < n:
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            out.append('[^/]*')
+        elif char == '?':
+            out.append('[^/]')
+        elif char == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                out.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[%s]' % body)
+                i = end + 1
+                continue
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return ''.join(out)
+
+
+class IgnoreRules:
+    """Правила .driveignore с семантикой .gitignore.
+
+    Поддерживаются комментарии (#), отрицание (!), шаблоны только
+    для папок (/ в конце), привязка к корню (/ в начале или середине),
+    *, ?, [...] и **. Побеждает последнее совпавшее правило.
+
+    Пути передаются в том же виде, что и в DriveTree (DnD/a/img),
+    а правила применяются к пути внутри корневой папки (a/img).
+
+    Аргументы:
+        lines: Строки файла с правилами.
+        root: Название корневой папки синхронизации.
+    """
+
+    __slots__ = ('root', 'rules')
+
+    def __init__(self, lines=(), root=''):
+        self.root = root
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # Шаблон со слэшем отсчитывается от корня, без слэша -
+            # совпадает с именем на любой глубине
+            prefix = '' if '/' in line else '(?:.*/)?'
+            regex = re.compile(prefix + _translate(line.lstrip('/')) + '$')
+            self.rules.append((regex, negate, dir_only))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @classmethod
+    def load(cls, full_path):
+        """Читает .driveignore из корня папки, если он там есть.
+
+        Аргументы:
+            full_path: Полный путь до папки синхронизации на пк.
+        """
+        full_path = full_path.rstrip(os.path.sep)
+        root = os.path.basename(full_path)
+        try:
+            with open(os.path.join(full_path, IGNORE_FILE),
+                      encoding='utf-8') as ignore_file:
+                return cls(ignore_file, root)
+        except FileNotFoundError:
+            return cls(root=root)
+
+    def _inner(self, path):
+        parts = path.split(os.path.sep)
+        if parts[0] == self.root:
+            parts = parts[1:]
+        return '/'.join(parts)
+
+    def _match(self, inner, is_dir):
+        for regex, negate, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(inner):
+                return not negate
+        return False
+
+    def match(self, path, is_dir=False):
+        """Проверяет, игнорируется ли объект.
+
+        Родительские папки не проверяются: игнорируемые папки
+        отсекаются при обходе дерева еще до того, как в них зайти.
+
+        Аргументы:
+            path: Относительный путь вида DnD/a/img.
+            is_dir: Папка ли это.
+        """
+        if not self.rules:
+            return False
+        inner = self._inner(path)
+        return bool(inner) and self._match(inner, is_dir)
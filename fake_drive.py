@@ -0,0 +1,522 @@
+"""Локальная подделка Drive v3 для бенчмарков.
+
+FakeDriveHttp притворяется httplib2.Http: клиентская библиотека гугла
+(discovery, MediaFileUpload, batch, resumable) ходит в него как в
+настоящий сервер, а он обслуживает эндпоинты files/changes в памяти.
+"""
+
+import email.parser
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+import httplib2
+
+from drive_tree import FOLDER_MIME, GOOGLE_APPS_MIME
+
+_HOST = 'https://www.googleapis.com'
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+
+class _Query:
+    """Разбирает и проверяет q-выражения files().list."""
+
+    _TOKEN = re.compile(r"\s*(?:(\()|(\))|'((?:[^'\\]|\\.)*)'|"
+                        r"(!=|=|<=|>=|<|>)|([A-Za-z_][\w.]*))")
+
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            match = self._TOKEN.match(text, pos)
+            if not match or match.end() == pos:
+                raise ValueError('bad query: %r' % text)
+            lpar, rpar, string, op, word = match.groups()
+            if lpar:
+                self.tokens.append(('(', None))
+            elif rpar:
+                self.tokens.append((')', None))
+            elif string is not None:
+                self.tokens.append(('str', re.sub(r'\\(.)', r'\1', string)))
+            elif op:
+                self.tokens.append(('op', op))
+            else:
+                self.tokens.append(('word', word))
+            pos = match.end()
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+        self.pos = 0
+        self.tree = self._or() if self.tokens else ('true',)
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ('word', 'or'):
+            self._next()
+            node = ('or', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._atom()
+        while self._peek() == ('word', 'and'):
+            self._next()
+            node = ('and', node, self._atom())
+        return node
+
+    def _atom(self):
+        kind, value = self._next()
+        if kind == '(':
+            node = self._or()
+            self._next()
+            return node
+        if kind == 'word' and value == 'not':
+            return ('not', self._atom())
+        if kind == 'str':
+            # 'X' in parents
+            self._next()
+            _, field = self._next()
+            return ('in', value, field)
+        field = value
+        _, op = self._next()
+        kind, value = self._next()
+        if kind == 'word':
+            value = {'true': True, 'false': False}.get(value.lower(), value)
+        return ('cmp', field, op, value)
+
+    def match(self, item, node=None):
+        node = node or self.tree
+        kind = node[0]
+        if kind == 'true':
+            return True
+        if kind == 'or':
+            return self.match(item, node[1]) or self.match(item, node[2])
+        if kind == 'and':
+            return self.match(item, node[1]) and self.match(item, node[2])
+        if kind == 'not':
+            return not self.match(item, node[1])
+        if kind == 'in':
+            return node[1] in item.get(node[2], [])
+        _, field, op, value = node
+        actual = item.get(field, False if field == 'trashed' else None)
+        if op == '=':
+            return actual == value
+        if op == '!=':
+            return actual != value
+        if op == '<':
+            return actual < value
+        if op == '>':
+            return actual > value
+        if op == '<=':
+            return actual <= value
+        return actual >= value
+
+
+class FakeDriveHttp:
+    """httplib2-совместимый сервер Drive v3 в памяти.
+
+    Аргументы:
+        latency: Искусственная задержка на каждый HTTP запрос, в секундах.
+        fail: Функция (method, path) -> статус или None, чтобы имитировать
+        ошибки 403/429/5xx.
+    """
+
+    def __init__(self, latency=0.0, fail=None):
+        self.latency = latency
+        self.fail = fail
+        self.files = {}
+        self.contents = {}
+        self.changes = []
+        self.sessions = {}
+        self.calls = {}
+        self.http_requests = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.files['root'] = {'id': 'root', 'name': 'My Drive',
+                              'mimeType': FOLDER_MIME, 'parents': [],
+                              'trashed': False,
+                              'modifiedTime': _now(), 'version': '1'}
+
+    def _new_id(self):
+        return 'f%06d' % next(self._ids)
+
+    def _record_change(self, file_id, removed=False):
+        self.changes.append({'fileId': file_id, 'removed': removed})
+
+    def add_file(self, name, parent='root', content=b'', mime_type=None,
+                 modified_time=None):
+        """Кладет файл (или папку, если content is None) прямо в хранилище."""
+        with self.lock:
+            file_id = self._new_id()
+            meta = {'id': file_id, 'name': name, 'parents': [parent],
+                    'trashed': False,
+                    'modifiedTime': modified_time or _now(), 'version': '1'}
+            if content is None:
+                meta['mimeType'] = mime_type or FOLDER_MIME
+            else:
+                meta['mimeType'] = mime_type or 'application/octet-stream'
+                self._set_content(meta, content)
+            self.files[file_id] = meta
+            self._record_change(file_id)
+            return file_id
+
+    def update_file(self, file_id, content):
+        """Меняет содержимое файла, как будто его отредактировали на диске."""
+        with self.lock:
+            meta = self.files[file_id]
+            self._set_content(meta, content)
+            self._touch(meta)
+
+    def _set_content(self, meta, content):
+        self.contents[meta['id']] = content
+        if meta['mimeType'].startswith(GOOGLE_APPS_MIME):
+            meta.pop('md5Checksum', None)
+            meta.pop('size', None)
+        else:
+            meta['md5Checksum'] = hashlib.md5(content).hexdigest()
+            meta['size'] = str(len(content))
+        meta['headRevisionId'] = 'r%s' % next(self._ids)
+
+    def _touch(self, meta, modified_time=None):
+        meta['modifiedTime'] = modified_time or _now()
+        meta['version'] = str(int(meta.get('version', '0')) + 1)
+        self._record_change(meta['id'])
+
+    def path_of(self, file_id):
+        """Возвращает путь файла вида 'DnD/a/b.txt'."""
+        parts = []
+        while file_id in self.files and file_id != 'root':
+            meta = self.files[file_id]
+            parts.append(meta['name'])
+            file_id = (meta.get('parents') or ['root'])[0]
+        return '/'.join(reversed(parts))
+
+    def find(self, path):
+        """Возвращает метаданные по пути вида 'DnD/a/b.txt' или None."""
+        for meta in self.files.values():
+            if not meta.get('trashed') and self.path_of(meta['id']) == path:
+                return meta
+        return None
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=5, connection_type=None):
+        """То же, что httplib2.Http.request, но без сети."""
+        if self.latency:
+            time.sleep(self.latency)
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        if hasattr(body, 'read'):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self.lock:
+            self.http_requests += 1
+            self.bytes_up += len(body or b'')
+        status, resp_headers, content = self._dispatch(uri, method, body or b'',
+                                                       headers)
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode('utf-8')
+            resp_headers.setdefault('content-type', 'application/json')
+        with self.lock:
+            self.bytes_down += len(content)
+        resp_headers['status'] = str(status)
+        response = httplib2.Response(resp_headers)
+        response.status = status
+        response.reason = 'OK' if status < 300 else 'Error'
+        return response, content
+
+    def _count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _error(self, status, reason, message=''):
+        return status, {}, {'error': {'code': status, 'message': message or reason,
+                                      'errors': [{'reason': reason,
+                                                  'message': message or reason}]}}
+
+    def _dispatch(self, uri, method, body, headers):
+        parsed = urllib.parse.urlsplit(uri)
+        path = parsed.path
+        params = {k: v[-1] for k, v in
+                  urllib.parse.parse_qs(parsed.query, keep_blank_values=True).items()}
+        if path.startswith('/batch/'):
+            self._count('batch')
+            return self._batch(body, headers)
+        if self.fail:
+            status = self.fail(method, path)
+            if status:
+                self._count('error')
+                reason = {403: 'userRateLimitExceeded',
+                          429: 'rateLimitExceeded'}.get(status, 'backendError')
+                return self._error(status, reason)
+        if path.startswith('/resumable/'):
+            return self._resumable_put(path, body, headers)
+        upload = path.startswith('/upload/')
+        if upload:
+            path = path[len('/upload'):]
+        match = re.match(r'^/drive/v3/(files|changes|about)'
+                         r'(?:/([^/]+))?(?:/([^/]+))?$', path)
+        if not match:
+            return self._error(404, 'notFound', path)
+        collection, file_id, action = match.groups()
+        if collection == 'about':
+            self._count('about.get')
+            return 200, {}, {'user': {'displayName': 'Fake'},
+                             'storageQuota': {'limit': '0', 'usage': '0'}}
+        if collection == 'changes':
+            if file_id == 'startPageToken':
+                self._count('changes.getStartPageToken')
+                return 200, {}, {'startPageToken': str(len(self.changes))}
+            self._count('changes.list')
+            return self._changes_list(params)
+        if file_id is None:
+            if method == 'GET':
+                self._count('files.list')
+                return self._list(params)
+            self._count('files.create')
+            return self._create(params, body, headers, upload)
+        file_id = urllib.parse.unquote(file_id)
+        if file_id not in self.files:
+            return self._error(404, 'notFound', 'File not found: %s' % file_id)
+        if action == 'copy':
+            self._count('files.copy')
+            return self._copy(file_id, body)
+        if action == 'export':
+            self._count('files.export')
+            # Как и настоящий диск, экспорт отдается целиком без Range
+            return self._media(file_id, {})
+        if method == 'GET':
+            if params.get('alt') == 'media':
+                self._count('files.get_media')
+                return self._media(file_id, headers)
+            self._count('files.get')
+            return 200, {}, dict(self.files[file_id])
+        if method == 'DELETE':
+            self._count('files.delete')
+            return self._delete(file_id)
+        self._count('files.update')
+        return self._update(file_id, params, body, headers, upload)
+
+    def _list(self, params):
+        query = _Query(params.get('q', ''))
+        page_size = min(int(params.get('pageSize', 100)), 1000)
+        offset = int(params.get('pageToken') or 0)
+        with self.lock:
+            items = [dict(m) for m in self.files.values()
+                     if m['id'] != 'root' and query.match(m)]
+        page = items[offset:offset + page_size]
+        result = {'files': page}
+        if offset + page_size < len(items):
+            result['nextPageToken'] = str(offset + page_size)
+        return 200, {}, result
+
+    def _changes_list(self, params):
+        token = int(params.get('pageToken', 0))
+        if token > len(self.changes):
+            return self._error(400, 'invalid', 'Invalid page token')
+        page_size = int(params.get('pageSize', 100))
+        window = self.changes[token:token + page_size]
+        changes = []
+        for change in window:
+            meta = self.files.get(change['fileId'])
+            item = {'fileId': change['fileId'],
+                    'removed': change['removed'] or meta is None}
+            if meta is not None:
+                item['file'] = dict(meta)
+            changes.append(item)
+        result = {'changes': changes}
+        if token + page_size < len(self.changes):
+            result['nextPageToken'] = str(token + page_size)
+        else:
+            result['newStartPageToken'] = str(len(self.changes))
+        return 200, {}, result
+
+    def _split_upload(self, body, headers, upload, params):
+        """Достает метаданные и содержимое из тела запроса."""
+        if not upload:
+            return json.loads(body or b'{}'), None
+        kind = params.get('uploadType', 'media')
+        if kind == 'multipart':
+            raw = (b'content-type: ' + headers['content-type'].encode() +
+                   b'\r\n\r\n' + body)
+            message = email.parser.BytesParser().parsebytes(raw)
+            parts = message.get_payload()
+            meta = json.loads(parts[0].get_payload(decode=True) or b'{}')
+            return meta, parts[1].get_payload(decode=True)
+        if kind == 'resumable':
+            return json.loads(body or b'{}'), None
+        return {}, body
+
+    def _create(self, params, body, headers, upload):
+        meta_in, content = self._split_upload(body, headers, upload, params)
+        with self.lock:
+            file_id = self._new_id()
+            meta = {'id': file_id, 'name': meta_in.get('name', 'Untitled'),
+                    'parents': [p for p in meta_in.get('parents', ['root']) if p]
+                    or ['root'],
+                    'mimeType': meta_in.get('mimeType',
+                                            headers.get('x-upload-content-type',
+                                                        'application/octet-stream')),
+                    'trashed': False,
+                    'modifiedTime': meta_in.get('modifiedTime') or _now(),
+                    'version': '1'}
+            if params.get('uploadType') == 'resumable':
+                return self._start_session(meta, headers, create=True)
+            if meta['mimeType'] != FOLDER_MIME:
+                self._set_content(meta, content or b'')
+            self.files[file_id] = meta
+            self._record_change(file_id)
+            return 200, {}, dict(meta)
+
+    def _update(self, file_id, params, body, headers, upload):
+        meta_in, content = self._split_upload(body, headers, upload, params)
+        with self.lock:
+            meta = self.files[file_id]
+            if params.get('uploadType') == 'resumable':
+                return self._start_session(dict(meta, **meta_in), headers,
+                                           create=False)
+            for key in ('name', 'mimeType', 'trashed'):
+                if key in meta_in:
+                    meta[key] = meta_in[key]
+            parents = list(meta.get('parents', []))
+            for parent in filter(None, params.get('removeParents', '').split(',')):
+                if parent in parents:
+                    parents.remove(parent)
+            for parent in filter(None, params.get('addParents', '').split(',')):
+                parents.append(parent)
+            meta['parents'] = parents
+            if content is not None:
+                self._set_content(meta, content)
+            self._touch(meta, meta_in.get('modifiedTime'))
+            return 200, {}, dict(meta)
+
+    def _start_session(self, meta, headers, create):
+        session = 'sess%d' % next(self._ids)
+        self.sessions[session] = {'meta': meta, 'data': b'', 'create': create}
+        self._count('upload.session')
+        return 200, {'location': _HOST + '/resumable/' + session}, b''
+
+    def _resumable_put(self, path, body, headers):
+        self._count('upload.chunk')
+        session = self.sessions.get(path.rsplit('/', 1)[-1])
+        if session is None:
+            return self._error(404, 'notFound', 'Upload session expired')
+        content_range = headers.get('content-range', '')
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+        status_match = re.match(r'bytes \*/(\d+|\*)', content_range)
+        with self.lock:
+            if match:
+                start = int(match.group(1))
+                if start != len(session['data']):
+                    session['data'] = session['data'][:start]
+                session['data'] += body
+                total = match.group(3)
+            elif status_match:
+                total = status_match.group(1)
+            else:
+                session['data'] = body
+                total = str(len(body))
+            received = len(session['data'])
+            if total != '*' and received >= int(total):
+                meta = session['meta']
+                if session['create']:
+                    meta.setdefault('parents', ['root'])
+                    self.files[meta['id']] = meta
+                    self._set_content(meta, session['data'])
+                    self._record_change(meta['id'])
+                else:
+                    stored = self.files[meta['id']]
+                    self._set_content(stored, session['data'])
+                    self._touch(stored, meta.get('modifiedTime'))
+                    meta = stored
+                del self.sessions[path.rsplit('/', 1)[-1]]
+                return 200, {}, dict(meta)
+            range_header = {'range': 'bytes=0-%d' % (received - 1)} if received else {}
+            return 308, range_header, b''
+
+    def _media(self, file_id, headers):
+        content = self.contents.get(file_id, b'')
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(content) - 1
+            end = min(end, len(content) - 1)
+            if start >= len(content) and content:
+                return 416, {}, b''
+            chunk = content[start:end + 1]
+            return 206, {'content-range': 'bytes %d-%d/%d' % (
+                start, start + len(chunk) - 1, len(content)),
+                'content-length': str(len(chunk))}, chunk
+        return 200, {'content-length': str(len(content))}, content
+
+    def _delete(self, file_id):
+        with self.lock:
+            stack = [file_id]
+            while stack:
+                current = stack.pop()
+                self.files.pop(current, None)
+                self.contents.pop(current, None)
+                self._record_change(current, removed=True)
+                stack.extend(m['id'] for m in list(self.files.values())
+                             if current in m.get('parents', []))
+        return 204, {}, b''
+
+    def _copy(self, file_id, body):
+        meta_in = json.loads(body or b'{}')
+        with self.lock:
+            source = self.files[file_id]
+            new_id = self._new_id()
+            meta = dict(source, id=new_id, version='1', modifiedTime=_now())
+            meta.update({k: v for k, v in meta_in.items()
+                         if k in ('name', 'parents', 'modifiedTime')})
+            self.files[new_id] = meta
+            self.contents[new_id] = self.contents.get(file_id, b'')
+            self._record_change(new_id)
+            return 200, {}, dict(meta)
+
+    def _batch(self, body, headers):
+        raw = (b'content-type: ' + headers['content-type'].encode() +
+               b'\r\n\r\n' + body)
+        message = email.parser.BytesParser().parsebytes(raw)
+        boundary = 'fakebatchboundary'
+        out = []
+        for part in message.get_payload():
+            payload = part.get_payload()
+            if isinstance(payload, list):
+                payload = payload[0].as_string()
+            request_line, rest = re.split(r'\r?\n', payload, 1)
+            method, target, _ = request_line.split(' ', 2)
+            head, sub_body = (re.split(r'\r?\n\r?\n', rest, 1) + [''])[:2]
+            sub_headers = {}
+            for line in head.splitlines():
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    sub_headers[key.strip().lower()] = value.strip()
+            status, resp_headers, content = self._dispatch(
+                _HOST + target, method, sub_body.encode('utf-8'), sub_headers)
+            if isinstance(content, (dict, list)):
+                content = json.dumps(content).encode('utf-8')
+            out.append('--%s\r\nContent-Type: application/http\r\n'
+                       'Content-ID: <response-%s>\r\n\r\n'
+                       'HTTP/1.1 %d OK\r\nContent-Type: application/json\r\n\r\n%s\r\n'
+                       % (boundary, part['Content-ID'].strip('<>'), status,
+                          content.decode('utf-8')))
+        out.append('--%s--' % boundary)
+        return 200, {'content-type': 'multipart/mixed; boundary=%s' % boundary}, \
+            ''.join(out).encode('utf-8')
+
@@ -0,0 +1,64 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+# Размер куска, которым читается файл
+CHUNK_SIZE = 1024 * 1024
+# Файлы больше этого размера читаются через mmap
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# hashlib отпускает GIL, поэтому потоков хватает
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def file_md5(file_dir, chunk_size=CHUNK_SIZE):
+    """Считает MD5 файла, не загружая его в память целиком.
+
+    Маленькие файлы читаются кусками по chunk_size,
+    большие отображаются в память через mmap.
+
+    Аргументы:
+        file_dir: Полный путь до файла.
+        chunk_size: Размер куска в байтах.
+
+    Возвращает:
+        MD5 в виде hex строки.
+    """
+    md5 = hashlib.md5()
+
+    with open(file_dir, 'rb') as file_read:
+        size = os.fstat(file_read.fileno()).st_size
+
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(file_read.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                for offset in range(0, size, chunk_size):
+                    md5.update(view[offset:offset + chunk_size])
+                view.release()
+        else:
+            for chunk in iter(lambda: file_read.read(chunk_size), b''):
+                md5.update(chunk)
+
+    METRICS.add_bytes('hashed', size)
+    return md5.hexdigest()
+
+
+def hash_files(file_dirs, workers=HASH_WORKERS):
+    """Считает MD5 сразу для нескольких файлов в пуле потоков.
+
+    Аргументы:
+        file_dirs: Список полных путей до файлов.
+        workers: Количество потоков.
+
+    Возвращает:
+        Словарь {путь до файла: MD5}.
+    """
+    file_dirs = list(file_dirs)
+    if len(file_dirs) <= 1:
+        return {file_dir: file_md5(file_dir) for file_dir in file_dirs}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(file_dirs, executor.map(file_md5, file_dirs)))
@@ -0,0 +1,56 @@
+import os
+
+from transfers import is_partial
+
+
+class LocalTree:
+    """Индекс папки на пк, собранный за один проход os.scandir.
+
+    Для каждой папки (относительный путь вида DnD/a/img, как в DriveTree)
+    хранит словарь {имя файла: os.stat_result}. Тип объекта берется
+    из DirEntry без лишних вызовов, а stat - один раз на файл.
+    Недокачанные .drivesync-part файлы в индекс не попадают, а папки
+    из .driveignore отсекаются еще до того, как в них зайти.
+
+    Аргументы:
+        full_path: Полный путь до папки синхронизации на пк.
+        ignore: IgnoreRules или None.
+    """
+
+    __slots__ = ('root', 'base_path', '_dirs')
+
+    def __init__(self, full_path, ignore=None):
+        full_path = full_path.rstrip(os.path.sep)
+        self.base_path = os.path.dirname(full_path)
+        self.root = os.path.basename(full_path)
+        self._dirs = {}
+
+        stack = [(self.root, full_path)]
+        while stack:
+            rel_dir, dir_path = stack.pop()
+            files = self._dirs[rel_dir] = {}
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    rel_path = os.path.join(rel_dir, entry.name)
+                    # По ссылкам на папки не ходим, чтобы не зациклиться
+                    if entry.is_dir(follow_symlinks=False):
+                        if not (ignore and ignore.match(rel_path, True)):
+                            stack.append((rel_path, entry.path))
+                    elif (entry.is_file() and not is_partial(entry.name)
+                          and not (ignore and ignore.match(rel_path))):
+                        files[entry.name] = entry.stat()
+
+    def __contains__(self, rel_dir):
+        return rel_dir in self._dirs
+
+    def folders(self):
+        """Возвращает относительные пути всех подпапок, кроме корневой."""
+        return [rel_dir for rel_dir in self._dirs if rel_dir != self.root]
+
+    def files(self, rel_dir):
+        """Возвращает словарь {имя файла: os.stat_result} папки."""
+        return self._dirs.get(rel_dir, {})
+
+    def full_path(self, rel_path):
+        """Переводит относительный путь в полный путь на пк."""
+        return os.path.join(self.base_path, rel_path)
@@ -0,0 +1,212 @@
+import contextlib
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+# Куда пишутся отчеты о последней синхронизации (рядом с sync_state.db)
+REPORT_JSON = 'sync_report.json'
+REPORT_PROM = 'sync_metrics.prom'
+
+# Границы корзин гистограммы задержек, в секундах
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+FILE_PATH = re.compile(r'/files/[^/]+$')
+
+
+def call_name(uri, method):
+    """Определяет метод апи гугл диска по URI и HTTP методу запроса.
+
+    Возвращает:
+        Строку вида files.list, files.get_media, batch и т.п.
+    """
+    parsed = urllib.parse.urlsplit(uri)
+    path, query = parsed.path, urllib.parse.parse_qs(parsed.query)
+    if 'upload_id' in query:
+        return 'upload.chunk'
+    if path.startswith('/batch'):
+        return 'batch'
+    if path.endswith('/changes/startPageToken'):
+        return 'changes.getStartPageToken'
+    if path.endswith('/changes'):
+        return 'changes.list'
+    if path.endswith('/export'):
+        return 'files.export'
+    if path.endswith('/copy'):
+        return 'files.copy'
+    if path.endswith('/files'):
+        return 'files.list' if method == 'GET' else 'files.create'
+    if FILE_PATH.search(path):
+        if method == 'GET':
+            return ('files.get_media' if query.get('alt') == ['media']
+                    else 'files.get')
+        return {'PATCH': 'files.update',
+                'DELETE': 'files.delete'}.get(method, 'files.' + method.lower())
+    return method + ' ' + path
+
+
+class Metrics:
+    """Счетчики одного запуска синхронизации.
+
+    Считает запросы к апи по методам, гистограммы их задержек,
+    повторы, переданные байты и время этапов (обход дерева,
+    хеширование, выгрузка, ...). Потокобезопасен.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Обнуляет все счетчики, не заменяя блокировку."""
+        with self.lock:
+            self.calls = {}
+            self.errors = {}
+            self.retries = {}
+            self.latency = {}
+            self.bytes = {}
+            self.phases = {}
+
+    def record_call(self, name, seconds, sent=0, received=0, status=200):
+        """Запоминает один HTTP запрос к апи."""
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if status >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            histogram = self.latency.setdefault(
+                name, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                       'sum': 0.0})
+            index = next((i for i, bound in enumerate(LATENCY_BUCKETS)
+                          if seconds <= bound), len(LATENCY_BUCKETS))
+            histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            self.bytes['sent'] = self.bytes.get('sent', 0) + sent
+            self.bytes['received'] = self.bytes.get('received', 0) + received
+
+    def record_retry(self, name):
+        with self.lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def add_bytes(self, kind, count):
+        """Добавляет байты, обработанные на пк (например, hashed)."""
+        with self.lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + count
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Засекает время этапа; повторные вызовы суммируются."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def report(self):
+        """Возвращает все счетчики в виде словаря для JSON."""
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'errors': dict(self.errors),
+                'retries': dict(self.retries),
+                'bytes': dict(self.bytes),
+                'phases': {name: round(seconds, 6)
+                           for name, seconds in self.phases.items()},
+                'latency': {
+                    name: {'buckets': dict(zip(
+                               [str(bound) for bound in LATENCY_BUCKETS]
+                               + ['+Inf'], histogram['buckets'])),
+                           'sum': round(histogram['sum'], 6),
+                           'count': self.calls[name]}
+                    for name, histogram in self.latency.items()},
+            }
+
+    def prometheus(self):
+        """Возвращает счетчики в текстовом формате Prometheus."""
+        report = self.report()
+        lines = []
+
+        def family(metric, kind, help_text):
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s %s' % (metric, kind))
+
+        family('drive_sync_api_calls_total', 'counter',
+               'Drive API requests by method.')
+        for name, count in sorted(report['calls'].items()):
+            lines.append('drive_sync_api_calls_total{method="%s"} %d'
+                         % (name, count))
+        family('drive_sync_api_errors_total', 'counter',
+               'Drive API responses with status >= 400.')
+        for name, count in sorted(report['errors'].items()):
+            lines.append('drive_sync_api_errors_total{method="%s"} %d'
+                         % (name, count))
+        family('drive_sync_api_retries_total', 'counter',
+               'Drive API requests retried after throttling or errors.')
+        for name, count in sorted(report['retries'].items()):
+            lines.append('drive_sync_api_retries_total{method="%s"} %d'
+                         % (name, count))
+
+        family('drive_sync_api_latency_seconds', 'histogram',
+               'Drive API request latency.')
+        for name, histogram in sorted(report['latency'].items()):
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('drive_sync_api_latency_seconds_bucket'
+                             '{method="%s",le="%s"} %d'
+                             % (name, bound, cumulative))
+            lines.append('drive_sync_api_latency_seconds_sum{method="%s"} %s'
+                         % (name, histogram['sum']))
+            lines.append('drive_sync_api_latency_seconds_count{method="%s"} %d'
+                         % (name, histogram['count']))
+
+        family('drive_sync_bytes_total', 'counter',
+               'Bytes sent to Drive, received from Drive and hashed locally.')
+        for kind, count in sorted(report['bytes'].items()):
+            lines.append('drive_sync_bytes_total{kind="%s"} %d'
+                         % (kind, count))
+        family('drive_sync_phase_seconds', 'gauge',
+               'Wall time spent in each sync phase.')
+        for name, seconds in sorted(report['phases'].items()):
+            lines.append('drive_sync_phase_seconds{phase="%s"} %s'
+                         % (name, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=REPORT_JSON, prom_path=REPORT_PROM,
+              profile=False):
+        """Пишет отчет в JSON и в формате Prometheus.
+
+        Аргументы:
+            json_path: Куда записать JSON отчет.
+            prom_path: Куда записать метрики для Prometheus
+            (например, для textfile collector у node_exporter).
+            profile: Вывести еще и время по этапам.
+        """
+        with open(json_path, 'w', encoding='utf-8') as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True)
+        with open(prom_path, 'w', encoding='utf-8') as prom_file:
+            prom_file.write(self.prometheus())
+        if profile:
+            self.print_phases()
+
+    def print_phases(self):
+        report = self.report()
+        total = report['phases'].get('total')
+        print('Этап          Время, с')
+        for name, seconds in sorted(report['phases'].items(),
+                                    key=lambda item: -item[1]):
+            share = ' (%d%%)' % (100 * seconds / total) if total else ''
+            print('%-13s %8.3f%s' % (name, seconds, share))
+        print('Запросов к апи: %d, повторов: %d, отправлено %d Б, '
+              'получено %d Б' % (sum(report['calls'].values()),
+                                 sum(report['retries'].values()),
+                                 report['bytes'].get('sent', 0),
+                                 report['bytes'].get('received', 0)))
+
+
+# Один набор счетчиков на процесс
+METRICS = Metrics()
@@ -0,0 +1,125 @@
+import argparse
+import functools
+import time
+
+from drive_api import build_service, get_credentials, iter_files, new_http
+from driveignore import IgnoreRules
+from drive_tree import FOLDER_MIME, DriveTree, get_tree
+from local_tree import LocalTree
+from metrics import METRICS
+from sync_engine import BOTH, build_plan, execute_plan
+from sync_state import SyncState
+from transfers import (UPLOAD_CHUNK_SIZE, UPLOAD_WORKERS, DownloadPool,
+                       UploadPool)
+
+# Полный путь до папки на пк и ее имя
+FULL_PATH = r'/Users/mafed/DnD'
+DIR_NAME = 'DnD'
+
+
+def find_root(service, create=True):
+    """Ищет папку синхронизации в корне гугл диска.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        create: Создать пустую папку, если ее нет.
+
+    Возвращает:
+        ID папки или None, если ее нет и create=False.
+    """
+    items = iter_files(
+        service,
+        "'root' in parents and trashed != True and "
+        "mimeType='application/vnd.google-apps.folder'")
+    folder_id = next((item['id'] for item in items
+                      if item['name'] == DIR_NAME), None)
+    if folder_id is None and create:
+        folder_id = service.files().create(
+            body={'name': DIR_NAME, 'parents': ['root'],
+                  'mimeType': FOLDER_MIME},
+            fields='id').execute()['id']
+    return folder_id
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Синхронизирует папку на пк и папку на гугл диске '
+                    'в обе стороны.')
+    parser.add_argument('--workers', type=int,
+                        default=UPLOAD_WORKERS,
+                        help='сколько файлов передавать одновременно')
+    parser.add_argument('--chunk-size', type=int,
+                        default=UPLOAD_CHUNK_SIZE // (1024 * 1024),
+                        help='размер куска при выгрузке и скачивании в МБ')
+    parser.add_argument('--profile', action='store_true',
+                        help='вывести время по этапам синхронизации')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='только показать, что будет сделано')
+    return parser.parse_args()
+
+
+def main(workers=UPLOAD_WORKERS, chunk_size=UPLOAD_CHUNK_SIZE,
+         profile=False, dry_run=False):
+    """Синхронизирует папку на пк и папку на гугл диске в обе стороны.
+
+    Новое и измененное с каждой стороны переносится на другую,
+    удаленное с одной стороны удаляется с другой. Что именно
+    поменялось, определяется по базе прошлой синхронизации.
+    Если файл поменяли с обеих сторон, остается более свежая версия.
+
+    Аргументы:
+        workers: Сколько файлов передавать одновременно.
+        chunk_size: Размер куска при выгрузке и скачивании в байтах.
+        profile: Вывести в конце время по этапам.
+        dry_run: Только напечатать план, ничего не меняя.
+    """
+    start = time.perf_counter()
+    credentials = get_credentials()
+    service = build_service(new_http(credentials))
+    http_factory = functools.partial(new_http, credentials)
+    state = SyncState()
+
+    if not dry_run:
+        # Курсор берем до обхода дерева, как в updateDrivetoPC
+        start_token = service.changes().getStartPageToken().execute()
+        start_token = start_token['startPageToken']
+
+    with METRICS.phase('list'):
+        folder_id = find_root(service, create=not dry_run)
+        ignore = IgnoreRules.load(FULL_PATH)
+        if folder_id is None:
+            tree = DriveTree(DIR_NAME, None)
+        else:
+            tree = get_tree(DIR_NAME, folder_id, service, ignore)
+
+    with METRICS.phase('scan'):
+        local = LocalTree(FULL_PATH, ignore)
+
+    with METRICS.phase('plan'):
+        plan = build_plan(local, tree, state, BOTH)
+    if dry_run:
+        print(plan.report())
+        state.close()
+        return
+
+    with UploadPool(service, http_factory, workers, state,
+                    chunk_size) as upload_pool, \
+            DownloadPool(http_factory, workers, chunk_size) as download_pool:
+        failed = execute_plan(plan, service, state, tree, local.base_path,
+                              upload_pool=upload_pool,
+                              download_pool=download_pool)
+
+    state.set_meta('root_id', folder_id)
+    # Как в updateDrivetoPC: с ошибками курсор остается старым
+    if not failed:
+        state.set_meta('start_page_token', start_token)
+    state.close()
+
+    METRICS.add_phase('total', time.perf_counter() - start)
+    METRICS.write(profile=profile)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(workers=args.workers, chunk_size=args.chunk_size * 1024 * 1024,
+         profile=args.profile, dry_run=args.dry_run)
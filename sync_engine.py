@@ -0,0 +1,888 @@
+import mimetypes
+import os
+import shutil
+
+from drive_api import MTIME_TOLERANCE, execute_batch, parse_time
+from drive_tree import (GOOGLE_MIME_TYPES, create_folders, is_native,
+                        local_name)
+from hashing import hash_files
+from metrics import METRICS
+from sync_state import SyncState
+from transfers import (content_index, download_file_from_gdrive, find_copies,
+                       upload_files)
+
+# Направления синхронизации
+PUSH = 'push'  # диск становится копией папки на пк
+PULL = 'pull'  # папка на пк становится копией диска
+BOTH = 'both'  # изменения с каждой стороны переносятся на другую
+
+# Действия плана
+MKDIR_REMOTE = 'mkdir_remote'
+MKDIR_LOCAL = 'mkdir_local'
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DELETE_REMOTE = 'delete_remote'
+DELETE_LOCAL = 'delete_local'
+# Перенос или переименование вместо удаления и повторной передачи
+MOVE_REMOTE = 'move_remote'
+MOVE_LOCAL = 'move_local'
+# Копия файла, который уже есть на диске, вместо выгрузки
+COPY_REMOTE = 'copy_remote'
+# Содержимое уже совпадает, нужно только записать его в базу состояния
+REMEMBER = 'remember'
+# Объекта нет ни на пк, ни на диске, нужно только забыть его
+FORGET = 'forget'
+
+ACTION_LABELS = {
+    MKDIR_REMOTE: 'создать на диске',
+    MKDIR_LOCAL: 'создать на пк',
+    UPLOAD: 'выгрузить',
+    DOWNLOAD: 'скачать',
+    DELETE_REMOTE: 'удалить с диска',
+    DELETE_LOCAL: 'удалить с пк',
+    MOVE_REMOTE: 'перенести на диске',
+    MOVE_LOCAL: 'перенести на пк',
+    COPY_REMOTE: 'скопировать на диске',
+}
+
+# Поля, которые нужны после переноса файла на диске
+MOVE_FIELDS = 'id, name, parents, md5Checksum, modifiedTime, version'
+
+
+def format_size(size):
+    """Переводит размер в байтах в строку вида 1.5 МБ."""
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            break
+        size /= 1024
+    return ('%d %s' if unit == 'Б' else '%.1f %s') % (size, unit)
+
+
+def _depth(path):
+    return path.count(os.path.sep)
+
+
+class Operation:
+    """Одно действие плана синхронизации.
+
+    Аргументы:
+        action: Что сделать: UPLOAD, DOWNLOAD, DELETE_REMOTE и т.д.
+        path: Относительный путь вида DnD/a/x.txt.
+        size: Сколько байт передать (для удалений - сколько удалится).
+        local_stat: os.stat_result файла на пк или None.
+        drive_file: Словарь с информацией о файле на диске или None.
+        folder: Папка ли это.
+        md5: MD5 файла на пк, если его уже посчитали.
+        conflict: Файл поменяли и на пк, и на диске.
+        source: Откуда переносится или копируется объект
+        (для MOVE_REMOTE, MOVE_LOCAL и COPY_REMOTE).
+    """
+
+    __slots__ = ('action', 'path', 'size', 'local_stat', 'drive_file',
+                 'folder', 'md5', 'conflict', 'source')
+
+    def __init__(self, action, path, size=0, local_stat=None,
+                 drive_file=None, folder=False, md5=None, conflict=False,
+                 source=None):
+        self.action = action
+        self.path = path
+        self.size = size
+        self.local_stat = local_stat
+        self.drive_file = drive_file
+        self.folder = folder
+        self.md5 = md5
+        self.conflict = conflict
+        self.source = source
+
+    def __repr__(self):
+        return 'Operation(%r, %r, size=%d)' % (self.action, self.path,
+                                               self.size)
+
+
+class Plan:
+    """План синхронизации: все действия, которые нужно сделать.
+
+    План только описывает изменения, поэтому его можно напечатать
+    (report) вместо того, чтобы выполнять (execute_plan).
+
+    Аргументы:
+        mode: Направление синхронизации (PUSH, PULL или BOTH).
+    """
+
+    __slots__ = ('mode', 'operations')
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.operations = []
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, action, path, **kwargs):
+        operation = Operation(action, path, **kwargs)
+        self.operations.append(operation)
+        return operation
+
+    def of(self, *actions):
+        """Возвращает операции с перечисленными действиями."""
+        return [operation for operation in self.operations
+                if operation.action in actions]
+
+    def total(self, *actions):
+        """Сколько байт придется передать или удалить."""
+        return sum(operation.size for operation in self.of(*actions))
+
+    def report(self):
+        """Возвращает план в виде текста для --dry-run."""
+        lines = []
+        for operation in sorted(self, key=lambda operation: operation.path):
+            if operation.action not in ACTION_LABELS:
+                continue
+            label = ACTION_LABELS[operation.action]
+            if operation.conflict:
+                label += ' (конфликт)'
+            path = operation.path + (os.path.sep if operation.folder else '')
+            if operation.source is not None:
+                path = '%s%s -> %s' % (
+                    operation.source,
+                    os.path.sep if operation.folder else '', path)
+            size = format_size(operation.size) if operation.size else ''
+            lines.append('%-28s %10s  %s' % (label, size, path))
+        if not lines:
+            return 'Изменений нет'
+
+        lines.append('')
+        lines.append('Выгрузить: %d (%s), скачать: %d (%s), '
+                     'удалить на диске: %d, удалить на пк: %d, '
+                     'перенести: %d, скопировать на диске: %d' % (
+                         len(self.of(UPLOAD)), format_size(self.total(UPLOAD)),
+                         len(self.of(DOWNLOAD)),
+                         format_size(self.total(DOWNLOAD)),
+                         len(self.of(DELETE_REMOTE)),
+                         len(self.of(DELETE_LOCAL)),
+                         len(self.of(MOVE_REMOTE, MOVE_LOCAL)),
+                         len(self.of(COPY_REMOTE))))
+        return '\n'.join(lines)
+
+
+def _plan_file(plan, mode, path, local_stat, drive_file, known, md5):
+    """Решает, что делать с одним файлом.
+
+    Аргументы:
+        plan: Plan, куда добавить действие.
+        mode: Направление синхронизации.
+        path: Относительный путь до файла.
+        local_stat: os.stat_result файла на пк или None, если его нет.
+        drive_file: Файл на диске или None, если его нет.
+        known: Запись о файле с прошлой синхронизации или None.
+        md5: MD5 файла на пк или None, если сравнивать нечего.
+    """
+    if local_stat is None and drive_file is None:
+        plan.add(FORGET, path)
+        return
+
+    if drive_file is None:
+        # В режиме BOTH файл, который не меняли на пк, удалили на диске
+        if mode == PULL or (mode == BOTH and
+                            SyncState.stat_matches(known, local_stat)):
+            plan.add(DELETE_LOCAL, path, size=local_stat.st_size,
+                     local_stat=local_stat)
+        else:
+            plan.add(UPLOAD, path, size=local_stat.st_size,
+                     local_stat=local_stat)
+        return
+
+    drive_size = int(drive_file.get('size', 0))
+    if local_stat is None:
+        if mode == PUSH or (mode == BOTH and known is not None and
+                            not SyncState.drive_changed(known, drive_file)):
+            plan.add(DELETE_REMOTE, path, size=drive_size,
+                     drive_file=drive_file)
+        else:
+            plan.add(DOWNLOAD, path, size=drive_size, drive_file=drive_file)
+        return
+
+    # С прошлой синхронизации файл не менялся ни на пк, ни на диске
+    if (SyncState.stat_matches(known, local_stat)
+            and not SyncState.drive_changed(known, drive_file)):
+        return
+
+    # Оба времени в UTC, небольшое расхождение не считается изменением
+    drive_time = parse_time(drive_file['modifiedTime'])
+    newer = local_stat.st_mtime > drive_time + MTIME_TOLERANCE
+    older = local_stat.st_mtime < drive_time - MTIME_TOLERANCE
+
+    if is_native(drive_file):
+        # У гугл дока нет md5Checksum, поэтому сравниваем с базой,
+        # а если в базе его нет - время изменения
+        if known is not None and known['drive_id'] == drive_file['id']:
+            local_changed = not SyncState.stat_matches(known, local_stat)
+            remote_changed = SyncState.drive_changed(known, drive_file)
+        else:
+            local_changed, remote_changed = newer, older
+        same = False
+    else:
+        # Если содержимое совпало, передавать нечего, даже когда время
+        # изменения разное: хватит запомнить файл в базе
+        same = md5 is not None and md5 == drive_file.get('md5Checksum')
+        if mode == PUSH:
+            local_changed, remote_changed = not same, False
+        elif mode == PULL:
+            local_changed, remote_changed = False, not same
+        elif same:
+            local_changed = remote_changed = False
+        else:
+            local_changed = not SyncState.stat_matches(known, local_stat)
+            remote_changed = SyncState.drive_changed(known, drive_file)
+
+    if mode == PUSH:
+        remote_changed = False
+    elif mode == PULL:
+        local_changed = False
+
+    upload = dict(local_stat=local_stat, drive_file=drive_file)
+    if local_changed and remote_changed:
+        # Поменяли с обеих сторон: побеждает более свежая версия
+        if local_stat.st_mtime >= drive_time:
+            plan.add(UPLOAD, path, size=local_stat.st_size, conflict=True,
+                     **upload)
+        else:
+            plan.add(DOWNLOAD, path, size=drive_size, conflict=True,
+                     **upload)
+    elif local_changed:
+        plan.add(UPLOAD, path, size=local_stat.st_size, **upload)
+    elif remote_changed:
+        plan.add(DOWNLOAD, path, size=drive_size, **upload)
+    elif same:
+        plan.add(REMEMBER, path, md5=md5, **upload)
+
+
+def _mark(folders, path):
+    """Добавляет папку и всех ее родителей в множество."""
+    while path and path not in folders:
+        folders.add(path)
+        path = os.path.dirname(path)
+
+
+def _top_ancestor(path, folders):
+    """Самая верхняя из папок folders, в которой лежит path, или None."""
+    found = None
+    path = os.path.dirname(path)
+    while path:
+        if path in folders:
+            found = path
+        path = os.path.dirname(path)
+    return found
+
+
+def _pair(moves, dropped, action, source, target, md5):
+    """Заменяет удаление source и передачу target одним переносом."""
+    dropped.add(source)
+    dropped.add(target)
+    remote = action == MOVE_REMOTE
+    moves.append(Operation(
+        action, target.path, size=target.size, md5=md5, source=source.path,
+        local_stat=target.local_stat if remote else source.local_stat,
+        drive_file=source.drive_file if remote else target.drive_file))
+
+
+def _match_moves(plan, mode, local, known_files):
+    """Находит файлы, которые переименовали или перенесли.
+
+    Файл, пропавший в одном месте и появившийся в другом, не нужно
+    удалять и передавать заново: на диске его переносит files().update,
+    а на пк - os.rename. Пара ищется сначала по inode (перенос на пк)
+    или по ID (перенос на диске) из базы, а потом по размеру и MD5.
+
+    Аргументы:
+        plan: Plan, в котором пары заменяются на MOVE_REMOTE и MOVE_LOCAL.
+        mode: Направление синхронизации.
+        local: LocalTree папки на пк.
+        known_files: Записи о файлах с прошлой синхронизации.
+    """
+    moves, dropped, by_content = [], set(), {}
+
+    # Перенесли на пк - переносим на диске
+    if mode != PULL:
+        by_inode = {}
+        for source in plan.of(DELETE_REMOTE):
+            known = known_files.get(source.path)
+            if (known is not None and known['drive_id'] == source.drive_file['id']
+                    and not SyncState.drive_changed(known, source.drive_file)):
+                by_inode[known['inode']] = (source, known)
+            md5 = source.drive_file.get('md5Checksum')
+            if md5 is not None:
+                by_content.setdefault((source.size, md5), []).append(source)
+
+        targets = []
+        for target in plan.of(UPLOAD):
+            if target.drive_file is not None:
+                continue
+            source, known = by_inode.pop(target.local_stat.st_ino,
+                                         (None, None))
+            if SyncState.stat_matches(known, target.local_stat):
+                key = (source.size, source.drive_file.get('md5Checksum'))
+                if key in by_content:
+                    by_content[key].remove(source)
+                _pair(moves, dropped, MOVE_REMOTE, source, target,
+                      known['md5'])
+            else:
+                targets.append(target)
+
+        sizes = {size for size, md5 in by_content if by_content[size, md5]}
+        targets = [target for target in targets
+                   if target.local_stat.st_size in sizes]
+        with METRICS.phase('hash'):
+            digests = hash_files([local.full_path(target.path)
+                                  for target in targets])
+        for target in targets:
+            md5 = digests[local.full_path(target.path)]
+            sources = by_content.get((target.local_stat.st_size, md5))
+            if sources:
+                _pair(moves, dropped, MOVE_REMOTE, sources.pop(), target, md5)
+
+    # Перенесли на диске - переносим на пк
+    if mode != PUSH:
+        by_id, by_content = {}, {}
+        for target in plan.of(DOWNLOAD):
+            md5 = target.drive_file.get('md5Checksum')
+            if target.local_stat is None and md5 is not None:
+                by_id[target.drive_file['id']] = target
+                by_content.setdefault((target.size, md5), []).append(target)
+
+        sources = []
+        for source in plan.of(DELETE_LOCAL):
+            known = known_files.get(source.path)
+            target = None
+            if known is not None:
+                target = by_id.pop(known['drive_id'], None)
+            if (target is not None
+                    and SyncState.stat_matches(known, source.local_stat)
+                    and known['drive_md5'] == target.drive_file['md5Checksum']):
+                by_content[target.size, known['drive_md5']].remove(target)
+                _pair(moves, dropped, MOVE_LOCAL, source, target, known['md5'])
+            else:
+                sources.append((source, known))
+
+        sizes = {size for size, md5 in by_content if by_content[size, md5]}
+        sources = [(source, known) for source, known in sources
+                   if source.local_stat.st_size in sizes]
+        to_hash = [local.full_path(source.path) for source, known in sources
+                   if not SyncState.stat_matches(known, source.local_stat)]
+        with METRICS.phase('hash'):
+            digests = hash_files(to_hash)
+        for source, known in sources:
+            if SyncState.stat_matches(known, source.local_stat):
+                md5 = known['md5']
+            else:
+                md5 = digests[local.full_path(source.path)]
+            targets = by_content.get((source.local_stat.st_size, md5))
+            if targets:
+                _pair(moves, dropped, MOVE_LOCAL, source, targets.pop(), md5)
+
+    plan.operations = [operation for operation in plan
+                       if operation not in dropped] + moves
+
+
+def _match_copies(plan, local, remote_files):
+    """Новые файлы, содержимое которых уже есть на диске или среди
+    других новых файлов, не выгружаются, а копируются на диске.
+
+    Аргументы:
+        plan: Plan, в котором такие UPLOAD становятся COPY_REMOTE.
+        local: LocalTree папки на пк.
+        remote_files: Файлы на диске {относительный путь: файл}.
+    """
+    uploads = {operation.path: operation for operation in plan.of(UPLOAD)
+               if operation.drive_file is None}
+    paths = {item['id']: path for path, item in remote_files.items()}
+    with METRICS.phase('hash'):
+        copies = find_copies(
+            {path: (local.full_path(path), operation.local_stat)
+             for path, operation in uploads.items()},
+            content_index(remote_files.values()))
+
+    for path, (md5, source) in copies.items():
+        operation = uploads[path]
+        operation.action = COPY_REMOTE
+        operation.md5 = md5
+        if isinstance(source, dict):
+            # Копируем файл, который уже лежит на диске
+            operation.drive_file, operation.source = source, paths[source['id']]
+        else:
+            # Копируем другой новый файл, когда он выгрузится
+            operation.source = source
+
+
+def _fold_folder_moves(plan, move, mkdir, delete, files, folders):
+    """Если папку переименовали или перенесли целиком, переносит ее
+    одним запросом вместо переноса каждого файла.
+
+    Папка считается перенесенной, если каждый файл в ней перенесен
+    куда-то внутрь новой папки и для каждой ее подпапки в новой папке
+    создается такая же.
+
+    Аргументы:
+        plan: Plan после _match_moves и разбора папок.
+        move: MOVE_REMOTE или MOVE_LOCAL.
+        mkdir: Соответствующее создание папки (MKDIR_REMOTE или MKDIR_LOCAL).
+        delete: Соответствующее удаление (DELETE_REMOTE или DELETE_LOCAL).
+        files: Относительные пути файлов на той стороне, откуда переносят.
+        folders: Относительные пути папок на той же стороне.
+    """
+    moves = {operation.source: operation for operation in plan.of(move)}
+    created = {operation.path: operation for operation in plan.of(mkdir)}
+    removals = [operation for operation in plan.of(delete) if operation.folder]
+    folded, dropped = {}, set()
+
+    for removal in sorted(removals, key=lambda operation: _depth(operation.path)):
+        old = removal.path
+        if _top_ancestor(old, folded) is not None:
+            continue
+        prefix = old + os.path.sep
+        inner = [path for path in files if path.startswith(prefix)]
+        if not inner or any(path not in moves for path in inner):
+            continue
+
+        # Новое место папки видно по файлам, которые сохранили
+        # относительный путь; остальные переименуют уже после переноса
+        targets = set()
+        for path in inner:
+            suffix, target = path[len(old):], moves[path].path
+            if target.endswith(suffix):
+                targets.add(target[:-len(suffix)])
+        if len(targets) != 1:
+            continue
+        new = targets.pop()
+        if (new not in created or new in folded.values()
+                or any(not moves[path].path.startswith(new + os.path.sep)
+                       for path in inner)):
+            continue
+        subdirs = [new + folder[len(old):] for folder in folders
+                   if folder.startswith(prefix)]
+        if any(folder not in created for folder in subdirs):
+            continue
+
+        folded[old] = new
+        for path in inner:
+            if moves[path].path == new + path[len(old):]:
+                dropped.add(moves[path])
+            else:
+                moves[path].source = new + path[len(old):]
+        dropped.update(created[folder] for folder in subdirs + [new])
+        dropped.update(operation for operation in removals
+                       if operation.path == old
+                       or operation.path.startswith(prefix))
+        plan.add(move, new, folder=True, source=old,
+                 size=sum(moves[path].size for path in inner),
+                 drive_file=removal.drive_file or created[new].drive_file)
+
+    plan.operations = [operation for operation in plan
+                       if operation not in dropped]
+
+
+def build_plan(local, tree, state, mode=BOTH):
+    """Сравнивает папку на пк, папку на диске и базу прошлой синхронизации
+    и составляет план синхронизации за один проход.
+
+    База нужна, чтобы в режиме BOTH отличить удаление с одной стороны
+    от нового файла с другой: файл, который есть в базе и не менялся
+    на пк, но пропал с диска, удалили на диске, а не создали на пк.
+    Файлы и папки, которые пропали в одном месте и появились в другом,
+    переносятся, а не удаляются и передаются заново. Новые файлы,
+    такие же по содержимому, как уже лежащие на диске, копируются.
+
+    Аргументы:
+        local: LocalTree папки на пк.
+        tree: DriveTree папки на диске.
+        state: SyncState с прошлой синхронизацией.
+        mode: PUSH, PULL или BOTH.
+
+    Возвращает:
+        Plan.
+    """
+    known_files, known_folders = state.baseline()
+    local_files = {os.path.join(rel_dir, name): file_stat
+                   for rel_dir in [local.root] + local.folders()
+                   for name, file_stat in local.files(rel_dir).items()}
+    # Гугл доки на пк лежат с расширением, под ним их и сравниваем
+    remote_files = {os.path.join(rel_dir, local_name(item)): item
+                    for rel_dir in [tree.root.path] + tree.folders()
+                    for item in tree.files(rel_dir)}
+
+    # Хешируем разом все файлы, которые есть с обеих сторон,
+    # поменялись и совпадают по размеру
+    hashes, to_hash = {}, []
+    for path in local_files.keys() & remote_files.keys():
+        local_stat, drive_file = local_files[path], remote_files[path]
+        known = known_files.get(path)
+        if is_native(drive_file) or state.size_differs(local_stat, drive_file):
+            continue
+        md5 = state.cached_md5(known, local_stat)
+        if md5 is not None:
+            hashes[path] = md5
+        elif state.drive_changed(known, drive_file) or not \
+                state.stat_matches(known, local_stat):
+            to_hash.append(path)
+    with METRICS.phase('hash'):
+        digests = hash_files([local.full_path(path) for path in to_hash])
+    for path in to_hash:
+        hashes[path] = digests[local.full_path(path)]
+
+    plan = Plan(mode)
+    for path in sorted(local_files.keys() | remote_files.keys()
+                       | known_files.keys()):
+        _plan_file(plan, mode, path, local_files.get(path),
+                   remote_files.get(path), known_files.get(path),
+                   hashes.get(path))
+    _match_moves(plan, mode, local, known_files)
+    if mode != PULL:
+        _match_copies(plan, local, remote_files)
+
+    # Папки, которые есть только с одной стороны. Идем снизу вверх:
+    # папку нельзя удалять, если внутри осталось что-то нужное
+    needs_remote, needs_local = set(), set()
+    for operation in plan:
+        if operation.action in (UPLOAD, MOVE_REMOTE, COPY_REMOTE):
+            _mark(needs_remote, os.path.dirname(operation.path))
+        elif operation.action in (DOWNLOAD, MOVE_LOCAL):
+            _mark(needs_local, os.path.dirname(operation.path))
+
+    local_dirs, remote_dirs = set(local.folders()), set(tree.folders())
+    for folder in sorted(local_dirs ^ remote_dirs, key=_depth, reverse=True):
+        if folder in local_dirs:
+            if mode == PUSH or (mode == BOTH and (folder in needs_remote or
+                                                  folder not in known_folders)):
+                plan.add(MKDIR_REMOTE, folder, folder=True)
+                _mark(needs_remote, folder)
+            else:
+                plan.add(DELETE_LOCAL, folder, folder=True)
+        else:
+            if mode == PULL or (mode == BOTH and (folder in needs_local or
+                                                  folder not in known_folders)):
+                plan.add(MKDIR_LOCAL, folder, folder=True,
+                         drive_file=tree.node(folder).item)
+                _mark(needs_local, folder)
+            else:
+                plan.add(DELETE_REMOTE, folder, folder=True,
+                         drive_file=tree.node(folder).item)
+
+    if mode != PULL:
+        _fold_folder_moves(plan, MOVE_REMOTE, MKDIR_REMOTE, DELETE_REMOTE,
+                           remote_files, remote_dirs)
+    if mode != PUSH:
+        _fold_folder_moves(plan, MOVE_LOCAL, MKDIR_LOCAL, DELETE_LOCAL,
+                           local_files, local_dirs)
+
+    # Содержимое удаляемой папки удалится вместе с ней
+    deleted = {operation.path: operation for operation in plan
+               if operation.folder
+               and operation.action in (DELETE_LOCAL, DELETE_REMOTE)}
+    operations = []
+    for operation in plan:
+        top = _top_ancestor(operation.path, deleted)
+        if top is None:
+            operations.append(operation)
+        elif operation.action in (deleted[top].action, FORGET):
+            deleted[top].size += operation.size
+        else:
+            operations.append(operation)
+    plan.operations = operations
+    return plan
+
+
+def execute_plan(plan, service, state, tree, base_path, upload_pool=None,
+                 download_pool=None):
+    """Выполняет план синхронизации.
+
+    Сначала создаются папки, потом файлы передаются в пулах потоков,
+    потом удаляется лишнее. Все, что получилось, записывается в state.
+
+    Аргументы:
+        plan: Plan.
+        service: Инстанс апишки гугл диска.
+        state: SyncState.
+        tree: DriveTree, из которого план составлялся (в нем
+        обновляются новые и удаленные папки).
+        base_path: Полный путь до папки, в которой лежит
+        папка синхронизации на пк.
+        upload_pool: UploadPool, если в плане есть выгрузки.
+        download_pool: DownloadPool, если в плане есть скачивания.
+
+    Возвращает:
+        Список относительных путей, которые не удалось перенести,
+        передать или удалить (пустой, если все получилось).
+    """
+    failed = []
+    # Папки на диске создаются batch запросами, уровень за уровнем.
+    # Подпапки перенесенных папок создаются уже после переноса
+    with METRICS.phase('folders'):
+        moved = [operation for operation in plan.of(MOVE_REMOTE)
+                 if operation.folder]
+        targets = {operation.path for operation in moved}
+        created = [operation.path for operation in plan.of(MKDIR_REMOTE)]
+        create_folders(service, tree, [path for path in created
+                                       if _top_ancestor(path, targets) is None])
+        failed += move_remote(service, state, tree, moved)
+        create_folders(service, tree, [path for path in created
+                                       if _top_ancestor(path, targets)])
+
+        moved = [operation for operation in plan.of(MOVE_LOCAL)
+                 if operation.folder]
+        targets = {operation.path for operation in moved}
+        created = [operation.path for operation in plan.of(MKDIR_LOCAL)]
+        for path in created:
+            if _top_ancestor(path, targets) is None:
+                os.makedirs(os.path.join(base_path, path), exist_ok=True)
+        failed += move_local(state, base_path, moved)
+        for path in created:
+            if _top_ancestor(path, targets) is not None:
+                os.makedirs(os.path.join(base_path, path), exist_ok=True)
+
+    with METRICS.phase('move'):
+        failed += move_remote(service, state, tree, [
+            operation for operation in plan.of(MOVE_REMOTE)
+            if not operation.folder])
+        failed += move_local(state, base_path, [operation for operation in
+                                                plan.of(MOVE_LOCAL)
+                                                if not operation.folder])
+
+    downloads, renames = {}, []
+    for operation in plan.of(DOWNLOAD):
+        folder_dir = os.path.dirname(operation.path)
+        drive_file = operation.drive_file
+        downloads[drive_file['id']] = (folder_dir, drive_file)
+        download_pool.submit(drive_file['id'], download_file_from_gdrive,
+                             os.path.join(base_path, folder_dir), drive_file,
+                             service, renames)
+
+    # Новые файлы выгружаются или копируются на диске (upload_files),
+    # а измененные сразу встают в очередь пула
+    stats, uploads, copies = {}, {}, {}
+    for operation in plan.of(UPLOAD, COPY_REMOTE):
+        local_path = os.path.join(base_path, operation.path)
+        stats[operation.path] = operation.local_stat
+        drive_file = operation.drive_file
+        if operation.action == UPLOAD and drive_file is not None:
+            mimetype = drive_file['mimeType']
+            if mimetype in GOOGLE_MIME_TYPES:
+                # Гугл док приходит в формате майкрософта, и диск
+                # сам переведет его обратно
+                mimetype = GOOGLE_MIME_TYPES[mimetype][0]
+            upload_pool.submit(operation.path, local_path, None,
+                               file_id=drive_file['id'], mimetype=mimetype)
+            continue
+        uploads[operation.path] = (
+            local_path,
+            {'name': os.path.basename(operation.path),
+             'parents': [tree.id_of(os.path.dirname(operation.path))]},
+            mimetypes.guess_type(operation.path)[0])
+        if operation.action == COPY_REMOTE:
+            copies[operation.path] = (operation.md5,
+                                      drive_file or operation.source)
+
+    if stats:
+        with METRICS.phase('upload'):
+            results, errors = upload_files(service, upload_pool, uploads,
+                                           copies)
+        for rel_path, drive_file in results.items():
+            state.put(rel_path, stats[rel_path],
+                      drive_file.get('md5Checksum'), drive_file)
+        for rel_path, error in errors.items():
+            print(f"Не удалось выгрузить {rel_path}: {error}")
+            failed.append(rel_path)
+    if downloads:
+        with METRICS.phase('download'):
+            failed += finish_downloads(download_pool, downloads, state)
+
+    with METRICS.phase('delete'):
+        removals = {operation.path: operation
+                    for operation in plan.of(DELETE_REMOTE)}
+        results, errors = execute_batch(service, [
+            (rel_path, service.files().delete(
+                fileId=operation.drive_file['id']))
+            for rel_path, operation in removals.items()])
+        for rel_path, error in errors.items():
+            # Если файла на диске уже нет, то и удалять нечего
+            if error.resp.status == 404:
+                results[rel_path] = None
+            else:
+                print(f"Не удалось удалить {rel_path}: {error}")
+                failed.append(rel_path)
+        for rel_path in results:
+            state.forget(rel_path)
+            tree.remove(tree.path_of(removals[rel_path].drive_file['id']))
+
+        for operation in plan.of(DELETE_LOCAL):
+            remove_local(os.path.join(base_path, operation.path),
+                         operation.folder)
+            state.forget(operation.path)
+
+    for operation in plan.of(REMEMBER):
+        state.put(operation.path, operation.local_stat, operation.md5,
+                  operation.drive_file)
+    for operation in plan.of(FORGET):
+        state.forget(operation.path)
+
+    rename_files(service, renames, state)
+
+    for folder_dir in tree.folders() + [tree.root.path]:
+        state.put_folder(folder_dir, tree.id_of(folder_dir))
+    return failed
+
+
+def move_remote(service, state, tree, operations):
+    """Переносит и переименовывает файлы и папки на гугл диске.
+
+    Запросы идут batch запросами по уровням, чтобы папка, в которую
+    переносят, уже была на своем месте.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        state: SyncState.
+        tree: DriveTree, в котором объекты тоже переносятся.
+        operations: Операции MOVE_REMOTE.
+
+    Возвращает:
+        Список путей, которые перенести не удалось.
+    """
+    failed = []
+    levels = {}
+    for operation in operations:
+        levels.setdefault(_depth(operation.path), []).append(operation)
+
+    for depth in sorted(levels):
+        requests, moves = [], {}
+        for operation in levels[depth]:
+            file_id = operation.drive_file['id']
+            old_parent = tree.id_of(os.path.dirname(tree.path_of(file_id)))
+            new_parent = tree.id_of(os.path.dirname(operation.path))
+            body = {'name': os.path.basename(operation.path)}
+            if not operation.folder:
+                # Перенос не меняет содержимое, пусть не меняет и время
+                body['modifiedTime'] = operation.drive_file['modifiedTime']
+            parents = {}
+            if old_parent != new_parent:
+                parents = {'addParents': new_parent,
+                           'removeParents': old_parent}
+            moves[operation.path] = operation
+            requests.append((operation.path, service.files().update(
+                fileId=file_id, body=body, fields=MOVE_FIELDS, **parents)))
+
+        results, errors = execute_batch(service, requests)
+        for rel_path, response in results.items():
+            operation = moves[rel_path]
+            drive_file = dict(operation.drive_file, **response)
+            tree.move(tree.path_of(drive_file['id']), rel_path, drive_file)
+            if operation.folder:
+                state.move(operation.source, rel_path)
+            else:
+                state.forget(operation.source)
+                state.put(rel_path, operation.local_stat, operation.md5,
+                          drive_file)
+        for rel_path, error in errors.items():
+            print(f"Не удалось перенести {moves[rel_path].source}: {error}")
+            failed.append(moves[rel_path].source)
+    return failed
+
+
+def move_local(state, base_path, operations):
+    """Переносит и переименовывает файлы и папки на пк.
+
+    Аргументы:
+        state: SyncState.
+        base_path: Полный путь до папки, в которой лежит
+        папка синхронизации на пк.
+        operations: Операции MOVE_LOCAL.
+
+    Возвращает:
+        Список путей, которые перенести не удалось.
+    """
+    failed = []
+    for operation in sorted(operations, key=lambda operation:
+                            _depth(operation.path)):
+        new_path = os.path.join(base_path, operation.path)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.rename(os.path.join(base_path, operation.source), new_path)
+        except OSError as error:
+            print(f"Не удалось перенести {operation.source}: {error}")
+            failed.append(operation.source)
+            continue
+        if operation.folder:
+            state.move(operation.source, operation.path)
+        else:
+            state.forget(operation.source)
+            state.put(operation.path, os.stat(new_path), operation.md5,
+                      operation.drive_file)
+    return failed
+
+
+def rename_files(service, renames, state=None):
+    """Переименовывает файлы на гугл диске batch запросами.
+
+    Аргументы:
+        service: Инстанс API.
+        renames: Список пар (ID файла, новое имя).
+        state: SyncState, в котором обновить version переименованных файлов.
+    """
+    requests = [(file_id, service.files().update(
+                    fileId=file_id, body={'name': file_name},
+                    fields='id, modifiedTime, version'))
+                for file_id, file_name in renames]
+    results, errors = execute_batch(service, requests)
+    if state is not None:
+        for drive_file in results.values():
+            state.update_drive(drive_file)
+    for file_id, error in errors.items():
+        print(f"Не удалось переименовать {file_id}: {error}")
+
+
+def finish_downloads(pool, downloads, state):
+    """Дожидается скачиваний из пула и записывает их в базу состояния.
+
+    Аргументы:
+        pool: DownloadPool.
+        downloads: Словарь {ID файла: (относительный путь до папки,
+        словарь с информацией о файле)}.
+        state: SyncState.
+
+    Возвращает:
+        Список относительных путей файлов, которые скачать не удалось.
+    """
+    failed = []
+    results, errors = pool.wait()
+    for file_id, file_dir in results.items():
+        folder_dir, drive_file = downloads[file_id]
+        remember_download(state, folder_dir, file_dir, drive_file)
+    for file_id, error in errors.items():
+        folder_dir, drive_file = downloads[file_id]
+        rel_path = os.path.join(folder_dir, drive_file['name'])
+        print(f"Не удалось скачать {rel_path}: {error}")
+        failed.append(rel_path)
+    downloads.clear()
+    return failed
+
+
+def remember_download(state, folder_dir, file_dir, drive_file):
+    """Записывает в базу состояния только что скачанный файл.
+
+    Аргументы:
+        state: SyncState.
+        folder_dir: Относительный путь до папки.
+        file_dir: Полный путь до скачанного файла на пк.
+        drive_file: Словарь с информацией о файле на гугл диске.
+    """
+    state.put(os.path.join(folder_dir, os.path.basename(file_dir)),
+              os.stat(file_dir), drive_file.get('md5Checksum'), drive_file)
+
+
+def remove_local(file_path, is_folder):
+    """Удаляет файл или папку на пк, если они еще есть."""
+    if is_folder:
+        shutil.rmtree(file_path, ignore_errors=True)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
@@ -0,0 +1,284 @@
+import os
+import sqlite3
+import threading
+
+# База лежит рядом с token.json, а не в синхронизируемой папке
+STATE_DB = 'sync_state.db'
+
+# Как часто сбрасывать изменения на диск
+COMMIT_EVERY = 500
+
+
+class SyncState:
+    """Состояние файлов на момент последней успешной синхронизации.
+
+    Для каждого относительного пути хранит stat файла на пк, его MD5
+    и то, что было на гугл диске (ID, md5Checksum, modifiedTime).
+    Если stat не поменялся, файл можно не читать и не хешировать.
+
+    Аргументы:
+        db_path: Путь до файла базы SQLite.
+    """
+
+    def __init__(self, db_path=STATE_DB):
+        # Сессии выгрузки пишутся из потоков пула, поэтому соединение общее
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                                 path TEXT PRIMARY KEY,
+                                 size INTEGER,
+                                 mtime_ns INTEGER,
+                                 inode INTEGER,
+                                 md5 TEXT,
+                                 drive_id TEXT,
+                                 drive_md5 TEXT,
+                                 drive_modified TEXT,
+                                 drive_version TEXT)''')
+        # Базы, созданные до появления drive_version
+        columns = [row['name'] for row in
+                   self.conn.execute('PRAGMA table_info(files)')]
+        if 'drive_version' not in columns:
+            self.conn.execute('ALTER TABLE files ADD COLUMN drive_version TEXT')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS folders (
+                                 path TEXT PRIMARY KEY,
+                                 drive_id TEXT)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                                 key TEXT PRIMARY KEY,
+                                 value TEXT)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS uploads (
+                                 path TEXT PRIMARY KEY,
+                                 size INTEGER,
+                                 mtime_ns INTEGER,
+                                 drive_id TEXT,
+                                 session_uri TEXT,
+                                 offset INTEGER)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_drive_id '
+                          'ON files (drive_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS folders_drive_id '
+                          'ON folders (drive_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_inode '
+                          'ON files (inode)')
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, path):
+        """Возвращает запись о файле или None, если его еще не синхронизировали."""
+        return self.conn.execute('SELECT * FROM files WHERE path = ?',
+                                 (path,)).fetchone()
+
+    @staticmethod
+    def stat_matches(known, file_stat):
+        """Проверяет, что файл на пк не менялся с прошлой синхронизации."""
+        return (known is not None
+                and known['size'] == file_stat.st_size
+                and known['mtime_ns'] == file_stat.st_mtime_ns
+                and known['inode'] == file_stat.st_ino)
+
+    @staticmethod
+    def size_differs(file_stat, drive_file):
+        """Проверяет, что размер файла на пк и на диске точно разный."""
+        drive_size = drive_file.get('size')
+        return drive_size is not None and int(drive_size) != file_stat.st_size
+
+    def cached_md5(self, known, file_stat):
+        """MD5 из базы, если stat файла не поменялся, иначе None."""
+        if self.stat_matches(known, file_stat):
+            return known['md5']
+        return None
+
+    @staticmethod
+    def drive_changed(known, drive_file):
+        """Проверяет, менялся ли файл на гугл диске с прошлой синхронизации.
+
+        У гугл доков нет md5Checksum, поэтому для них сравнивается version,
+        а если ее нет в базе - modifiedTime.
+        """
+        if known is None or known['drive_id'] != drive_file['id']:
+            return True
+        if drive_file.get('md5Checksum') is None:
+            if known['drive_version'] is not None and 'version' in drive_file:
+                return known['drive_version'] != drive_file['version']
+            return known['drive_modified'] != drive_file.get('modifiedTime')
+        return (known['drive_md5'] != drive_file['md5Checksum']
+                or known['drive_modified'] != drive_file.get('modifiedTime'))
+
+    def unchanged(self, known, file_stat, drive_file):
+        """Проверяет, что с прошлой синхронизации не менялась ни одна сторона."""
+        return (self.stat_matches(known, file_stat)
+                and not self.drive_changed(known, drive_file))
+
+    def put(self, path, file_stat, md5, drive_file):
+        """Запоминает состояние файла после синхронизации.
+
+        Аргументы:
+            path: Относительный путь до файла.
+            file_stat: os.stat_result файла на пк.
+            md5: MD5 содержимого файла.
+            drive_file: Словарь с информацией о файле на гугл диске.
+        """
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, md5, '
+            'drive_id, drive_md5, drive_modified, drive_version) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino,
+             md5, drive_file['id'], drive_file.get('md5Checksum'),
+             drive_file.get('modifiedTime'), drive_file.get('version')))
+        self._maybe_commit()
+
+    def update_drive(self, drive_file):
+        """Обновляет version и modifiedTime файла после своего же
+        изменения на диске (например, переименования), чтобы
+        следующая синхронизация не приняла его за чужое."""
+        self.conn.execute(
+            'UPDATE files SET drive_modified = ?, drive_version = ? '
+            'WHERE drive_id = ?',
+            (drive_file.get('modifiedTime'), drive_file.get('version'),
+             drive_file['id']))
+        self._maybe_commit()
+
+    def put_folder(self, path, drive_id):
+        """Запоминает ID папки на гугл диске."""
+        self.conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)',
+                          (path, drive_id))
+        self._maybe_commit()
+
+    def folder_id(self, path):
+        """Возвращает ID синхронизированной папки на гугл диске или None."""
+        row = self.conn.execute('SELECT drive_id FROM folders WHERE path = ?',
+                                (path,)).fetchone()
+        return row['drive_id'] if row is not None else None
+
+    def path_of(self, drive_id):
+        """Ищет синхронизированный объект по ID на гугл диске.
+
+        Возвращает:
+            Пару (относительный путь, папка ли это) или (None, False).
+        """
+        row = self.conn.execute('SELECT path FROM folders WHERE drive_id = ?',
+                                (drive_id,)).fetchone()
+        if row is not None:
+            return row['path'], True
+        row = self.conn.execute('SELECT path FROM files WHERE drive_id = ?',
+                                (drive_id,)).fetchone()
+        if row is not None:
+            return row['path'], False
+        return None, False
+
+    def by_inode(self, inode):
+        """Возвращает записи о файлах с этим inode (по нему видно,
+        что файл на пк переименовали или перенесли)."""
+        return self.conn.execute('SELECT * FROM files WHERE inode = ?',
+                                 (inode,)).fetchall()
+
+    def baseline(self):
+        """Возвращает все, что было синхронизировано в прошлый раз.
+
+        Возвращает:
+            Пару (словарь {относительный путь: запись о файле},
+            множество относительных путей папок).
+        """
+        files = {row['path']: row
+                 for row in self.conn.execute('SELECT * FROM files')}
+        folders = {row['path']
+                   for row in self.conn.execute('SELECT path FROM folders')}
+        return files, folders
+
+    def forget(self, path):
+        """Удаляет запись о файле или о папке со всем содержимым."""
+        prefix = path.rstrip(os.path.sep) + os.path.sep
+        for table in ('files', 'folders', 'uploads'):
+            self.conn.execute(
+                'DELETE FROM %s WHERE path = ? OR substr(path, 1, ?) = ?'
+                % table, (path, len(prefix), prefix))
+        self._maybe_commit()
+
+    def move(self, old_path, new_path):
+        """Переносит записи о файле или папке со всем содержимым на новый путь.
+
+        Старые записи о новом пути (если перенос уже записали с другой
+        стороны) заменяются.
+        """
+        if old_path == new_path:
+            return
+        prefix = old_path.rstrip(os.path.sep) + os.path.sep
+        new_prefix = new_path.rstrip(os.path.sep) + os.path.sep
+        for table in ('files', 'folders'):
+            self.conn.execute(
+                'DELETE FROM %s WHERE path = ? OR substr(path, 1, ?) = ?'
+                % table, (new_path, len(new_prefix), new_prefix))
+            self.conn.execute(
+                'UPDATE %s SET path = ? || substr(path, ?) '
+                'WHERE path = ? OR substr(path, 1, ?) = ?' % table,
+                (new_path, len(old_path) + 1, old_path, len(prefix), prefix))
+        self._maybe_commit()
+
+    def get_upload(self, path, file_stat, drive_id=None):
+        """Ищет незаконченную выгрузку файла.
+
+        Сессия подходит, только если файл на пк с тех пор не менялся
+        и выгружается в тот же объект на диске.
+
+        Аргументы:
+            path: Относительный путь до файла.
+            file_stat: os.stat_result файла на пк.
+            drive_id: ID файла на диске или None для нового файла.
+
+        Возвращает:
+            Пару (URI сессии, сколько байт уже выгружено) или None.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM uploads WHERE path = ?',
+                                    (path,)).fetchone()
+        if (row is None or row['size'] != file_stat.st_size
+                or row['mtime_ns'] != file_stat.st_mtime_ns
+                or row['drive_id'] != (drive_id or '')):
+            return None
+        return row['session_uri'], row['offset']
+
+    def put_upload(self, path, file_stat, drive_id, session_uri, offset):
+        """Запоминает сессию выгрузки, чтобы продолжить ее после перезапуска."""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)',
+                (path, file_stat.st_size, file_stat.st_mtime_ns,
+                 drive_id or '', session_uri, offset))
+            # Прогресс должен пережить падение процесса
+            self.conn.commit()
+
+    def drop_upload(self, path):
+        """Удаляет сессию выгрузки (файл выгружен или сессия протухла)."""
+        with self.lock:
+            self.conn.execute('DELETE FROM uploads WHERE path = ?', (path,))
+            self.conn.commit()
+
+    def get_meta(self, key):
+        """Возвращает служебное значение (например, курсор изменений) или None."""
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                (key,)).fetchone()
+        return row['value'] if row is not None else None
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          (key, value))
+        self._maybe_commit()
+
+    def _maybe_commit(self):
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
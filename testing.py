@@ -1,42 +1,16 @@
+import itertools
 import mimetypes
 import os.path
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from drive_api import build_service, get_credentials, iter_files, new_http
 
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly", "https://www.googleapis.com/auth/drive.file"]
 FULL_PATH = "/Users/mafed/DnD"
 
-creds = None
-
-if os.path.exists("token.json"):
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file(
-            "credentials.json", SCOPES
-        )
-        creds = flow.run_local_server(port=0)
-    # Save the credentials for the next run
-    with open("token.json", "w") as token:
-        token.write(creds.to_json())
-
-service = build("drive", "v3", credentials=creds)
-
-
-def return_recent_files():
-    results = (
-        service.files()
-        .list(pageSize=10, fields="nextPageToken, files(id, name)")
-        .execute()
-    )
-    items = results.get("files", [])
+
+def return_recent_files(service):
+    items = list(itertools.islice(
+        iter_files(service, fields="id, name", page_size=10), 10))
 
     if not items:
         print("No files found.")
@@ -46,7 +20,7 @@ def return_recent_files():
         print(f"{item['name']} ({item['id']})")
 
 
-def get_drive_info():
+def get_drive_info(service):
     # Выполнение запроса к методу about()
     response = service.about().get(fields="user, storageQuota").execute()
 
@@ -65,6 +39,8 @@ def get_drive_info():
 
 
 def folder_upload(service):
+    from googleapiclient.http import MediaFileUpload
+
     parents_id = {}
 
     for root, _, files in os.walk(FULL_PATH, topdown=True):
@@ -95,6 +71,12 @@ def folder_upload(service):
     return parents_id
 
 
-#return_recent_files()
-get_drive_info()
-#folder_upload(service)
+def main():
+    service = build_service(new_http(get_credentials(SCOPES)))
+    #return_recent_files(service)
+    get_drive_info(service)
+    #folder_upload(service)
+
+
+if __name__ == '__main__':
+    main()
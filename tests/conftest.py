@@ -0,0 +1,80 @@
+"""Общие фикстуры: папка синхронизации на пк и фейковый гугл диск."""
+
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import updateDrivetoPC  # noqa: E402
+import updatePCtoDrive  # noqa: E402
+from drive_tree import FOLDER_MIME  # noqa: E402
+from fake_drive import FakeDriveHttp  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from throttle import RequestLimiter, ThrottledHttp  # noqa: E402
+
+DIR_NAME = 'DnD'
+
+
+@pytest.fixture
+def drive():
+    """Пустой FakeDriveHttp."""
+    return FakeDriveHttp()
+
+
+@pytest.fixture
+def full_path(tmp_path, monkeypatch, drive):
+    """Полный путь до пустой папки синхронизации.
+
+    Скрипты синхронизации ходят в drive без авторизации и без пауз
+    между повторами, а база состояния, кеш discovery и отчеты
+    пишутся в tmp_path.
+    """
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / 'sync' / DIR_NAME)
+    os.makedirs(path)
+    limiter = RequestLimiter(rate=1000, burst=1000)
+    for module in (updatePCtoDrive, updateDrivetoPC):
+        monkeypatch.setattr(module, 'FULL_PATH', path)
+        monkeypatch.setattr(module, 'DIR_NAME', DIR_NAME)
+        monkeypatch.setattr(module, 'get_credentials', lambda: None)
+        monkeypatch.setattr(
+            module, 'new_http',
+            lambda credentials: ThrottledHttp(drive, limiter,
+                                              sleep=lambda seconds: None))
+    METRICS.reset()
+    return path
+
+
+def write_file(full_path, rel_path, content=b''):
+    """Кладет файл в папку синхронизации, создавая подпапки."""
+    path = os.path.join(full_path, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(content)
+    return path
+
+
+def local_state(full_path):
+    """{путь вида DnD/a/x.txt: md5 или 'folder'} для папки на пк."""
+    base_path = os.path.dirname(full_path)
+    state = {}
+    for dir_path, _, names in os.walk(full_path):
+        state[os.path.relpath(dir_path, base_path)] = 'folder'
+        for name in names:
+            with open(os.path.join(dir_path, name), 'rb') as file:
+                state[os.path.relpath(os.path.join(dir_path, name),
+                                      base_path)] = \
+                    hashlib.md5(file.read()).hexdigest()
+    return state
+
+
+def drive_state(drive):
+    """То же, что local_state, но для FakeDriveHttp."""
+    return {drive.path_of(meta['id']):
+            'folder' if meta['mimeType'] == FOLDER_MIME
+            else meta.get('md5Checksum')
+            for meta in drive.files.values()
+            if meta['id'] != 'root' and not meta.get('trashed')}
@@ -0,0 +1,43 @@
+import pytest
+
+from driveignore import IgnoreRules
+
+RULES = IgnoreRules([
+    '# комментарий',
+    '*.tmp',
+    'build/',
+    '/notes.txt',
+    'docs/**/draft?.md',
+    '!keep.tmp',
+], 'DnD')
+
+
+@pytest.mark.parametrize('path, is_dir, ignored', [
+    ('DnD/a.tmp', False, True),
+    ('DnD/deep/er/b.tmp', False, True),
+    ('DnD/keep.tmp', False, False),
+    ('DnD/build', True, True),
+    ('DnD/x/build', True, True),
+    ('DnD/build', False, False),
+    ('DnD/notes.txt', False, True),
+    ('DnD/a/notes.txt', False, False),
+    ('DnD/docs/draft1.md', False, True),
+    ('DnD/docs/a/b/draft2.md', False, True),
+    ('DnD/docs/final.md', False, False),
+    ('DnD', True, False),
+])
+def test_match(path, is_dir, ignored):
+    assert RULES.match(path, is_dir) is ignored
+
+
+def test_load_without_file(tmp_path):
+    rules = IgnoreRules.load(str(tmp_path))
+    assert not rules
+    assert not rules.match('DnD/a.tmp')
+
+
+def test_load(tmp_path):
+    (tmp_path / '.driveignore').write_text('*.log\n', encoding='utf-8')
+    rules = IgnoreRules.load(str(tmp_path))
+    assert rules.match(tmp_path.name + '/a/b.log')
+    assert not rules.match(tmp_path.name + '/a/b.txt')
@@ -0,0 +1,70 @@
+import os
+import shutil
+import time
+
+import updateDrivetoPC
+import updatePCtoDrive
+from conftest import drive_state, local_state, write_file
+from sync_state import SyncState
+
+
+def test_push_then_pull_round_trip(full_path, drive):
+    write_file(full_path, 'top.txt', b'top')
+    write_file(full_path, 'a/x.txt', b'ax')
+    write_file(full_path, 'a/img/p.png', b'png')
+    updatePCtoDrive.main()
+    uploaded = drive_state(drive)
+    assert uploaded == local_state(full_path)
+
+    shutil.rmtree(full_path)
+    os.makedirs(full_path)
+    os.remove('sync_state.db')
+    updateDrivetoPC.main(full=True)
+    assert local_state(full_path) == uploaded
+
+
+def test_empty_file_is_downloaded(full_path, drive):
+    write_file(full_path, 'a/empty.txt')
+    updatePCtoDrive.main()
+    assert drive.find('DnD/a/empty.txt')['size'] == '0'
+
+    os.remove(os.path.join(full_path, 'a', 'empty.txt'))
+    os.remove('sync_state.db')
+    updateDrivetoPC.main(full=True)
+    assert os.path.getsize(os.path.join(full_path, 'a', 'empty.txt')) == 0
+
+
+def test_cursor_is_kept_while_downloads_fail(full_path, drive):
+    write_file(full_path, 'a/x.txt', b'old')
+    updatePCtoDrive.main()
+    updateDrivetoPC.main(full=True)
+
+    meta = drive.find('DnD/a/x.txt')
+    drive.update_file(meta['id'], b'new content')
+    drive.fail = lambda method, path: (
+        404 if method == 'GET' and meta['id'] in path else None)
+    for _ in range(2):
+        updateDrivetoPC.main()
+    with open(os.path.join(full_path, 'a', 'x.txt'), 'rb') as file:
+        assert file.read() == b'old'
+
+    # Курсор не ушел дальше изменения, и оно докачивается потом
+    drive.fail = None
+    updateDrivetoPC.main()
+    with open(os.path.join(full_path, 'a', 'x.txt'), 'rb') as file:
+        assert file.read() == b'new content'
+    assert not [name for name in os.listdir(os.path.join(full_path, 'a'))
+                if name.endswith('.drivesync-part')]
+
+
+def test_touched_file_is_not_uploaded_again(full_path, drive):
+    path = write_file(full_path, 'a/x.txt', b'same')
+    updatePCtoDrive.main()
+
+    later = time.time() + 3600
+    os.utime(path, (later, later))
+    drive.calls.clear()
+    updatePCtoDrive.main()
+    assert 'files.update' not in drive.calls
+    with SyncState() as state:
+        assert state.stat_matches(state.get('DnD/a/x.txt'), os.stat(path))
@@ -0,0 +1,83 @@
+import json
+
+from fake_drive import FakeDriveHttp
+from throttle import RequestLimiter, ThrottledHttp
+
+FILES = 'https://www.googleapis.com/drive/v3/files'
+
+
+def flaky_drive(status, failures):
+    """FakeDriveHttp, который первые failures запросов отвечает status.
+
+    Возвращает:
+        Пару (FakeDriveHttp, список (метод, путь) всех запросов).
+    """
+    seen = []
+
+    def fail(method, path):
+        seen.append((method, path))
+        return status if len(seen) <= failures else None
+
+    return FakeDriveHttp(fail=fail), seen
+
+
+def throttled(drive, sleeps=None):
+    return ThrottledHttp(drive, RequestLimiter(rate=1000, burst=1000),
+                         retries=3, sleep=(sleeps if sleeps is not None
+                                           else []).append)
+
+
+def test_get_is_retried_on_server_error():
+    drive, seen = flaky_drive(503, 2)
+    sleeps = []
+    response, _ = throttled(drive, sleeps).request(FILES + '/root')
+    assert response.status == 200
+    assert len(seen) == 3
+    assert len(sleeps) == 2
+
+
+def test_retries_are_limited():
+    drive, seen = flaky_drive(503, 100)
+    response, _ = throttled(drive).request(FILES + '/root')
+    assert response.status == 503
+    assert len(seen) == 4
+
+
+def test_create_is_not_retried_on_server_error():
+    drive, seen = flaky_drive(500, 1)
+    response, _ = throttled(drive).request(
+        FILES, 'POST', body=json.dumps({'name': 'a.txt'}),
+        headers={'content-type': 'application/json'})
+    assert response.status == 500
+    assert len(seen) == 1
+
+
+def test_create_is_retried_on_rate_limit():
+    drive, seen = flaky_drive(429, 1)
+    response, _ = throttled(drive).request(
+        FILES, 'POST', body=json.dumps({'name': 'a.txt'}),
+        headers={'content-type': 'application/json'})
+    assert response.status == 200
+    assert len(seen) == 2
+    assert drive.find('a.txt') is not None
+
+
+def test_limiter_waits_for_tokens():
+    now, sleeps = [0.0], []
+    limiter = RequestLimiter(rate=10, burst=2, clock=lambda: now[0],
+                             sleep=sleeps.append)
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release()
+    assert sleeps == [0.1]
+
+
+def test_limiter_halves_concurrency_when_throttled():
+    limiter = RequestLimiter(max_concurrency=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 5
@@ -0,0 +1,123 @@
+import os
+
+import updatePCtoDrive
+from conftest import DIR_NAME, drive_state, local_state, write_file
+from watcher import watch_loop
+
+
+class FakeClock:
+    """Время, которое идет только когда его двигают."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ScriptedWatcher:
+    """Отдает события по расписанию вместо inotify.
+
+    Аргументы:
+        clock: FakeClock, который read двигает вперед.
+        script: Список (время, пути) или (время, 'overflow').
+        before: Функция before(пути), которую вызывают перед тем,
+        как отдать события (например, чтобы поменять файлы на пк).
+    """
+
+    def __init__(self, clock, script, before=None):
+        self.clock = clock
+        self.script = list(script)
+        self.before = before
+        self.timeouts = []
+
+    def read(self, timeout):
+        self.timeouts.append(timeout)
+        if self.script and self.script[0][0] <= self.clock.now + timeout:
+            at, paths = self.script.pop(0)
+            self.clock.now = max(self.clock.now, at)
+            if paths == 'overflow':
+                return set(), True
+            if self.before:
+                self.before(paths)
+            return set(paths), False
+        self.clock.now += timeout
+        return set(), False
+
+
+def run(script, until, **kwargs):
+    """Гоняет watch_loop до момента until.
+
+    Возвращает:
+        Пару (список (время, пути) выгрузок, список времени сверок).
+    """
+    clock = FakeClock()
+    pushes, reconciles = [], []
+    watch_loop(ScriptedWatcher(clock, script),
+               lambda paths: pushes.append((clock.now, set(paths))),
+               lambda: reconciles.append(clock.now),
+               clock=clock, should_stop=lambda: clock.now >= until,
+               **kwargs)
+    return pushes, reconciles
+
+
+def test_events_are_pushed_after_debounce():
+    pushes, _ = run([(0, {'DnD/a'}), (1, {'DnD/b'}), (1.5, {'DnD/a'})],
+                    until=10, debounce=2)
+    assert pushes == [(3.5, {'DnD/a', 'DnD/b'})]
+
+
+def test_steady_events_are_pushed_after_max_delay():
+    script = [(second, {'DnD/%d' % second}) for second in range(12)]
+    pushes, _ = run(script, until=20, debounce=2, max_delay=5)
+
+    assert [at for at, _ in pushes] == [5, 11]
+    assert set().union(*(paths for _, paths in pushes)) == \
+        {'DnD/%d' % second for second in range(12)}
+
+
+def test_overflow_drops_pending_and_reconciles():
+    pushes, reconciles = run([(0, {'DnD/a'}), (1, 'overflow')], until=10,
+                             debounce=2, reconcile_every=100)
+    assert pushes == []
+    assert reconciles == [1]
+
+
+def test_periodic_reconcile():
+    pushes, reconciles = run([], until=35, reconcile_every=10)
+    assert pushes == []
+    assert reconciles == [10, 20, 30]
+
+
+def test_read_timeout_is_bounded():
+    clock = FakeClock()
+    watcher = ScriptedWatcher(clock, [(0, {'DnD/a'})])
+    watch_loop(watcher, lambda paths: None, lambda: None, debounce=0.5,
+               reconcile_every=100, clock=clock,
+               should_stop=lambda: clock.now >= 5)
+    # Пока есть изменения, ждем не дольше debounce, иначе - POLL_TIMEOUT
+    assert watcher.timeouts[1] == 0.5
+    assert max(watcher.timeouts) <= 1.0
+
+
+def test_watch_pushes_local_changes(full_path, drive):
+    write_file(full_path, 'a/old.txt', b'old')
+    write_file(full_path, 'a/gone.txt', b'gone')
+
+    def change(paths):
+        write_file(full_path, 'a/new.txt', b'new')
+        write_file(full_path, 'a/old.txt', b'changed')
+        os.remove(os.path.join(full_path, 'a', 'gone.txt'))
+
+    clock = FakeClock()
+    script = [(5, {os.path.join(DIR_NAME, 'a', name)
+                   for name in ('new.txt', 'old.txt', 'gone.txt')})]
+    updatePCtoDrive.watch(
+        workers=2, debounce=2, interval=1000, clock=clock,
+        watcher=ScriptedWatcher(clock, script, before=change),
+        should_stop=lambda: clock.now >= 10)
+
+    assert drive_state(drive) == local_state(full_path)
+    assert 'DnD/a/gone.txt' not in drive_state(drive)
+    # Изменения выгружены точечно, без второго обхода дерева
+    assert drive.calls['files.list'] == 2
@@ -0,0 +1,266 @@
+import contextlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+from metrics import METRICS, call_name
+
+# Сколько запросов в секунду отправлять к апи (квота гугл диска -
+# 20 000 запросов за 100 секунд на пользователя)
+RATE = 150
+# Сколько запросов можно отправить разом после простоя
+BURST = 50
+# Максимум одновременных запросов на все потоки
+MAX_CONCURRENCY = 16
+# Сколько раз повторять запрос, прежде чем сдаться
+MAX_RETRIES = 6
+# Пауза перед первым повтором и верхняя граница паузы, в секундах
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+
+# На эти ответы гугл советует повторять запрос с экспоненциальной паузой
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'userRateLimitExceeded', 'rateLimitExceeded'}
+# Эти запросы создают новый файл при каждом вызове: если ответ не дошел
+# или сервер ответил 5xx, файл мог уже появиться, и повтор оставит дубль
+NON_IDEMPOTENT_CALLS = {'files.create', 'files.copy'}
+
+
+# Запросы этого потока сейчас не повторяются после обрыва и 5xx
+# (см. non_idempotent)
+_local = threading.local()
+
+
+def is_throttled(response, content):
+    """Проверяет, что апи попросило притормозить (429, 5xx или 403 с
+    причиной rateLimitExceeded)."""
+    return response.status in RETRY_STATUSES or is_rate_limited(
+        response, content)
+
+
+def is_rate_limited(response, content):
+    """Проверяет, что сервер отклонил запрос из-за лимита (429 или 403
+    rateLimitExceeded) и, значит, точно его не выполнил."""
+    if response.status == 429:
+        return True
+    if response.status != 403:
+        return False
+    try:
+        errors = json.loads(content)['error']['errors']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+
+
+def is_idempotent(uri, name):
+    """Проверяет, что запрос можно повторить, не зная, выполнил ли
+    его сервер. Начало resumable выгрузки - тоже POST на /files,
+    но файл появляется только после последнего куска, поэтому его
+    повторять можно.
+
+    Аргументы:
+        uri: URI запроса.
+        name: Метод апи, как его определяет call_name.
+    """
+    if getattr(_local, 'non_idempotent', False):
+        return False
+    if name not in NON_IDEMPOTENT_CALLS:
+        return True
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(uri).query)
+    return query.get('uploadType') == ['resumable']
+
+
+@contextlib.contextmanager
+def non_idempotent():
+    """Внутри блока запросы текущего потока считаются неидемпотентными.
+
+    Так помечается batch, в котором есть создание или копирование:
+    по URI /batch этого не видно.
+    """
+    _local.non_idempotent = True
+    try:
+        yield
+    finally:
+        _local.non_idempotent = False
+
+
+def backoff(attempt, retry_after=None):
+    """Пауза перед повтором номер attempt: экспонента со случайным
+    разбросом, чтобы потоки не повторяли запросы одновременно.
+    Если сервер прислал Retry-After, ждем не меньше него."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+
+class RequestLimiter:
+    """Общий для всех потоков ограничитель запросов к апи.
+
+    Частоту держит token bucket, а число одновременных запросов
+    подстраивается само: при каждом ответе "притормози" оно
+    уменьшается вдвое, а после серии успешных растет на единицу.
+
+    Аргументы:
+        rate: Сколько запросов в секунду можно отправлять.
+        burst: Сколько запросов можно отправить разом после простоя.
+        max_concurrency: Максимум одновременных запросов.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_concurrency=MAX_CONCURRENCY,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated = clock()
+        self.limit = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Ждет свободного места и токена на один запрос."""
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Токен берем в долг, а ждем уже без блокировки
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            self.sleep(wait)
+
+    def release(self, throttled=False):
+        """Освобождает место после запроса.
+
+        Аргументы:
+            throttled: Ответил ли сервер, что запросов слишком много.
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if (self.successes >= self.limit
+                        and self.limit < self.max_concurrency):
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+# Один ограничитель на процесс: квота общая для всех потоков
+LIMITER = RequestLimiter()
+
+
+class ThrottledHttp:
+    """HTTP клиент, через который идут все запросы к гугл диску.
+
+    Оборачивает httplib2.Http (или AuthorizedHttp): каждый запрос
+    ждет очереди в RequestLimiter, а ответы 429, 5xx и 403
+    rateLimitExceeded повторяются с экспоненциальной паузой.
+    Так под этот лимит попадают и обычные запросы, и batch,
+    и куски выгрузок и скачиваний. Создание и копирование файла
+    после обрыва соединения, таймаута или 5xx не повторяются:
+    сервер мог его уже выполнить (см. is_idempotent). Каждая попытка
+    и каждый повтор записываются в METRICS.
+
+    Аргументы:
+        http: Настоящий HTTP клиент.
+        limiter: RequestLimiter, общий для всех клиентов.
+        retries: Сколько раз повторять запрос.
+    """
+
+    def __init__(self, http, limiter=LIMITER, retries=MAX_RETRIES,
+                 sleep=time.sleep):
+        self.http = http
+        self.limiter = limiter
+        self.retries = retries
+        self.sleep = sleep
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        # Кусок файла при выгрузке приходит потоком, а повторять
+        # запрос нужно с тем же телом
+        if hasattr(body, 'read'):
+            body = body.read()
+
+        def send():
+            response, content = self.http.request(
+                uri, method, body=body, headers=headers, **kwargs)
+            return response, content, len(content or b'')
+
+        return self._retry(uri, method, body, send)
+
+    def stream(self, uri, file_io, chunk_size, headers=None):
+        """Скачивает ответ на GET запрос прямо в file_io (см.
+        SessionHttp.stream). Перед каждой попыткой file_io очищается.
+
+        Если настоящий клиент так не умеет, тело ответа читается
+        в память целиком и потом записывается.
+        """
+        def send():
+            file_io.seek(0)
+            file_io.truncate()
+            if hasattr(self.http, 'stream'):
+                response, content = self.http.stream(uri, file_io,
+                                                     chunk_size, headers)
+            else:
+                response, content = self.http.request(uri, 'GET',
+                                                      headers=headers)
+                if response.status == 200:
+                    file_io.write(content)
+                    content = b''
+            return response, content, file_io.tell() + len(content)
+
+        return self._retry(uri, 'GET', None, send)
+
+    def _retry(self, uri, method, body, send):
+        """Выполняет send под ограничителем, повторяя его, пока сервер
+        просит притормозить. send возвращает (ответ, тело, сколько
+        байт получено)."""
+        name = call_name(uri, method)
+        idempotent = is_idempotent(uri, name)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                METRICS.record_retry(name)
+            self.limiter.acquire()
+            throttled = False
+            start = time.perf_counter()
+            try:
+                response, content, received = send()
+                throttled = is_throttled(response, content)
+            except (ConnectionError, TimeoutError):
+                METRICS.record_call(name, time.perf_counter() - start,
+                                    len(body or b''), 0, 599)
+                if attempt == self.retries or not idempotent:
+                    raise
+                self.sleep(backoff(attempt))
+                continue
+            finally:
+                self.limiter.release(throttled)
+
+            METRICS.record_call(name, time.perf_counter() - start,
+                                len(body or b''), received, response.status)
+            if (not throttled or attempt == self.retries
+                    or response.status >= 500 and not idempotent):
+                return response, content
+            self.sleep(backoff(attempt, response.get('retry-after')))
@@ -0,0 +1,567 @@
+import functools
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+
+from drive_api import execute_batch, format_time, parse_time
+from drive_tree import GOOGLE_MIME_TYPES, local_name
+from hashing import file_md5, hash_files
+
+# Сколько файлов выгружается одновременно
+UPLOAD_WORKERS = 8
+# Сколько файлов скачивается одновременно
+DOWNLOAD_WORKERS = 8
+# Какие поля вернуть после выгрузки (нужны для базы состояния)
+UPLOAD_FIELDS = 'id, md5Checksum, modifiedTime, version'
+# Файлы от этого размера выгружаются кусками через resumable сессию,
+# меньшие - одним multipart запросом
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+# Размер куска resumable выгрузки, должен быть кратен 256 КБ
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Размер куска (Range запроса) при скачивании
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Недокачанный файл лежит рядом с настоящим скрытым файлом
+# .<имя>.drivesync-part, чтобы не спутать его с файлом пользователя
+PART_SUFFIX = '.drivesync-part'
+# Файлы меньше этого размера выгружаются, даже если такие уже есть
+# на диске: копия стоит столько же запросов, сколько и выгрузка
+COPY_THRESHOLD = 64 * 1024
+
+
+def part_path(target):
+    """Путь недокачанного куска для файла target."""
+    folder, name = os.path.split(target)
+    return os.path.join(folder, '.' + name + PART_SUFFIX)
+
+
+def is_partial(name):
+    """Проверяет, что файл - недокачанный кусок, а не настоящий файл."""
+    return name.startswith('.') and name.endswith(PART_SUFFIX)
+
+
+def download_range(request, file_io, offset, chunk_size):
+    """Дописывает в file_io содержимое файла с байта offset до конца.
+
+    Range заголовок ставится здесь, а не в MediaIoBaseDownload:
+    тот умеет качать только с начала файла.
+
+    Аргументы:
+        request: HttpRequest от files().get_media.
+        file_io: Файл, открытый на дозапись.
+        offset: Сколько байт уже скачано.
+        chunk_size: Размер одного Range запроса в байтах.
+
+    Исключения:
+        HttpError, если диск ответил ошибкой.
+    """
+    total = None
+    while total is None or offset < total:
+        headers = dict(request.headers)
+        headers['range'] = 'bytes=%d-%d' % (offset, offset + chunk_size - 1)
+        response, content = request.http.request(request.uri, 'GET',
+                                                 headers=headers)
+        # 416 приходит на Range запрос к пустому файлу
+        if response.status == 416 and offset == 0:
+            return
+        if response.status not in (200, 206):
+            raise HttpError(response, content, uri=request.uri)
+        if response.status == 200:
+            # Сервер не понял Range и прислал весь файл
+            file_io.seek(0)
+            file_io.truncate()
+            file_io.write(content)
+            return
+
+        file_io.write(content)
+        offset += len(content)
+        length = response.get('content-range', '').rsplit('/', 1)[-1]
+        if not content or not length.isdigit():
+            return
+        total = int(length)
+
+
+def download_stream(request, file_io, chunk_size):
+    """Скачивает содержимое одним запросом, записывая его в file_io
+    кусками по мере получения.
+
+    Нужно для экспорта гугл доков: диск отдает его целиком и Range
+    не понимает. Если HTTP клиент не умеет stream (см.
+    SessionHttp.stream), ответ все-таки читается в память целиком.
+
+    Аргументы:
+        request: HttpRequest от files().export_media.
+        file_io: Файл, открытый на запись.
+        chunk_size: Сколько байт писать за раз.
+
+    Исключения:
+        HttpError, если диск ответил ошибкой.
+    """
+    http = request.http
+    if hasattr(http, 'stream'):
+        response, content = http.stream(request.uri, file_io, chunk_size,
+                                        request.headers)
+    else:
+        response, content = http.request(request.uri, 'GET',
+                                         headers=request.headers)
+        if response.status == 200:
+            file_io.write(content)
+    if response.status != 200:
+        raise HttpError(response, content, uri=request.uri)
+
+
+def download_media(request, target, md5=None, size=None,
+                   chunk_size=DOWNLOAD_CHUNK_SIZE, resume=True):
+    """Скачивает содержимое файла через временный файл.
+
+    В памяти одновременно держится не больше одного куска.
+    Если от прошлого запуска остался .<имя>.drivesync-part, скачивание
+    продолжается с его конца. Готовый файл сверяется с md5
+    и только потом переименовывается в target.
+
+    Аргументы:
+        request: HttpRequest от files().get_media или files().export_media.
+        target: Полный путь, куда положить файл.
+        md5: md5Checksum файла на гугл диске или None.
+        size: Размер файла на гугл диске или None.
+        chunk_size: Размер одного Range запроса в байтах.
+        resume: Докачивать ли оставшийся кусок. Экспорт гугл доков
+        каждый раз генерируется заново и Range не понимает, поэтому
+        его всегда качаем с нуля одним запросом (download_stream).
+
+    Исключения:
+        OSError, если MD5 скачанного файла не совпал с md5Checksum.
+    """
+    part = part_path(target)
+    offset = os.path.getsize(part) if resume and os.path.exists(part) else 0
+    # Файл на диске стал меньше, чем уже скачано - кусок от старой версии
+    if size is not None and offset > int(size):
+        offset = 0
+
+    if size is not None and int(size) == 0:
+        # Пустой файл качать незачем, но кусок все равно нужен для md5
+        # и переименования
+        open(part, 'wb').close()
+    elif not resume:
+        with io.FileIO(part, 'wb') as file_io:
+            download_stream(request, file_io, chunk_size)
+    elif size is None or offset < int(size):
+        with io.FileIO(part, 'ab' if offset else 'wb') as file_io:
+            download_range(request, file_io, offset, chunk_size)
+
+    if md5 is not None and file_md5(part) != md5:
+        os.remove(part)
+        if offset:
+            # Кусок мог остаться от старой версии файла, качаем заново
+            return download_media(request, target, md5, size, chunk_size)
+        raise OSError('MD5 скачанного файла {} не совпадает с диском'
+                      .format(target))
+
+    os.replace(part, target)
+
+
+class WorkerPool:
+    """Пул потоков для запросов к гугл диску.
+
+    У каждого потока свой HTTP клиент из http_factory, потому что
+    httplib2.Http не потокобезопасен. В очереди ждет не больше
+    2 * workers задач, остальные submit ждут, пока место освободится.
+
+    Аргументы:
+        http_factory: Функция без аргументов, которая создает
+        HTTP клиент для потока. Если None, задачи получают http=None
+        и ходят через HTTP клиент service.
+        workers: Количество потоков.
+    """
+
+    def __init__(self, http_factory=None, workers=UPLOAD_WORKERS):
+        self.http_factory = http_factory
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(2 * workers)
+        self.futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _http(self):
+        if self.http_factory is None:
+            return None
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.http_factory()
+        return self.local.http
+
+    def _call(self, func, args):
+        return func(*args, http=self._http())
+
+    def run(self, key, func, *args):
+        """Ставит в очередь вызов func(*args, http=...) в отдельном потоке.
+
+        Аргументы:
+            key: Ключ, под которым вернется результат (например, путь).
+            func: Функция, которая делает запрос.
+        """
+        self.slots.acquire()
+        future = self.executor.submit(self._call, func, args)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures[key] = future
+
+    def wait(self):
+        """Дожидается всех поставленных в очередь задач.
+
+        Возвращает:
+            Два словаря: {ключ: результат} для выполненных задач
+            и {ключ: исключение} для тех, что выполнить не удалось.
+        """
+        results, errors = {}, {}
+        for key, future in self.futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as error:
+                errors[key] = error
+        self.futures = {}
+        return results, errors
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class UploadPool(WorkerPool):
+    """Выгружает файлы на гугл диск в несколько потоков.
+
+    Файл открывается только тогда, когда поток берется за него,
+    поэтому открытых файлов не больше, чем потоков.
+    Родительская папка файла должна уже существовать на диске.
+
+    Вместе с файлом на диск уходит его время изменения на пк
+    (modifiedTime), чтобы оно совпадало с обеих сторон.
+
+    Маленькие файлы уходят одним multipart запросом, большие -
+    кусками по chunk_size через resumable сессию. URI сессии и
+    выгруженный объем сохраняются в state после каждого куска,
+    так что следующий запуск продолжает выгрузку с того же места.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        http_factory: Функция, создающая HTTP клиент для потока.
+        workers: Количество потоков.
+        state: SyncState для сессий выгрузки или None.
+        chunk_size: Размер куска resumable выгрузки в байтах.
+    """
+
+    def __init__(self, service, http_factory=None, workers=UPLOAD_WORKERS,
+                 state=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        super().__init__(http_factory, workers)
+        self.service = service
+        self.state = state
+        self.chunk_size = chunk_size
+
+    def submit(self, key, file_dir, metadata, file_id=None, mimetype=None):
+        """Ставит файл в очередь на выгрузку.
+
+        Аргументы:
+            key: Ключ, под которым вернется результат (например, путь).
+            file_dir: Полный путь до файла на пк.
+            metadata: Метаданные файла для гугл диска.
+            file_id: ID файла на диске, если нужно обновить существующий.
+            mimetype: mimeType содержимого.
+        """
+        self.run(key, self._upload, key, file_dir, metadata, file_id,
+                 mimetype)
+
+    def _request(self, media, metadata, file_id):
+        if file_id is None:
+            return self.service.files().create(
+                body=metadata, media_body=media, fields=UPLOAD_FIELDS)
+        return self.service.files().update(
+            fileId=file_id, body=metadata, media_body=media,
+            fields=UPLOAD_FIELDS)
+
+    @staticmethod
+    def _session_status(request, media, http):
+        """Спрашивает у диска, сколько байт resumable сессии он получил,
+        и выставляет request.resumable_progress.
+
+        Возвращает:
+            Ответ диска, если выгрузка уже завершилась, иначе None.
+
+        Исключения:
+            HttpError, если сессия протухла (404, 410) или другая ошибка.
+        """
+        response, content = (http or request.http).request(
+            request.resumable_uri, 'PUT',
+            headers={'Content-Length': '0',
+                     'Content-Range': 'bytes */%d' % media.size()})
+        if response.status in (200, 201):
+            return request.postproc(response, content)
+        if response.status != 308:
+            raise HttpError(response, content, uri=request.uri)
+        # Range: bytes=0-N, нет заголовка - не получено ничего
+        received = response.get('range')
+        request.resumable_progress = (int(received.rsplit('-', 1)[1]) + 1
+                                      if received else 0)
+        return None
+
+    def _upload(self, key, file_dir, metadata, file_id, mimetype, http=None):
+        file_stat = os.stat(file_dir)
+        metadata = dict(metadata or {},
+                        modifiedTime=format_time(file_stat.st_mtime))
+        if file_stat.st_size < RESUMABLE_THRESHOLD:
+            media = MediaFileUpload(file_dir, mimetype=mimetype)
+            try:
+                return self._request(media, metadata, file_id).execute(
+                    http=http)
+            finally:
+                media.stream().close()
+
+        media = MediaFileUpload(file_dir, mimetype=mimetype,
+                                chunksize=self.chunk_size, resumable=True)
+        try:
+            session = None
+            if self.state is not None:
+                session = self.state.get_upload(key, file_stat, file_id)
+            try:
+                return self._resumable(key, file_stat, media, metadata,
+                                       file_id, session, http)
+            except HttpError as error:
+                # Сессия живет около недели, протухшую начинаем заново
+                if session is None or error.resp.status not in (404, 410):
+                    raise
+                self.state.drop_upload(key)
+                return self._resumable(key, file_stat, media, metadata,
+                                       file_id, None, http)
+        finally:
+            media.stream().close()
+
+    def _resumable(self, key, file_stat, media, metadata, file_id, session,
+                   http):
+        request = self._request(media, metadata, file_id)
+        if session is not None:
+            request.resumable_uri = session[0]
+            # Сначала спрашиваем у диска, сколько байт он на самом деле
+            # получил: сохраненный offset мог отстать от сервера
+            response = self._session_status(request, media, http)
+        else:
+            response = None
+
+        while response is None:
+            status, response = request.next_chunk(http=http)
+            if status is not None and self.state is not None:
+                self.state.put_upload(key, file_stat, file_id,
+                                      request.resumable_uri,
+                                      status.resumable_progress)
+
+        if self.state is not None:
+            self.state.drop_upload(key)
+        return response
+
+
+class DownloadPool(WorkerPool):
+    """Скачивает файлы с гугл диска в несколько потоков.
+
+    Папка на пк создается в вызывающем потоке еще до того,
+    как файл попадет в очередь.
+
+    Аргументы:
+        http_factory: Функция, создающая HTTP клиент для потока.
+        workers: Количество потоков.
+        chunk_size: Размер одного Range запроса в байтах.
+    """
+
+    def __init__(self, http_factory=None, workers=DOWNLOAD_WORKERS,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE):
+        super().__init__(http_factory, workers)
+        self.chunk_size = chunk_size
+
+    def submit(self, key, download, file_path, drive_file, *args):
+        """Ставит файл в очередь на скачивание.
+
+        Аргументы:
+            key: Ключ, под которым вернется результат (например, путь).
+            download: Функция download(file_path, drive_file, *args,
+            chunk_size=..., http=...), которая скачивает файл
+            и возвращает путь до него.
+            file_path: Папка на пк, куда скачивается файл.
+            drive_file: Словарь с информацией о файле на гугл диске.
+        """
+        os.makedirs(file_path, exist_ok=True)
+        self.run(key, functools.partial(download, chunk_size=self.chunk_size),
+                 file_path, drive_file, *args)
+
+
+def download_file_from_gdrive(file_path, drive_file, service, renames=None,
+                              chunk_size=DOWNLOAD_CHUNK_SIZE, http=None):
+    """Скачивает файлы из гугл диска.
+
+    Если файл в формате гугл доков, тогда загружаем его
+    с соответствующим не гугловским форматом. Файл сначала пишется
+    во временный .drivesync-part файл, а потом переименовывается, поэтому на месте
+    настоящего файла никогда не остается недокачанного.
+    Обычные файлы докачиваются с места, где остановились в прошлый раз.
+
+    Аргументы:
+        path: Строка директории, где будут сохраняться файлы
+        file: Словарь с информацией об объекте, включающий
+        его имя, ID и mimeType.
+        service: Инстанс API.
+        renames: Список, куда складывать переименования гугл доков
+        (ID, новое имя), чтобы потом отправить их одним batch запросом.
+        Если None, файл переименовывается сразу.
+        chunk_size: Размер одного Range запроса в байтах.
+        http: HTTP клиент, через который делать запросы
+        (у каждого потока свой), None - клиент service.
+
+    Возвращает:
+        Полный путь до скачанного файла.
+    """
+    file_id = drive_file['id']
+    file_name = local_name(drive_file)
+    if file_name != drive_file['name']:
+        if renames is None:
+            service.files().update(fileId=file_id,
+                                   body={'name': file_name}).execute(
+                                       http=http)
+        else:
+            renames.append((file_id, file_name))
+
+    target = os.path.join(file_path, file_name)
+
+    if drive_file['mimeType'] in GOOGLE_MIME_TYPES.keys():
+        # Экспорт тоже качаем кусками, не собирая весь файл в памяти
+        request = service.files().export_media(
+            fileId=file_id,
+            mimeType=(GOOGLE_MIME_TYPES[drive_file['mimeType']])[0])
+        if http is not None:
+            request.http = http
+        download_media(request, target, chunk_size=chunk_size, resume=False)
+
+    else:
+        request = service.files().get_media(fileId=file_id)
+        if http is not None:
+            request.http = http
+        download_media(request, target, drive_file.get('md5Checksum'),
+                       drive_file.get('size'), chunk_size)
+
+    # Время изменения как на диске, иначе следующая выгрузка
+    # примет скачанный файл за измененный
+    if 'modifiedTime' in drive_file:
+        os.utime(target, (time.time(), parse_time(drive_file['modifiedTime'])))
+    return target
+
+
+def content_index(items):
+    """Индекс файлов на гугл диске по содержимому.
+
+    Аргументы:
+        items: Словари с информацией о файлах на диске.
+
+    Возвращает:
+        Словарь {(размер, md5Checksum): файл}. Гугл доков в нем нет.
+    """
+    return {(int(item['size']), item['md5Checksum']): item for item in items
+            if item.get('md5Checksum') is not None and 'size' in item}
+
+
+def find_copies(files, index=None):
+    """Ищет новые файлы, которые можно не выгружать, а скопировать на диске.
+
+    Хешируются только файлы, размер которых совпадает с размером
+    файла из index или другого файла из files.
+
+    Аргументы:
+        files: Словарь {ключ: (полный путь, os.stat_result)} новых файлов.
+        index: content_index файлов, которые уже есть на диске.
+
+    Возвращает:
+        Словарь {ключ: (MD5, источник)}. Источник - словарь файла на диске
+        или ключ такого же файла из files, который выгрузится сам.
+    """
+    index = index or {}
+    remote_sizes = {size for size, md5 in index}
+    by_size = {}
+    for key, (file_dir, file_stat) in files.items():
+        if file_stat.st_size >= COPY_THRESHOLD:
+            by_size.setdefault(file_stat.st_size, []).append(key)
+    candidates = sorted(key for size, keys in by_size.items()
+                        if size in remote_sizes or len(keys) > 1
+                        for key in keys)
+    digests = hash_files([files[key][0] for key in candidates])
+
+    copies, originals = {}, {}
+    for key in candidates:
+        md5 = digests[files[key][0]]
+        content = (files[key][1].st_size, md5)
+        if content in index:
+            copies[key] = (md5, index[content])
+        elif content in originals:
+            copies[key] = (md5, originals[content])
+        else:
+            originals[content] = key
+    return copies
+
+
+def upload_files(service, pool, uploads, copies=None):
+    """Выгружает новые файлы, а повторяющиеся копирует на диске.
+
+    Файлы из copies не выгружаются: когда остальные выгружены, они
+    копируются batch запросами files().copy. Если диск отказался
+    копировать (4xx), файл выгружается как обычно. После 5xx копия
+    могла и получиться, поэтому такой файл попадает в ошибки, а не
+    выгружается второй раз. Дожидается и того, что уже стояло
+    в очереди pool.
+
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        pool: UploadPool.
+        uploads: Словарь {ключ: (полный путь, метаданные, mimetype)}.
+        copies: Результат find_copies или None.
+
+    Возвращает:
+        Как UploadPool.wait: {ключ: ответ апи} и {ключ: ошибка}.
+    """
+    copies = copies or {}
+    for key, (file_dir, metadata, mimetype) in uploads.items():
+        if key not in copies:
+            pool.submit(key, file_dir, metadata, mimetype=mimetype)
+    results, errors = pool.wait()
+
+    requests, fallback = [], []
+    for key, (md5, source) in copies.items():
+        if not isinstance(source, dict):
+            # Оригинал мог не выгрузиться
+            source = results.get(source)
+        file_dir, metadata, _ = uploads[key]
+        try:
+            file_stat = os.stat(file_dir)
+        except OSError as error:
+            errors[key] = error
+            continue
+        if source is None:
+            fallback.append(key)
+            continue
+        # Время изменения, как и при выгрузке, берется с пк
+        metadata = dict(metadata, modifiedTime=format_time(file_stat.st_mtime))
+        requests.append((key, service.files().copy(
+            fileId=source['id'], body=metadata, fields=UPLOAD_FIELDS)))
+
+    copied, failed = execute_batch(service, requests)
+    results.update(copied)
+    for key, error in failed.items():
+        if error.resp.status >= 500:
+            errors[key] = error
+        else:
+            fallback.append(key)
+    for key in fallback:
+        file_dir, metadata, mimetype = uploads[key]
+        pool.submit(key, file_dir, metadata, mimetype=mimetype)
+    uploaded, upload_errors = pool.wait()
+    results.update(uploaded)
+    errors.update(upload_errors)
+    return results, errors
@@ -0,0 +1,170 @@
+import threading
+
+# Сколько соединений с гугл диском держать открытыми на процесс
+# (больше одновременных запросов ThrottledHttp все равно не пустит)
+POOL_SIZE = 16
+# Сколько секунд ждать соединения и ответа сервера
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# При этих ответах токен обновляется и запрос повторяется
+REFRESH_STATUSES = (401,)
+MAX_REFRESH_ATTEMPTS = 2
+# Как httplib2.DEFAULT_MAX_REDIRECTS
+MAX_REDIRECTS = 5
+
+_session = None
+_session_lock = threading.Lock()
+# Credentials одни на все потоки, поэтому и блокировка токена общая
+_auth_lock = threading.Lock()
+
+
+def shared_session():
+    """Возвращает общий на процесс requests.Session с пулом соединений.
+
+    Соединения переиспользуются (keep-alive) всеми потоками, поэтому
+    TLS рукопожатие делается один раз на соединение, а не на запрос.
+    Если все POOL_SIZE соединений заняты, запрос ждет свободного.
+    """
+    # requests грузится долго, поэтому импортируется, только когда нужен
+    import requests
+    import requests.adapters
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=True)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+class SessionHttp:
+    """HTTP клиент с интерфейсом httplib2.Http поверх общего пула.
+
+    Его можно отдать в build_service, execute(http=...),
+    Range запросы скачивания и resumable выгрузку, как httplib2.Http,
+    но, в отличие от него, им могут одновременно пользоваться
+    несколько потоков. Токен добавляется к каждому запросу
+    и обновляется при ответе 401.
+
+    Аргументы:
+        credentials: Credentials пользователя или None.
+        session: requests.Session, по умолчанию shared_session().
+        timeout: Пара (секунд на соединение, секунд на ответ).
+    """
+
+    def __init__(self, credentials, session=None,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        from google.auth.transport.requests import Request
+
+        self.credentials = credentials
+        self.session = session or shared_session()
+        self.timeout = timeout
+        self.auth_request = Request(self.session)
+
+    def _authorize(self, method, uri, headers):
+        """Добавляет токен в заголовки и возвращает этот токен."""
+        if self.credentials is None:
+            return None
+        # Токен обновляет только один поток, остальные его ждут
+        with _auth_lock:
+            self.credentials.before_request(
+                self.auth_request, method, uri, headers)
+            return self.credentials.token
+
+    def _refresh(self, token):
+        with _auth_lock:
+            # Пока ждали, другой поток мог уже обновить токен
+            if self.credentials.token == token:
+                self.credentials.refresh(self.auth_request)
+
+    def _send(self, method, uri, body, headers, allow_redirects,
+              stream=False):
+        """Отправляет запрос через пул, обновляя токен при ответе 401.
+
+        Возвращает:
+            requests.Response.
+        """
+        import requests
+
+        for attempt in range(MAX_REFRESH_ATTEMPTS + 1):
+            request_headers = dict(headers or {})
+            token = self._authorize(method, uri, request_headers)
+            try:
+                response = self.session.request(
+                    method, uri, data=body, headers=request_headers,
+                    timeout=self.timeout, allow_redirects=allow_redirects,
+                    stream=stream)
+            except requests.Timeout as error:
+                raise TimeoutError(str(error)) from error
+            except requests.ConnectionError as error:
+                raise ConnectionError(str(error)) from error
+
+            if (self.credentials is None
+                    or response.status_code not in REFRESH_STATUSES
+                    or attempt == MAX_REFRESH_ATTEMPTS):
+                return response
+            response.close()
+            self._refresh(token)
+
+    @staticmethod
+    def _response(response, length):
+        """Переводит заголовки ответа requests в httplib2.Response."""
+        import httplib2
+
+        info = {key.lower(): value for key, value in response.headers.items()}
+        info['status'] = str(response.status_code)
+        # requests уже распаковал gzip, как и httplib2
+        if info.pop('content-encoding', None):
+            info['content-length'] = str(length)
+        result = httplib2.Response(info)
+        result.reason = response.reason
+        return result
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=MAX_REDIRECTS, connection_type=None):
+        if hasattr(body, 'read'):
+            body = body.read()
+        # 308 у resumable выгрузки - не редирект, а "продолжай"
+        response = self._send(method, uri, body, headers,
+                              method == 'GET' and redirections > 0)
+        content = response.content
+        return self._response(response, len(content)), content
+
+    def stream(self, uri, file_io, chunk_size, headers=None):
+        """Скачивает ответ на GET запрос прямо в file_io кусками,
+        не собирая его целиком в памяти.
+
+        Аргументы:
+            uri: URI запроса.
+            file_io: Файл, куда писать тело ответа.
+            chunk_size: Сколько байт читать из соединения за раз.
+            headers: Заголовки запроса.
+
+        Возвращает:
+            Как request, но тело ответа 200 уже записано в file_io,
+            а вместо него возвращается b''.
+        """
+        import requests
+
+        with self._send('GET', uri, None, headers, True,
+                        stream=True) as response:
+            if response.status_code != 200:
+                content = response.content
+                return self._response(response, len(content)), content
+            written = 0
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    file_io.write(chunk)
+                    written += len(chunk)
+            except requests.Timeout as error:
+                raise TimeoutError(str(error)) from error
+            except requests.RequestException as error:
+                raise ConnectionError(str(error)) from error
+        return self._response(response, written), b''
+
+    def close(self):
+        """Ничего не закрывает: пул общий на весь процесс."""
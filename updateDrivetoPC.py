@@ -1,21 +1,20 @@
-import datetime
-import io
-import mimetypes
+import argparse
+import functools
 import os
-import shutil
 import time
-import hashlib
 
-from apiclient import discovery
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
 
-# Если хотим изменить права доступа, то нужно удалить файл token.json
-SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly',
-          'https://www.googleapis.com/auth/drive.file',
-          'https://www.googleapis.com/auth/drive']
+from drive_api import build_service, get_credentials, list_changes, new_http
+from driveignore import IgnoreRules
+from drive_tree import FOLDER_MIME, DriveTree, check_upload, get_tree
+from local_tree import LocalTree
+from metrics import METRICS
+from sync_engine import (PULL, build_plan, execute_plan, finish_downloads,
+                         remove_local, rename_files)
+from sync_state import SyncState
+from transfers import (DOWNLOAD_CHUNK_SIZE, DOWNLOAD_WORKERS, DownloadPool,
+                       download_file_from_gdrive)
 
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'Drive Sync'
@@ -24,319 +23,328 @@ APPLICATION_NAME = 'Drive Sync'
 FULL_PATH = r'/Users/mafed/DnD'
 DIR_NAME = 'DnD'
 
-# Карта майкросовтовских аналогов гугловских форматов
-# например, формат google docs, по сути просто веб,
-# поэтому при его выгрузке на пк не будет ничего отображаться.
-# для этого заменяем его на аналогичный от майкрософта (word .docx)
-GOOGLE_MIME_TYPES = {
-    'application/vnd.google-apps.document':
-        ['application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-         '.docx'],
-    'application/vnd.google-apps.spreadsheet':
-        ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-         '.xlsx'],
-    'application/vnd.google-apps.presentation':
-        ['application/vnd.openxmlformats-officedocument.presentationml.presentation',
-         '.pptx']
-}
-
-
-def folder_upload(service):
-    '''Выгружает папку со всем ее содержимым (если еще не выгружена)
-    в корневую папку да гугл диске
+# Поля изменений, которые нужны для инкрементальной синхронизации
+CHANGE_FIELDS = ('fileId, removed, file(id, name, parents, mimeType, '
+                 'md5Checksum, modifiedTime, size, version, trashed)')
 
-    Аргументы:
-        items: Список папок в корневом каталоге гугл диска.
-        service: Инстанс апишки гугл диска.
-
-    Возвращает:
-        Словари, где ключи - это названия папок,
-        а значения - id этих папок.
-    '''
-
-    parents_id = {}
 
-    for root, _, files in os.walk(FULL_PATH, topdown=True):
-        last_dir = root.split('/')[-1]
-        pre_last_dir = root.split('/')[-2]
-        if pre_last_dir not in parents_id.keys():
-            pre_last_dir = []
-        else:
-            pre_last_dir = parents_id[pre_last_dir]
-
-        folder_metadata = {'name': last_dir,
-                           'parents': [pre_last_dir],
-                           'mimeType': 'application/vnd.google-apps.folder'}
-        create_folder = service.files().create(body=folder_metadata,
-                                               fields='id').execute()
-        folder_id = create_folder.get('id', [])
-
-        for name in files:
-            file_metadata = {'name': name, 'parents': [folder_id]}
-            media = MediaFileUpload(
-                os.path.join(root, name),
-                mimetype=mimetypes.MimeTypes().guess_type(name)[0])
-            service.files().create(body=file_metadata,
-                                   media_body=media,
-                                   fields='id').execute()
-
-        parents_id[last_dir] = folder_id
-
-    return parents_id
+def parent_path(state, drive_file, removed=()):
+    """Возвращает относительный путь до родительской папки объекта
+    или None, если она не входит в синхронизируемую папку
+    или удалена (ее ID в removed).
+    """
+    for parent in drive_file.get('parents', []):
+        if parent in removed:
+            continue
+        path, is_folder = state.path_of(parent)
+        if is_folder:
+            return path
+    return None
 
 
-def check_upload(service):
-    """Проверяет, выгружена ли папка на диск,
-    и если нет, то выгружает.
+def move_file(state, var, old_path, rel_path, drive_file):
+    """Переносит файл на пк вслед за переносом или переименованием
+    на диске, если содержимое не поменялось ни там, ни там.
 
     Аргументы:
-        service: Инстанс апишки гугл диска.
+        state: SyncState.
+        var: Полный путь до папки, в которой лежит папка синхронизации.
+        old_path: Где файл лежал (относительный путь).
+        rel_path: Куда его перенесли на диске.
+        drive_file: Словарь с информацией о файле на гугл диске.
 
     Возвращает:
-        ID выгруженной папки, полный путь до этой папки на пк.
-
+        True, если файл перенесен и скачивать его не нужно.
     """
+    known = state.get(old_path)
+    old_file, new_file = os.path.join(var, old_path), os.path.join(var, rel_path)
+    if (known is None or known['drive_md5'] is None
+            or known['drive_md5'] != drive_file.get('md5Checksum')
+            or not os.path.exists(old_file) or os.path.exists(new_file)
+            or not state.stat_matches(known, os.stat(old_file))):
+        return False
+    os.makedirs(os.path.dirname(new_file), exist_ok=True)
+    os.rename(old_file, new_file)
+    state.forget(old_path)
+    state.put(rel_path, os.stat(new_file), known['md5'], drive_file)
+    return True
+
+
+def drop_removed(state, var, path, removed):
+    """Удаляет с пк объект по пути path, если на диске его удалили.
+
+    Удаления применяются после переносов, но если на место удаленного
+    объекта переносят или создают другой, место нужно освободить сразу.
 
-    results = service.files().list(
-        pageSize=100,
-        q="'root' in parents and trashed != True and \
-        mimeType='application/vnd.google-apps.folder'").execute()
-
-    items = results.get('files', [])
+    Аргументы:
+        state: SyncState.
+        var: Полный путь до папки, в которой лежит папка синхронизации.
+        path: Относительный путь, который нужно освободить.
+        removed: Множество ID объектов, удаленных на диске.
+    """
+    known = state.get(path)
+    drive_id = state.folder_id(path) if known is None else known['drive_id']
+    if drive_id in removed:
+        remove_local(os.path.join(var, path), known is None)
+        state.forget(path)
 
-    # Проверяем, существует ли папка, и, если да, то создаем ее и получаем ее ID
-    if DIR_NAME in [item['name'] for item in items]:
-        folder_id = [item['id'] for item in items
-                     if item['name'] == DIR_NAME][0]
-    else:
-        parents_id = folder_upload(service)
-        folder_id = parents_id[DIR_NAME]
 
-    return folder_id, FULL_PATH
+def pull_changes(service, state, full_path, pool, ignore=None):
+    """Применяет к папке на пк только изменения с прошлой синхронизации.
 
+    Берет курсор из базы состояния, получает через changes().list
+    все изменения после него и переносит на пк только те,
+    что касаются синхронизируемой папки. Сначала переносятся
+    папки и файлы, потом применяются удаления: файл могли вынести
+    из папки, которую затем удалили, и тогда его нужно перенести
+    на пк, а не скачать заново.
 
-def get_credentials():
-    """Получает credentials пользователя из файла (или создает его, если нет).
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        state: SyncState.
+        full_path: Полный путь до папки на пк.
+        pool: DownloadPool для скачивания файлов.
+        ignore: IgnoreRules, изменения в которых пропускаются.
 
     Возвращает:
-        Credentials, полученный credential.
+        True, если изменения применены, и False, если курсора нет,
+        он устарел или папку на пк нельзя перенести вслед за диском
+        и нужно обойти все дерево.
     """
-
-    creds = None
-
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+    page_token = state.get_meta('start_page_token')
+    if page_token is None:
+        return False
+
+    try:
+        changes, new_token = list_changes(service, page_token, CHANGE_FIELDS)
+    except HttpError as error:
+        # Курсор устарел
+        if error.resp.status in (400, 404, 410):
+            return False
+        raise
+
+    var = os.path.dirname(full_path)
+    root_id = state.get_meta('root_id')
+    removed, folders, files, renames, missing = set(), [], [], [], []
+    downloads = {}
+
+    for change in changes:
+        drive_file = change.get('file')
+        if change['fileId'] == root_id:
+            continue
+        if (change.get('removed') or drive_file is None
+                or drive_file.get('trashed')):
+            removed.add(change['fileId'])
+        elif drive_file['mimeType'] == FOLDER_MIME:
+            folders.append(drive_file)
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
-            )
-            creds = flow.run_local_server(port=0)
-        # Сохраняем credentials для будущих запусков
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
-    return creds
-
-
-def get_tree(folder_name, tree_list, root, parents_id, service):
-    """Получает относительный путь до папка.
-
-        Рекурсивно идет по подкаталогам и запоминает их ID и имена.
-
-        Аргументы:
-            folder_name: Название папки, изначально строка с именем родительской папки
-            folder_id: ID папки, изнчально ID родительской папки.
-            tree_list: список относительных путей до папой, изначально пустой список
-            root: Относительный путь до текущей папки, изначально пустая строка.
-            parents_id: Словарь со следующей парой {ключ:значение}
-            {folder's name: ID папки на гугл диске}, изначально пустой словарь.
-            service: Инстанс апишки Гугл Диска.
-
-        Возвращает:
-           Список относительных путей папок.
-
-        """
-    folder_id = parents_id[folder_name]
-
-    results = service.files().list(
-        pageSize=100,
-        q=("%r in parents and \
-        mimeType = 'application/vnd.google-apps.folder'and \
-        trashed != True" % folder_id)).execute()
-
-    items = results.get('files', [])
-    root += folder_name + os.path.sep
-
-    for item in items:
-        parents_id[item['name']] = item['id']
-        tree_list.append(root + item['name'])
-        folder_id = [i['id'] for i in items
-                     if i['name'] == item['name']][0]
-        folder_name = item['name']
-        get_tree(folder_name, tree_list,
-                 root, parents_id, service)
-
-
-def download_file_from_gdrive(file_path, drive_file, service):
-    """Скачивает файлы из гугл диска.
+            files.append(drive_file)
+
+    # Создаем, переименовываем и переносим папки.
+    # Родитель может прийти в этом же списке, поэтому ходим по кругу,
+    # пока у оставшихся папок находятся родители
+    while folders:
+        rest = []
+        for drive_file in folders:
+            parent_dir = parent_path(state, drive_file, removed)
+            if parent_dir is None:
+                rest.append(drive_file)
+                continue
+
+            folder_dir = os.path.join(parent_dir, drive_file['name'])
+            if ignore and ignore.match(folder_dir, True):
+                continue
+            old_dir, _ = state.path_of(drive_file['id'])
+            if old_dir != folder_dir:
+                drop_removed(state, var, folder_dir, removed)
+            if old_dir is not None and old_dir != folder_dir:
+                old_full = os.path.join(var, old_dir)
+                new_full = os.path.join(var, folder_dir)
+                if not os.path.isdir(old_full):
+                    # Папку на пк удалили или перенесли, скачиваем заново
+                    state.forget(old_dir)
+                    os.makedirs(new_full, exist_ok=True)
+                    state.put_folder(folder_dir, drive_file['id'])
+                    missing.append((folder_dir, drive_file['id']))
+                    continue
+                try:
+                    os.rename(old_full, new_full)
+                except OSError:
+                    # На этом месте на пк уже что-то есть
+                    return False
+                state.move(old_dir, folder_dir)
+            elif old_dir is None:
+                os.makedirs(os.path.join(var, folder_dir), exist_ok=True)
+                state.put_folder(folder_dir, drive_file['id'])
+
+        if len(rest) == len(folders):
+            break
+        folders = rest
+
+    # Содержимое папок, которых не оказалось на пк
+    for folder_dir, folder_id in missing:
+        subtree = get_tree(folder_dir, folder_id, service, ignore)
+        for path in [folder_dir] + subtree.folders():
+            os.makedirs(os.path.join(var, path), exist_ok=True)
+            state.put_folder(path, subtree.id_of(path))
+            for item in subtree.files(path):
+                downloads[item['id']] = (path, item)
+
+    # Переносим файлы и собираем новые и изменившиеся
+    for drive_file in files:
+        folder_dir = parent_path(state, drive_file, removed)
+        old_path, _ = state.path_of(drive_file['id'])
+
+        if folder_dir is None:
+            if old_path is not None:
+                remove_local(os.path.join(var, old_path), False)
+                state.forget(old_path)
+            continue
+
+        rel_path = os.path.join(folder_dir, drive_file['name'])
+        if ignore and ignore.match(rel_path):
+            continue
+        if old_path != rel_path:
+            drop_removed(state, var, rel_path, removed)
+        known = state.get(rel_path)
+        if old_path is not None and old_path != rel_path:
+            if move_file(state, var, old_path, rel_path, drive_file):
+                continue
+            remove_local(os.path.join(var, old_path), False)
+            state.forget(old_path)
+        elif not state.drive_changed(known, drive_file):
+            # Это изменение мы уже видели (например, сами его выгрузили)
+            continue
+
+        downloads[drive_file['id']] = (folder_dir, drive_file)
+
+    # Удаляем то, что удалили на диске, и папки, которые перенесли
+    # за пределы синхронизируемой
+    for file_id in removed | {item['id'] for item in folders}:
+        path, is_folder = state.path_of(file_id)
+        if path is not None:
+            remove_local(os.path.join(var, path), is_folder)
+            state.forget(path)
+
+    # Скачиваем новые и изменившиеся файлы
+    for file_id, (folder_dir, drive_file) in downloads.items():
+        pool.submit(file_id, download_file_from_gdrive,
+                    os.path.join(var, folder_dir), drive_file, service,
+                    renames)
+
+    failed = finish_downloads(pool, downloads, state)
+    rename_files(service, renames, state)
+    # Курсор двигаем, только если все получилось, иначе
+    # в следующий раз эти изменения применятся еще раз
+    if not failed:
+        state.set_meta('start_page_token', new_token)
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Синхронизирует папку на гугл диске с папкой на пк.')
+    parser.add_argument('--full', action='store_true',
+                        help='обойти все дерево, а не только изменения '
+                             'с прошлой синхронизации')
+    parser.add_argument('--workers', type=int, default=DOWNLOAD_WORKERS,
+                        help='сколько файлов скачивать одновременно')
+    parser.add_argument('--chunk-size', type=int,
+                        default=DOWNLOAD_CHUNK_SIZE // (1024 * 1024),
+                        help='размер куска при скачивании в МБ')
+    parser.add_argument('--profile', action='store_true',
+                        help='вывести время по этапам синхронизации')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='только показать, что будет сделано')
+    return parser.parse_args()
+
+
+def main(full=False, workers=DOWNLOAD_WORKERS,
+         chunk_size=DOWNLOAD_CHUNK_SIZE, profile=False, dry_run=False):
+    """Синхронизирует папку на диске с папкой на компе.
 
-    Если файл в формате гугл доков, тогда загружаем его
-    с соответствующим не гугловским форматом
+    Если есть курсор с прошлого запуска, применяет только изменения
+    после него. Иначе сравнивает обе папки, составляет план
+    (см. build_plan) и выполняет его: скачивает новые файлы
+    и подкаталоги, удаляет старые файлы с пк и обновляет существующие
 
     Аргументы:
-        path: Строка директории, где будут сохраняться файлы
-        file: Словарь с информацией об объекте, включающий
-        его имя, ID и mimeType.
-        service: Инстанс API.
+        full: Всегда обходить все дерево.
+        workers: Сколько файлов скачивать одновременно.
+        chunk_size: Размер куска при скачивании в байтах.
+        profile: Вывести в конце время по этапам.
+        dry_run: Только напечатать план полной синхронизации,
+        ничего не меняя.
     """
-    file_id = drive_file['id']
-    file_name = drive_file['name']
-    if drive_file['mimeType'] in GOOGLE_MIME_TYPES.keys():
-        if file_name.endswith(GOOGLE_MIME_TYPES[drive_file['mimeType']][1]):
-            file_name = drive_file['name']
+    start = time.perf_counter()
+    credentials = get_credentials()
+    service = build_service(new_http(credentials))
+    http_factory = functools.partial(new_http, credentials)
+    state = SyncState()
+    pool = DownloadPool(http_factory, workers, chunk_size)
+
+    # Изменения по курсору применяются сразу, поэтому в --dry-run
+    # всегда показывается план полной синхронизации
+    if not full and not dry_run:
+        with METRICS.phase('changes'):
+            pulled = pull_changes(service, state, FULL_PATH, pool,
+                                  IgnoreRules.load(FULL_PATH))
+        if pulled:
+            pool.close()
+            state.close()
+            METRICS.add_phase('total', time.perf_counter() - start)
+            METRICS.write(profile=profile)
+            return
+
+    # Курсор берем до обхода дерева, чтобы не пропустить то,
+    # что поменяется на диске во время синхронизации
+    if not dry_run:
+        start_token = service.changes().getStartPageToken().execute()
+        start_token = start_token['startPageToken']
+
+    # Получаем ID папки на гугл диске и путь до нее
+    with METRICS.phase('list'):
+        # Размер куска скачивания может быть не кратен 256 КБ,
+        # поэтому выгрузка берет только число потоков
+        full_path = FULL_PATH
+        folder_id = check_upload(service, full_path, http_factory,
+                                 not dry_run, state, workers)
+        folder_name = full_path.split(os.path.sep)[-1]
+        ignore = IgnoreRules.load(full_path)
+        if folder_id is None:
+            tree = DriveTree(folder_name, None)
         else:
-            file_name = '{}{}'.format(
-                drive_file['name'],
-                GOOGLE_MIME_TYPES[drive_file['mimeType']][1])
-            service.files().update(fileId=file_id,
-                                   body={'name': file_name}).execute()
-
-        request = service.files().export(
-            fileId=file_id,
-            mimeType=(GOOGLE_MIME_TYPES[drive_file['mimeType']])[0]).execute()
-        with io.FileIO(os.path.join(file_path, file_name), 'wb') as file_write:
-            file_write.write(request)
-
-    else:
-        request = service.files().get_media(fileId=file_id)
-        file_io = io.FileIO(os.path.join(file_path, drive_file['name']), 'wb')
-        downloader = MediaIoBaseDownload(file_io, request)
-        done = False
-        while done is False:
-            _, done = downloader.next_chunk()
-
-
-def by_lines(input_str):
-    """Сортирует элементы по кол-ву слэшей.
+            tree = get_tree(folder_name, folder_id, service, ignore)
 
-    Возвращает:
-        Количество слэшей в виде str.
-    """
-    return input_str.count(os.path.sep)
+    # Папки и файлы на компъютере за один проход
+    with METRICS.phase('scan'):
+        local = LocalTree(full_path, ignore)
 
+    with METRICS.phase('plan'):
+        plan = build_plan(local, tree, state, PULL)
+    if dry_run:
+        print(plan.report())
+        pool.close()
+        state.close()
+        return
 
-def main():
-    """Синхронизирует папку на диске с папкой на компе.
+    failed = execute_plan(plan, service, state, tree, local.base_path,
+                          download_pool=pool)
+    pool.close()
 
-    Проверяет наличие файлов, выгружает новые файлы и подкаталоги,
-    удаляет старые файлы с пк и обновляет существующие
-    """
-    credentials = get_credentials()
-    service = discovery.build('drive', 'v3', credentials=credentials)
+    state.set_meta('root_id', folder_id)
+    # С непрошедшими файлами курсор остается старым, и следующий
+    # запуск их повторит
+    if not failed:
+        state.set_meta('start_page_token', start_token)
+    state.close()
 
-    # Получаем ID папки на гугл диске и путь до нее
-    folder_id, full_path = check_upload(service)
-    folder_name = full_path.split(os.path.sep)[-1]
-    tree_list, root, parents_id = [], '', {}
-
-    parents_id[folder_name] = folder_id
-    get_tree(folder_name, tree_list, root, parents_id, service)
-    os_tree_list = []
-    root_len = len(full_path.split(os.path.sep)[0:-2])
-
-    # Получаем список папок на компъютере
-    for root, dirs, files in os.walk(full_path, topdown=True):
-        for name in dirs:
-            var_path = (os.path.sep).join(
-                root.split(os.path.sep)[root_len + 1:])
-            os_tree_list.append(os.path.join(var_path, name))
-
-    # новые папки на диске
-    download_folders = list(set(tree_list).difference(set(os_tree_list)))
-    # старые папки на диске
-    remove_folders = list(set(os_tree_list).difference(set(tree_list)))
-    # совпадающие папки
-    exact_folders = list(set(os_tree_list).intersection(set(tree_list)))
-
-    exact_folders.append(folder_name)
-
-    var = (os.path.sep).join(full_path.split(os.path.sep)[0:-1]) + os.path.sep
-
-    # Скачиваем файлы с диска
-    download_folders = sorted(download_folders, key=by_lines)
-
-    for folder_dir in download_folders:
-        variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-
-        folder_id = parents_id[last_dir]
-        results = service.files().list(
-            pageSize=20, q=('%r in parents' % folder_id)).execute()
-
-        items = results.get('files', [])
-        os.makedirs(variable)
-        files = [f for f in items
-                 if f['mimeType'] != 'application/vnd.google-apps.folder']
-
-        for drive_file in files:
-            download_file_from_gdrive(variable, drive_file, service)
-
-    # Проверяем файлы в существующих папках и обновляем, если нужно
-    for folder_dir in exact_folders:
-        variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-        os_files = [f for f in os.listdir(variable)
-                    if os.path.isfile(os.path.join(variable, f))]
-        folder_id = parents_id[last_dir]
-
-        results = service.files().list(
-            pageSize=1000,
-            q=('%r in parents and \
-            mimeType!="application/vnd.google-apps.folder"' % folder_id),
-            fields="files(id, name, mimeType, \
-                modifiedTime, md5Checksum)").execute()
-
-        items = results.get('files', [])
-
-        refresh_files = [f for f in items if f['name'] in os_files]
-        upload_files = [f for f in items if f['name'] not in os_files]
-        remove_files = [f for f in os_files
-                        if f not in [j['name'] for j in items]]
-
-        for drive_file in refresh_files:
-            file_dir = os.path.join(variable, drive_file['name'])
-            file_time = os.path.getmtime(file_dir)
-            mtime = datetime.datetime.strptime(drive_file['modifiedTime'][:-2],
-                                               "%Y-%m-%dT%H:%M:%S.%f")
-            drive_time = time.mktime(mtime.timetuple())
-
-            file_dir = os.path.join(variable, drive_file['name'])
-            os_file_md5 = hashlib.md5(open(file_dir, 'rb').read()).hexdigest()
-            if 'md5Checksum' in drive_file.keys():
-                drive_md5 = drive_file['md5Checksum']
-            else:
-                drive_md5 = None
-
-            if (file_time < drive_time) or (drive_md5 != os_file_md5):
-                os.remove(os.path.join(variable, drive_file['name']))
-                download_file_from_gdrive(variable, drive_file, service)
-
-        for os_file in remove_files:
-            os.remove(os.path.join(variable, os_file))
-
-        for drive_file in upload_files:
-            download_file_from_gdrive(variable, drive_file, service)
-
-    # Удаляем старые папки с компъютера
-    remove_folders = sorted(remove_folders, key=by_lines, reverse=True)
-
-    for folder_dir in remove_folders:
-        variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-        shutil.rmtree(variable)
+    METRICS.add_phase('total', time.perf_counter() - start)
+    METRICS.write(profile=profile)
 
 
 if __name__ == '__main__':
-    main()
+    args = parse_args()
+    main(full=args.full, workers=args.workers,
+         chunk_size=args.chunk_size * 1024 * 1024, profile=args.profile,
+         dry_run=args.dry_run)
@@ -1,19 +1,20 @@
-import datetime
-import hashlib
+import argparse
+import functools
 import mimetypes
-import time
 import os
+import time
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from apiclient import discovery
-from googleapiclient.http import MediaFileUpload
+from drive_api import build_service, execute_batch, get_credentials, new_http
+from driveignore import IgnoreRules
+from drive_tree import FOLDER_MIME, DriveTree, check_upload, get_tree
+from hashing import hash_files
+from local_tree import LocalTree
+from metrics import METRICS
+from sync_engine import PUSH, build_plan, execute_plan
+from sync_state import SyncState
+from transfers import UPLOAD_CHUNK_SIZE, UPLOAD_WORKERS, UploadPool
+from watcher import DEBOUNCE, RECONCILE_EVERY, InotifyWatcher, watch_loop
 
-# Если хотим изменить права доступа, то нужно удалить файл token.json
-SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly',
-          'https://www.googleapis.com/auth/drive.file',
-          'https://www.googleapis.com/auth/drive']
 CLIENT_SECRET_FILE = 'credentials.json'
 APPLICATION_NAME = 'Drive Sync'
 
@@ -22,305 +23,310 @@ FULL_PATH = r'/Users/mafed/DnD'
 DIR_NAME = 'DnD'
 
 
-def folder_upload(service):
-    '''Выгружает папку со всем ее содержимым (если еще не выгружена)
-    в корневую папку да гугл диске
-
-    Аргументы:
-        items: Список папок в корневом каталоге гугл диска.
-        service: Инстанс апишки гугл диска.
+def by_lines(input_str):
+    """Сортирует элементы по кол-ву слэшей.
 
     Возвращает:
-        Словари, где ключи - это названия папок,
-        а значения - id этих папок.
-    '''
-
-    parents_id = {}
-
-    for root, _, files in os.walk(FULL_PATH, topdown=True):
-        last_dir = root.split('/')[-1]
-        pre_last_dir = root.split('/')[-2]
-        if pre_last_dir not in parents_id.keys():
-            pre_last_dir = []
-        else:
-            pre_last_dir = parents_id[pre_last_dir]
-
-        folder_metadata = {'name': last_dir,
-                           'parents': [pre_last_dir],
-                           'mimeType': 'application/vnd.google-apps.folder'}
-        create_folder = service.files().create(body=folder_metadata,
-                                               fields='id').execute()
-        folder_id = create_folder.get('id', [])
-
-        for name in files:
-            file_metadata = {'name': name, 'parents': [folder_id]}
-            media = MediaFileUpload(
-                os.path.join(root, name),
-                mimetype=mimetypes.MimeTypes().guess_type(name)[0])
-            service.files().create(body=file_metadata,
-                                   media_body=media,
-                                   fields='id').execute()
-
-        parents_id[last_dir] = folder_id
+        Количество слэшей в виде str.
+    """
+    return input_str.count(os.path.sep)
 
-    return parents_id
 
+def push_moves(service, state, var, paths, ignore=None):
+    """Переносит на диске то, что переименовали или перенесли на пк.
 
-def check_upload(service):
-    """Проверяет, выгружена ли папка на диск,
-    и если нет, то выгружает.
+    Новый файл считается перенесенным, если в базе есть пропавший
+    файл с тем же inode, размером и временем изменения. Если вместе
+    с ним пропала и появилась вся папка, переносится сама папка.
 
     Аргументы:
         service: Инстанс апишки гугл диска.
-
-    Возвращает:
-        ID выгруженной папки, полный путь до этой папки на пк.
-
+        state: SyncState.
+        var: Полный путь до папки, в которой лежит папка синхронизации.
+        paths: Относительные пути, которые поменялись.
+        ignore: IgnoreRules или None.
     """
+    appeared = {rel_path for rel_path in paths
+                if os.path.isdir(os.path.join(var, rel_path))
+                and state.folder_id(rel_path) is None}
+
+    moves = {}
+    for rel_path in paths:
+        local_path = os.path.join(var, rel_path)
+        if (not os.path.isfile(local_path) or state.get(rel_path) is not None
+                or (ignore and ignore.match(rel_path))):
+            continue
+        file_stat = os.stat(local_path)
+        for known in state.by_inode(file_stat.st_ino):
+            old, new = known['path'], rel_path
+            if (not state.stat_matches(known, file_stat)
+                    or os.path.exists(os.path.join(var, old))):
+                continue
+            # Поднимаемся, пока вместе с файлом перенесена и его папка
+            while (os.path.basename(old) == os.path.basename(new)
+                   and os.path.dirname(new) in appeared
+                   and state.folder_id(os.path.dirname(old)) is not None
+                   and not os.path.exists(
+                       os.path.join(var, os.path.dirname(old)))):
+                old, new = os.path.dirname(old), os.path.dirname(new)
+            moves[old] = new
+            break
+
+    # Папки раньше вложенных в них файлов, уровень за уровнем
+    levels, done = {}, {}
+    for old, new in moves.items():
+        levels.setdefault(by_lines(new), []).append((old, new))
+    for depth in sorted(levels):
+        requests = []
+        for old, new in levels[depth]:
+            # Папку, в которой лежал объект, могли уже перенести
+            for moved_old, moved_new in done.items():
+                if old.startswith(moved_old + os.path.sep):
+                    old = moved_new + old[len(moved_old):]
+            if old == new:
+                continue
+            known = state.get(old)
+            drive_id = state.folder_id(old) or (
+                known['drive_id'] if known is not None else None)
+            old_parent = state.folder_id(os.path.dirname(old))
+            new_parent = state.folder_id(os.path.dirname(new))
+            if drive_id is None or new_parent is None:
+                continue
+            parents = {}
+            if old_parent != new_parent:
+                parents = {'addParents': new_parent,
+                           'removeParents': old_parent}
+            requests.append(((old, new), service.files().update(
+                fileId=drive_id, body={'name': os.path.basename(new)},
+                fields='id, modifiedTime, version', **parents)))
+
+        results, errors = execute_batch(service, requests)
+        for (old, new), drive_file in results.items():
+            state.move(old, new)
+            if state.folder_id(new) is None:
+                state.update_drive(drive_file)
+            done[old] = new
+        for (old, new), error in errors.items():
+            print(f"Не удалось перенести {old}: {error}")
+
+
+def push_paths(service, state, full_path, paths, pool, ignore=None):
+    """Выгружает на диск только перечисленные пути, без обхода дерева.
+
+    ID папок и файлов на диске берутся из базы состояния, поэтому
+    папка должна быть уже хоть раз синхронизирована через main.
 
-    results = service.files().list(
-        pageSize=100,
-        q="'root' in parents and trashed != True and \
-        mimeType='application/vnd.google-apps.folder'").execute()
-
-    items = results.get('files', [])
-
-    # Проверяем, существует ли папка, и, если да, то создаем ее и получаем ее ID
-    if DIR_NAME in [item['name'] for item in items]:
-        folder_id = [item['id'] for item in items
-                     if item['name'] == DIR_NAME][0]
-    else:
-        parents_id = folder_upload(service)
-        folder_id = parents_id[DIR_NAME]
-
-    return folder_id, FULL_PATH
-
-
-def get_credentials():
-    """Получает credentials пользователя из файла (или создает его, если нет).
-
-    Возвращает:
-        Credentials, полученный credential.
+    Аргументы:
+        service: Инстанс апишки гугл диска.
+        state: SyncState.
+        full_path: Полный путь до папки на пк.
+        paths: Относительные пути (вида DnD/a/x.txt), которые поменялись.
+        pool: UploadPool для выгрузки файлов.
+        ignore: IgnoreRules или None.
     """
-    creds = None
+    var = os.path.dirname(full_path.rstrip(os.path.sep))
+    uploads, changed, delete_requests = {}, [], []
+
+    # Переименованное и перенесенное не удаляем и не выгружаем заново
+    push_moves(service, state, var, paths, ignore)
+
+    # Родительские папки раньше вложенных
+    for rel_path in sorted(set(paths), key=by_lines):
+        local_path = os.path.join(var, rel_path)
+        is_dir = os.path.isdir(local_path)
+        if ignore and ignore.match(rel_path, is_dir):
+            continue
+
+        if is_dir:
+            parent_id = state.folder_id(os.path.dirname(rel_path))
+            if state.folder_id(rel_path) is None and parent_id is not None:
+                created = service.files().create(
+                    body={'name': os.path.basename(rel_path),
+                          'parents': [parent_id],
+                          'mimeType': FOLDER_MIME},
+                    fields='id').execute()
+                state.put_folder(rel_path, created['id'])
+
+        elif os.path.isfile(local_path):
+            file_stat = os.stat(local_path)
+            known = state.get(rel_path)
+            if not state.stat_matches(known, file_stat):
+                changed.append((rel_path, local_path, file_stat, known))
 
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
-            )
-            creds = flow.run_local_server(port=0)
-        # Сохраняем credentials для будущих запусков
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
-    return creds
+            # Путь удалили (или перенесли) на пк
+            known = state.get(rel_path)
+            drive_id = state.folder_id(rel_path) or (
+                known['drive_id'] if known is not None else None)
+            if drive_id is not None:
+                delete_requests.append((rel_path, service.files().delete(
+                    fileId=drive_id)))
+
+    # Файлы, у которых поменялся только stat, заново не выгружаем
+    hashes = hash_files([local_path for _, local_path, file_stat, known
+                         in changed if known is not None
+                         and known['size'] == file_stat.st_size])
+    for rel_path, local_path, file_stat, known in changed:
+        if known is not None and hashes.get(local_path) == known['drive_md5']:
+            state.put(rel_path, file_stat, known['drive_md5'],
+                      {'id': known['drive_id'],
+                       'md5Checksum': known['drive_md5'],
+                       'modifiedTime': known['drive_modified'],
+                       'version': known['drive_version']})
+            continue
+
+        mimetype = mimetypes.MimeTypes().guess_type(local_path)[0]
+        if known is not None:
+            pool.submit(rel_path, local_path, None,
+                        file_id=known['drive_id'], mimetype=mimetype)
+        else:
+            parent_id = state.folder_id(os.path.dirname(rel_path))
+            if parent_id is None:
+                continue
+            pool.submit(rel_path, local_path,
+                        {'name': os.path.basename(rel_path),
+                         'parents': [parent_id]}, mimetype=mimetype)
+        uploads[rel_path] = file_stat
+
+    results, errors = pool.wait()
+    for rel_path, drive_file in results.items():
+        state.put(rel_path, uploads[rel_path],
+                  drive_file.get('md5Checksum'), drive_file)
+    for rel_path, error in errors.items():
+        print(f"Не удалось выгрузить {rel_path}: {error}")
+
+    results, errors = execute_batch(service, delete_requests)
+    for rel_path in results:
+        state.forget(rel_path)
+    for rel_path, error in errors.items():
+        if error.resp.status == 404:
+            state.forget(rel_path)
+        else:
+            print(f"Не удалось удалить {rel_path}: {error}")
+    state.commit()
 
 
-def get_tree(folder_name, tree_list, root, parents_id, service):
-    """Получает относительный путь до папка.
+def watch(workers=UPLOAD_WORKERS, chunk_size=UPLOAD_CHUNK_SIZE,
+          debounce=DEBOUNCE, interval=RECONCILE_EVERY, watcher=None,
+          clock=time.monotonic, should_stop=lambda: False):
+    """Следит за папкой на пк и сразу выгружает изменения на диск.
 
-    Рекурсивно идет по подкаталогам и запоминает их ID и имена.
+    Сначала делает полную синхронизацию (main), потом выгружает только
+    те пути, о которых сообщил watcher, а раз в interval секунд
+    снова делает полную сверку на случай пропущенных событий.
 
     Аргументы:
-        folder_name: Название папки, изначально строка с именем родительской папки
-        folder_id: ID папки, изнчально ID родительской папки.
-        tree_list: список относительных путей до папой, изначально пустой список
-        root: Относительный путь до текущей папки, изначально пустая строка.
-        parents_id: Словарь со следующей парой {ключ:значение}
-        {folder's name: ID папки на гугл диске}, изначально пустой словарь.
-        service: Инстанс апишки Гугл Диска.
-
-    Возвращает:
-       Список относительных путей папок.
-
+        workers: Сколько файлов выгружать одновременно.
+        chunk_size: Размер куска выгрузки больших файлов в байтах.
+        debounce: Сколько секунд тишины ждать перед выгрузкой.
+        interval: Как часто делать полную сверку, в секундах.
+        watcher: Источник событий, по умолчанию InotifyWatcher.
+        clock: Функция, возвращающая текущее время в секундах.
+        should_stop: Функция, по которой наблюдение завершается.
     """
-    folder_id = parents_id[folder_name]
-
-    results = service.files().list(
-        pageSize=1000,
-        q=("%r in parents and \
-        mimeType = 'application/vnd.google-apps.folder'and \
-        trashed != True" % folder_id)).execute()
-
-    items = results.get('files', [])
-    root += folder_name + os.path.sep
-
-    for item in items:
-        parents_id[item['name']] = item['id']
-        tree_list.append(root + item['name'])
-        folder_id = [i['id'] for i in items
-                     if i['name'] == item['name']][0]
-        folder_name = item['name']
-        get_tree(folder_name, tree_list,
-                 root, parents_id, service)
+    main(workers, chunk_size)
 
+    credentials = get_credentials()
+    service = build_service(new_http(credentials))
+    ignore = IgnoreRules.load(FULL_PATH)
+    if watcher is None:
+        watcher = InotifyWatcher(FULL_PATH, ignore)
+
+    with SyncState() as state, UploadPool(
+            service, functools.partial(new_http, credentials), workers,
+            state, chunk_size) as pool:
+        watch_loop(watcher,
+                   lambda paths: push_paths(service, state, FULL_PATH, paths,
+                                            pool, ignore),
+                   lambda: main(workers, chunk_size),
+                   debounce=debounce, reconcile_every=interval,
+                   clock=clock, should_stop=should_stop)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Синхронизирует папку на пк с папкой на гугл диске.')
+    parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS,
+                        help='сколько файлов выгружать одновременно')
+    parser.add_argument('--chunk-size', type=int,
+                        default=UPLOAD_CHUNK_SIZE // (1024 * 1024),
+                        help='размер куска выгрузки больших файлов в МБ')
+    parser.add_argument('--watch', action='store_true',
+                        help='не завершаться, а следить за папкой '
+                             'и выгружать изменения сразу')
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE,
+                        help='сколько секунд ждать после последнего '
+                             'изменения перед выгрузкой')
+    parser.add_argument('--interval', type=float, default=RECONCILE_EVERY,
+                        help='как часто в режиме наблюдения делать '
+                             'полную сверку, в секундах')
+    parser.add_argument('--profile', action='store_true',
+                        help='вывести время по этапам синхронизации')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='только показать, что будет сделано')
+    return parser.parse_args()
+
+
+def main(workers=UPLOAD_WORKERS, chunk_size=UPLOAD_CHUNK_SIZE, profile=False,
+         dry_run=False):
+    """Синхронизирует папку на компе с папкой в гугл драйве.
 
-def by_lines(input_str):
-    """Сортирует элементы по кол-ву слэшей.
+    Сравнивает обе папки и базу прошлой синхронизации, составляет
+    план (см. build_plan) и выполняет его: выгружает новые файлы
+    и подкаталоги, удаляет старые файлы из гугл драйва и обновляет
+    существующие
 
-    Возвращает:
-        Количество слэшей в виде str.
+    Аргументы:
+        workers: Сколько файлов выгружать одновременно.
+        chunk_size: Размер куска выгрузки больших файлов в байтах.
+        profile: Вывести в конце время по этапам.
+        dry_run: Только напечатать план, ничего не меняя.
     """
-    return input_str.count(os.path.sep)
+    start = time.perf_counter()
+    credentials = get_credentials()
+    service = build_service(new_http(credentials))
+    http_factory = functools.partial(new_http, credentials)
+    state = SyncState()
 
+    # Получаем ID папки и путь до нее
+    with METRICS.phase('list'):
+        full_path = FULL_PATH
+        folder_id = check_upload(service, full_path, http_factory,
+                                 not dry_run, state, workers, chunk_size)
+        folder_name = full_path.split(os.path.sep)[-1]
+        ignore = IgnoreRules.load(full_path)
+        if folder_id is None:
+            # Папки на диске еще нет, а создавать ее нельзя
+            tree = DriveTree(folder_name, None)
+        else:
+            tree = get_tree(folder_name, folder_id, service, ignore)
 
-def main():
-    """Синхронизирует папку на компе с папкой в гугл драйве.
+    # Папки и файлы на компъютере за один проход
+    with METRICS.phase('scan'):
+        local = LocalTree(full_path, ignore)
 
-    Проверяет наличие файлов, выгружает новые файлы и подкаталоги,
-    удаляет старые файлы из гугл драйва и обновляет существующие
-    """
-    credentials = get_credentials()
-    service = discovery.build('drive', 'v3', credentials=credentials)
+    with METRICS.phase('plan'):
+        plan = build_plan(local, tree, state, PUSH)
+    if dry_run:
+        print(plan.report())
+        state.close()
+        return
 
-    # Получаем ID папки и путь до нее
-    folder_id, full_path = check_upload(service)
-    folder_name = full_path.split(os.path.sep)[-1]
-    tree_list = []
-    root = ''
-    parents_id = {}
-
-    parents_id[folder_name] = folder_id
-    get_tree(folder_name, tree_list, root, parents_id, service)
-    os_tree_list = []
-    root_len = len(full_path.split(os.path.sep)[0:-2])
-
-    # Получаем список папок на компъютере
-    for root, dirs, files in os.walk(full_path, topdown=True):
-        for name in dirs:
-            var_path = (os.path.sep).join(
-                root.split(os.path.sep)[root_len + 1:])
-            os_tree_list.append(os.path.join(var_path, name))
-
-    # старые папки на пк
-    remove_folders = list(set(tree_list).difference(set(os_tree_list)))
-    # новые папки на пк
-    upload_folders = list(set(os_tree_list).difference(set(tree_list)))
-    # совпадающие папки
-    exact_folders = list(set(os_tree_list).intersection(set(tree_list)))
-
-    # Добавляем стартовую директорию
-    exact_folders.append(folder_name)
-    # Сортируем выгружаемые папки, чтобы можно было идти по директории снизу вверх
-    upload_folders = sorted(upload_folders, key=by_lines)
-
-    # Выгружаем отсутствующие на гугл диске файлы
-    for folder_dir in upload_folders:
-        var = os.path.sep.join(full_path.split(os.path.sep)[0:-1]) + os.path.sep
-        variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-        pre_last_dir = folder_dir.split(os.path.sep)[-2]
-
-        files = [f for f in os.listdir(variable)
-                 if os.path.isfile(os.path.join(variable, f))]
-
-        folder_metadata = {'name': last_dir,
-                           'parents': [parents_id[pre_last_dir]],
-                           'mimeType': 'application/vnd.google-apps.folder'}
-        create_folder = service.files().create(
-            body=folder_metadata, fields='id').execute()
-        folder_id = create_folder.get('id', [])
-        parents_id[last_dir] = folder_id
-
-        for os_file in files:
-            some_metadata = {'name': os_file, 'parents': [folder_id]}
-            os_file_mimetype = mimetypes.MimeTypes().guess_type(
-                os.path.join(variable, os_file))[0]
-            media = MediaFileUpload(os.path.join(variable, os_file),
-                                    mimetype=os_file_mimetype)
-            upload_this = service.files().create(body=some_metadata,
-                                                 media_body=media,
-                                                 fields='id').execute()
-            upload_this = upload_this.get('id', [])
-
-    # Проверяем файлы в существующих папках и обновляем, если нужно
-    for folder_dir in exact_folders:
-
-        var = (os.path.sep).join(full_path.split(
-            os.path.sep)[0:-1]) + os.path.sep
-
-        variable = var + folder_dir
-        last_dir = folder_dir.split(os.path.sep)[-1]
-        os_files = [f for f in os.listdir(variable)
-                    if os.path.isfile(os.path.join(variable, f))]
-        results = service.files().list(
-            pageSize=1000, q=('%r in parents and \
-            mimeType!="application/vnd.google-apps.folder" and \
-            trashed != True' % parents_id[last_dir]),
-            fields="files(id, name, mimeType, \
-            modifiedTime, md5Checksum)").execute()
-
-        items = results.get('files', [])
-
-        refresh_files = [f for f in items if f['name'] in os_files]
-        remove_files = [f for f in items if f['name'] not in os_files]
-        upload_files = [f for f in os_files
-                        if f not in [j['name'] for j in items]]
-
-        # Проверяем файлы, которые есть и на пк и на диске
-        for drive_file in refresh_files:
-            file_dir = os.path.join(variable, drive_file['name'])
-            file_time = os.path.getmtime(file_dir)
-            mtime = [f['modifiedTime']
-                     for f in items if f['name'] == drive_file['name']][0]
-            mtime = datetime.datetime.strptime(
-                mtime[:-2], "%Y-%m-%dT%H:%M:%S.%f")
-            drive_time = time.mktime(mtime.timetuple())
-            os_file_md5 = hashlib.md5(open(file_dir, 'rb').read()).hexdigest()
-            if 'md5Checksum' in drive_file.keys():
-                drive_md5 = drive_file['md5Checksum']
-            else:
-                drive_md5 = None
-
-            if (file_time > drive_time) or (drive_md5 != os_file_md5):
-                file_id = [f['id'] for f in items
-                           if f['name'] == drive_file['name']][0]
-                file_mime = [f['mimeType'] for f in items
-                             if f['name'] == drive_file['name']][0]
-
-                # Новое содержимое файла
-                file_metadata = {'name': drive_file['name'],
-                                 'parents': [parents_id[last_dir]]}
-                media_body = MediaFileUpload(file_dir, mimetype=file_mime)
-                service.files().update(fileId=file_id,
-                                       media_body=media_body,
-                                       fields='id').execute()
-
-        # Удаляем старые файлы с диска
-        for drive_file in remove_files:
-            file_id = [f['id'] for f in items
-                       if f['name'] == drive_file['name']][0]
-            service.files().delete(fileId=file_id).execute()
-
-        # Выгружаем новые файлы на диск
-        for os_file in upload_files:
-            file_dir = os.path.join(variable, os_file)
-
-            # Новое содержимое файла
-            filemime = mimetypes.MimeTypes().guess_type(file_dir)[0]
-            file_metadata = {'name': os_file,
-                             'parents': [parents_id[last_dir]]}
-            media_body = MediaFileUpload(file_dir, mimetype=filemime)
-
-            service.files().create(body=file_metadata,
-                                   media_body=media_body,
-                                   fields='id').execute()
-
-    remove_folders = sorted(remove_folders, key=by_lines, reverse=True)
-
-    # Удаляем старые папки с диска
-    for folder_dir in remove_folders:
-        var = (os.path.sep).join(full_path.split(
-            os.path.sep)[0:-1]) + os.path.sep
-        variable = var + folder_dir
-        last_dir = folder_dir.split('/')[-1]
-        folder_id = parents_id[last_dir]
-        service.files().delete(fileId=folder_id).execute()
+    with UploadPool(service, http_factory, workers, state,
+                    chunk_size) as pool:
+        execute_plan(plan, service, state, tree, local.base_path,
+                     upload_pool=pool)
+    state.close()
+
+    METRICS.add_phase('total', time.perf_counter() - start)
+    METRICS.write(profile=profile)
 
 
 if __name__ == '__main__':
-    main()
+    args = parse_args()
+    if args.watch:
+        watch(workers=args.workers, chunk_size=args.chunk_size * 1024 * 1024,
+              debounce=args.debounce, interval=args.interval)
+    else:
+        main(workers=args.workers, chunk_size=args.chunk_size * 1024 * 1024,
+             profile=args.profile, dry_run=args.dry_run)
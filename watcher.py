@@ -0,0 +1,206 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from transfers import is_partial
+
+# Сколько секунд после последнего события ждать, прежде чем выгружать
+DEBOUNCE = 2.0
+# Дольше этого изменения не копятся, даже если события идут без перерыва
+MAX_DELAY = 30.0
+# Как часто делать полную сверку на случай пропущенных событий
+RECONCILE_EVERY = 600.0
+# Дольше этого событий не ждем, чтобы вовремя заметить should_stop
+POLL_TIMEOUT = 1.0
+
+# Флаги inotify из <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """Следит за изменениями в папке на пк через inotify (только Linux).
+
+    Подписывается на каждую подпапку, а на новые папки - по мере их
+    появления. Папки из .driveignore и недокачанные
+    .drivesync-part файлы пропускаются.
+
+    Аргументы:
+        full_path: Полный путь до папки синхронизации на пк.
+        ignore: IgnoreRules или None.
+    """
+
+    def __init__(self, full_path, ignore=None):
+        self.full_path = full_path.rstrip(os.path.sep)
+        self.base_path = os.path.dirname(self.full_path)
+        self.ignore = ignore
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.watches = {}
+        self._add_tree(os.path.basename(self.full_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add_tree(self, rel_dir):
+        """Подписывается на папку и все ее подпапки.
+
+        Возвращает:
+            Относительные пути всего, что уже лежит в папке: это могло
+            появиться до подписки, и событий об этом не будет.
+        """
+        found, stack = [], [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            dir_path = os.path.join(self.base_path, rel_dir)
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                # Папку успели удалить
+                continue
+            self.watches[wd] = rel_dir
+            try:
+                entries = list(os.scandir(dir_path))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self._skip(rel_path, entry.name, is_dir):
+                    continue
+                found.append(rel_path)
+                if is_dir:
+                    stack.append(rel_path)
+        return found
+
+    def _skip(self, rel_path, name, is_dir):
+        return ((not is_dir and is_partial(name))
+                or (self.ignore and self.ignore.match(rel_path, is_dir)))
+
+    def read(self, timeout):
+        """Ждет событий не дольше timeout секунд.
+
+        Возвращает:
+            Пару (множество относительных путей, которые поменялись,
+            переполнилась ли очередь событий). При переполнении
+            события потеряны и нужна полная сверка.
+        """
+        paths, overflow = set(), False
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return paths, overflow
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                rel_dir = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if rel_dir is None or not name:
+                    continue
+
+                name = os.fsdecode(name)
+                rel_path = os.path.join(rel_dir, name)
+                is_dir = bool(mask & IN_ISDIR)
+                if self._skip(rel_path, name, is_dir):
+                    continue
+                paths.add(rel_path)
+                if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                    paths.update(self._add_tree(rel_path))
+
+        return paths, overflow
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch_loop(watcher, push, reconcile, debounce=DEBOUNCE,
+               max_delay=MAX_DELAY, reconcile_every=RECONCILE_EVERY,
+               clock=time.monotonic, should_stop=lambda: False):
+    """Копит события и выгружает изменения пачками.
+
+    Изменения уходят, когда событий не было debounce секунд
+    (или они копятся уже max_delay секунд). Раз в reconcile_every
+    секунд и при потере событий делается полная сверка.
+
+    Аргументы:
+        watcher: Объект с методом read(timeout) -> (пути, переполнение),
+        например InotifyWatcher.
+        push: Функция push(paths), выгружающая изменившиеся пути.
+        reconcile: Функция без аргументов для полной сверки.
+        debounce: Сколько секунд тишины ждать перед выгрузкой.
+        max_delay: Сколько секунд максимум копить изменения.
+        reconcile_every: Как часто делать полную сверку, в секундах.
+        clock: Функция, возвращающая текущее время в секундах.
+        should_stop: Функция, по которой цикл завершается.
+    """
+    pending, first_event, last_event = set(), None, None
+    next_reconcile = clock() + reconcile_every
+
+    while not should_stop():
+        now = clock()
+        if pending:
+            timeout = min(last_event + debounce, first_event + max_delay) - now
+        else:
+            timeout = next_reconcile - now
+        paths, overflow = watcher.read(max(0, min(timeout, POLL_TIMEOUT,
+                                                  next_reconcile - now)))
+        now = clock()
+
+        if overflow:
+            pending, first_event = set(), None
+            reconcile()
+            next_reconcile = clock() + reconcile_every
+            continue
+
+        if paths:
+            pending |= paths
+            last_event = now
+            if first_event is None:
+                first_event = now
+
+        if pending and (now - last_event >= debounce
+                        or now - first_event >= max_delay):
+            push(pending)
+            pending, first_event = set(), None
+
+        if now >= next_reconcile:
+            reconcile()
+            next_reconcile = clock() + reconcile_every